@@ -60,6 +60,9 @@ def create_app(config_class=Config):
     from app.api import bp as api_bp
     app.register_blueprint(api_bp, url_prefix='/api')
 
+    from app.api import instrumentation
+    instrumentation.init_app(app)
+
     if not app.debug and not app.testing:
         if app.config['LOG_TO_STDOUT']:
             stream_handler = logging.StreamHandler()
@@ -85,10 +88,14 @@ def create_app(config_class=Config):
         Keeps the current URL scheme with the specified modifications.
         Is placed here to give Jinja global access it.
         A Python variant is accessible from `api.query`.
+        Passing None for a value removes it.
         """
         args = request.args.copy()
         for key, val in new_values.items():
-            args[key] = val
+            if val is None:
+                args.pop(key, None)
+            else:
+                args[key] = val
         return f"{request.path}?{url_encode(args)}"
 
     @app.template_global()
@@ -103,6 +110,49 @@ def create_app(config_class=Config):
         print()
         return ""
 
+    @app.cli.command('preload-locations')
+    def preload_locations():
+        """ Loads the bundled city/state coordinates into the location table. """
+        n = models.LocationCoordinates.preload()
+        print(f"Loaded {n} locations")
+
+    @app.cli.command('fill-coordinates')
+    def fill_coordinates():
+        """ Sets the coordinates of the companies, seekers and job posts that don't have them yet. """
+        n = models.fill_missing_coordinates()
+        print(f"Updated {n} rows")
+
+    @app.cli.command('remove-duplicate-scores')
+    def remove_duplicate_scores():
+        """
+        Deletes all but the newest match score of each seeker-job post pair.
+        `flask db upgrade` does this before adding the unique constraint; this is for databases that skip it.
+        """
+        from app.api.matchmaker import remove_duplicate_scores
+        n = remove_duplicate_scores()
+        print(f"Removed {n} duplicate scores")
+
+    @app.cli.command('move-legacy-resumes')
+    def move_legacy_resumes():
+        """ Moves resumes still in the old profile column to the resume table (`flask db upgrade` does this too). """
+        from app.api.resumes import move_legacy_resumes
+        n = move_legacy_resumes()
+        print(f"Moved {n} resumes")
+
+    @app.cli.command('prune-resumes')
+    def prune_resumes():
+        """ Deletes the stored resumes that no seeker has anymore. """
+        from app.api.resumes import prune_resumes
+        n = prune_resumes()
+        print(f"Deleted {n} resumes")
+
+    @app.cli.command('compress-stored')
+    def compress_stored():
+        """ Compresses the resumes and long text stored before compression was added. """
+        from app.api.resumes import compress_stored
+        counts = compress_stored()
+        print(", ".join(f"Compressed {n} {key}" for key, n in counts.items()))
+
     @app.template_filter('filename')
     def filename(s):
         l = re.findall('\'([^\']*).html', str(s))
@@ -2,4 +2,4 @@ from flask import Blueprint
 
 bp = Blueprint('api', __name__)
 
-from app.api import users, matchmaker
+from app.api import users, matchmaker, tasks, spatial, search_cache, images
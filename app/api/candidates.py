@@ -0,0 +1,95 @@
+# An in-memory inverted index from skills/attitudes to the seekers and job posts that have them.
+# Used by the matchmaker to skip pairs that can't earn any skill or attitude points.
+from collections import Counter
+from threading import Lock
+from typing import Dict, Iterable, Set
+
+from sqlalchemy import func
+
+from app import db
+from app.models import SeekerSkill, SeekerAttitude, JobPostSkill, JobPostAttitude
+
+
+class _TableIndex:
+    """
+    Maps each attribute ID (skill or attitude) in an association table to a counter of the owner IDs
+        (seeker or job post) that have it, counting how many entries each owner has for it.
+    The index is refreshed from the table on every read:
+        new entries are fetched by ID, and a full reload only happens if entries were deleted.
+    """
+    def __init__(self, model, owner_column, attribute_column):
+        self.model = model
+        self.owner_column = owner_column
+        self.attribute_column = attribute_column
+        self.owners = dict()  # type: Dict[int, Counter]
+        self.count = None
+        self.max_id = 0
+        self._lock = Lock()
+
+    def _add(self, rows):
+        for owner_id, attribute_id in rows:
+            self.owners.setdefault(attribute_id, Counter())[owner_id] += 1
+
+    def refresh(self):
+        count, max_id = db.session.query(func.count(self.model.id), func.max(self.model.id)).one()
+        max_id = max_id or 0
+        with self._lock:
+            if count == self.count and max_id == self.max_id:
+                return
+            rows = []
+            if self.count is not None:
+                rows = db.session.query(self.owner_column, self.attribute_column)\
+                    .filter(self.model.id > self.max_id)\
+                    .all()
+            if self.count is None or count != self.count + len(rows):
+                # first load, or some entries were deleted; rebuild from scratch
+                self.owners = dict()
+                rows = db.session.query(self.owner_column, self.attribute_column).all()
+            self._add(rows)
+            self.count, self.max_id = count, max_id
+
+    def get(self, attribute_id: int) -> Counter:
+        return self.owners.get(attribute_id, Counter())
+
+
+class AttributeIndex:
+    """
+    Inverted index of skill and attitude IDs to the seekers and job posts that have them.
+    """
+    def __init__(self):
+        self.seekers_by_skill = _TableIndex(SeekerSkill, SeekerSkill.seeker_id, SeekerSkill.skill_id)
+        self.seekers_by_attitude = _TableIndex(SeekerAttitude, SeekerAttitude.seeker_id, SeekerAttitude.attitude_id)
+        self.posts_by_skill = _TableIndex(JobPostSkill, JobPostSkill.jobpost_id, JobPostSkill.skill_id)
+        self.posts_by_attitude = _TableIndex(JobPostAttitude, JobPostAttitude.jobpost_id, JobPostAttitude.attitude_id)
+
+    def refresh(self):
+        """ Brings all four mappings up to date with their tables. """
+        self.seekers_by_skill.refresh()
+        self.seekers_by_attitude.refresh()
+        self.posts_by_skill.refresh()
+        self.posts_by_attitude.refresh()
+
+    def seekers_sharing(self, skill_ids: Iterable[int], attitude_ids: Iterable[int]) -> Set[int]:
+        """ Gets the IDs of the seekers that have at least one of the given skills or attitudes. """
+        self.seekers_by_skill.refresh()
+        self.seekers_by_attitude.refresh()
+        ids = set()
+        for sid in skill_ids:
+            ids.update(self.seekers_by_skill.get(sid))
+        for aid in attitude_ids:
+            ids.update(self.seekers_by_attitude.get(aid))
+        return ids
+
+    def posts_sharing(self, skill_ids: Iterable[int], attitude_ids: Iterable[int]) -> Set[int]:
+        """ Gets the IDs of the job posts that require at least one of the given skills or attitudes. """
+        self.posts_by_skill.refresh()
+        self.posts_by_attitude.refresh()
+        ids = set()
+        for sid in skill_ids:
+            ids.update(self.posts_by_skill.get(sid))
+        for aid in attitude_ids:
+            ids.update(self.posts_by_attitude.get(aid))
+        return ids
+
+
+attribute_index = AttributeIndex()
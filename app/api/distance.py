@@ -0,0 +1,138 @@
+# Distance calculations between locations.
+# Distances from one origin to many coordinates are computed at once with a vectorized haversine formula.
+# Haversine treats the earth as a sphere, so it can be off from geopy's (ellipsoidal) geodesic by up to ~0.5%;
+#   the `DISTANCE_ACCURACY` config chooses how that is handled:
+#   'fast' - haversine only
+#   'auto' - haversine, with geodesic only for the distances close enough to a limit to be on the wrong side of it
+#            (gives the same answers as 'exact')
+#   'exact' - geodesic for every distance
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+import numpy as np
+from flask import current_app, has_app_context
+from geopy.distance import geodesic
+from sqlalchemy import and_, or_
+
+from app.models import LocationCoordinates
+
+EARTH_RADIUS_MI = 3958.7613
+# relative difference between haversine and geodesic is below 0.56% anywhere on earth; pad it a little
+HAVERSINE_MAX_ERROR = 0.006
+
+Coordinates = Tuple[float, float]
+
+
+def _accuracy() -> str:
+    return current_app.config['DISTANCE_ACCURACY'] if has_app_context() else 'auto'
+
+
+def _as_array(coords: Sequence[Coordinates]) -> np.ndarray:
+    return np.asarray(coords, dtype=float).reshape(-1, 2)
+
+
+def haversine_miles(origin: Coordinates, coords: Sequence[Coordinates]) -> np.ndarray:
+    """ Gets the great-circle distance in miles from the origin to each of the (lat, lng) coordinates. """
+    coords = _as_array(coords)
+    lat0, lng0 = np.radians(float(origin[0])), np.radians(float(origin[1]))
+    lats, lngs = np.radians(coords[:, 0]), np.radians(coords[:, 1])
+    a = np.sin((lats - lat0) / 2) ** 2 + np.cos(lat0) * np.cos(lats) * np.sin((lngs - lng0) / 2) ** 2
+    return 2 * EARTH_RADIUS_MI * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def _geodesic_miles(origin: Coordinates, coords: np.ndarray) -> np.ndarray:
+    return np.array([geodesic(origin, tuple(c)).miles for c in coords], dtype=float)
+
+
+def distances_miles(origin: Coordinates, coords: Sequence[Coordinates]) -> np.ndarray:
+    """ Gets the distance in miles from the origin to each of the coordinates, per `DISTANCE_ACCURACY`. """
+    coords = _as_array(coords)
+    if _accuracy() == 'exact':
+        return _geodesic_miles(origin, coords)
+    return haversine_miles(origin, coords)
+
+
+def bands(origin: Coordinates, coords: Sequence[Coordinates], limits: Sequence[float]) -> np.ndarray:
+    """
+    Gets the index of the first (smallest) limit that each coordinate is within, or `len(limits)` if none.
+    E.g., with limits of (50, 100): 0 means within 50 miles, 1 within 100 miles and 2 is further.
+    """
+    coords = _as_array(coords)
+    accuracy = _accuracy()
+    dists = _geodesic_miles(origin, coords) if accuracy == 'exact' else haversine_miles(origin, coords)
+    if accuracy == 'auto' and len(coords):
+        # only the distances that could fall on either side of a limit need the precise measure
+        near = np.zeros(len(coords), dtype=bool)
+        for limit in limits:
+            near |= np.abs(dists - limit) <= limit * HAVERSINE_MAX_ERROR
+        if near.any():
+            dists[near] = _geodesic_miles(origin, coords[near])
+    idx = np.full(len(coords), len(limits), dtype=np.int64)
+    for i, limit in reversed(list(enumerate(limits))):
+        idx[dists <= limit] = i
+    return idx
+
+
+def within(origin: Coordinates, coords: Sequence[Coordinates], distance: float) -> np.ndarray:
+    """ Checks which of the coordinates are within the distance (in miles) of the origin. """
+    return bands(origin, coords, [distance]) == 0
+
+
+def is_within(coords_a: Coordinates, coords_b: Coordinates, distance: float) -> bool:
+    """ Checks if two points are within the distance (in miles) of each other. """
+    return bool(within(coords_a, [coords_b], distance)[0])
+
+
+def locations_within(locations: Iterable[Tuple[str, str]], distance: float,
+                     city: str, state: str) -> Dict[Tuple[str, str], bool]:
+    """
+    Checks which of the (city, state) locations are within the distance of the given city/state.
+    Locations without a city or a state are always considered within.
+    """
+    locations = set(locations)
+    known = [loc for loc in locations if loc[0] or loc[1]]
+    result = {loc: True for loc in locations if not (loc[0] or loc[1])}
+    if known:
+        origin = LocationCoordinates.get(city, state)
+        mask = within(origin, [LocationCoordinates.get(*loc) for loc in known], distance)
+        result.update(zip(known, mask.tolist()))
+    return result
+
+
+def bounding_box_filter(lat_column, lng_column, origin: Coordinates, distance: float):
+    """
+    Converts a radius search to an (indexable) SQL filter on latitude/longitude columns:
+        the box around the radius, plus the rows without coordinates (which are checked by `ids_within`).
+    The box is slightly larger than needed, so it never excludes anything that is actually within the distance.
+    """
+    lat, lng = float(origin[0]), float(origin[1])
+    pad = distance * (1 + HAVERSINE_MAX_ERROR)
+    dlat = np.degrees(pad / EARTH_RADIUS_MI)
+    in_box = lat_column.between(lat - dlat, lat + dlat)
+    # longitude degrees shrink away from the equator; use the box's edge furthest from it
+    max_lat = min(abs(lat) + dlat, 90)
+    if max_lat < 89:
+        dlng = np.degrees(pad / (EARTH_RADIUS_MI * np.cos(np.radians(max_lat))))
+        if lng - dlng >= -180 and lng + dlng <= 180:  # otherwise the box wraps around; skip the longitude check
+            in_box = and_(in_box, lng_column.between(lng - dlng, lng + dlng))
+    return or_(in_box, lat_column.is_(None))
+
+
+def ids_within(rows: Iterable[Tuple[int, float, float, str, str]], distance: float,
+               city: str, state: str) -> List[int]:
+    """
+    Gets the IDs of the (id, latitude, longitude, city, state) rows that are within the given distance
+        of the city/state.
+    Rows with coordinates are all measured together; the others fall back to looking up their city/state
+        (each distinct location only once), and are always within if they don't have either.
+    """
+    rows = list(rows)
+    with_coords = [r for r in rows if r[1] is not None and r[2] is not None]
+    without = [r for r in rows if r[1] is None or r[2] is None]
+    ids = []
+    if with_coords:
+        mask = within(LocationCoordinates.get(city, state), [(r[1], r[2]) for r in with_coords], distance)
+        ids += [r[0] for r, ok in zip(with_coords, mask.tolist()) if ok]
+    if without:
+        within_by_loc = locations_within([(r[3], r[4]) for r in without], distance, city, state)
+        ids += [r[0] for r in without if within_by_loc[(r[3], r[4])]]
+    return ids
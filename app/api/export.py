@@ -0,0 +1,107 @@
+# Streaming exports of search results (the download buttons on the search pages).
+# Rows are fetched in batches with their related details loaded alongside, converted one at a time,
+#   and sent as they're ready, so an export of any size starts right away and uses about the same memory.
+import csv
+import io
+import json
+import textwrap
+from datetime import datetime
+from typing import Iterable, Iterator
+
+from flask import Response, current_app, stream_with_context
+
+EXPORT_FORMATS = {
+    'json': 'text/json',
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv'
+}
+# output is sent in chunks of about this many characters, rather than a write per row
+CHUNK_SIZE = 64 * 1024
+
+
+def iter_dicts(query) -> Iterator[dict]:
+    """
+    Converts each result of the query to its dictionary, fetching `EXPORT_BATCH_SIZE` rows at a time.
+    The query should use the 'export' loading profile, so each batch loads what `to_dict` needs along with it.
+    Rows aren't kept once converted (the session only holds weak references to unchanged rows).
+    """
+    for row in query.yield_per(current_app.config['EXPORT_BATCH_SIZE']):
+        yield row.to_dict()
+
+
+def _flatten(d: dict) -> dict:
+    """
+    Flattens a dictionary for a CSV row: nested dictionaries become 'outer.inner' columns (one level deep),
+        and any lists or deeper dictionaries are written as JSON.
+    """
+    flat = dict()
+    for key, val in d.items():
+        inner = val.items() if isinstance(val, dict) else [(None, val)]
+        for inner_key, inner_val in inner:
+            if inner_key == '__comment':
+                continue
+            if isinstance(inner_val, (list, tuple, dict)):
+                inner_val = json.dumps(inner_val)
+            flat[key if inner_key is None else f"{key}.{inner_key}"] = inner_val
+    return flat
+
+
+def _json_lines(rows: Iterable[dict], query_str: str) -> Iterator[str]:
+    """ The JSON envelope (timestamp, query and results), written out a result at a time. """
+    head = json.dumps({"timestamp": datetime.now().isoformat(), "query": query_str}, indent=4)
+    yield head[:-2] + ',\n    "results": ['
+    sep = '\n'
+    for row in rows:
+        yield sep + textwrap.indent(json.dumps(row, indent=4), ' ' * 8)
+        sep = ',\n'
+    yield ('\n    ]' if sep != '\n' else ']') + '\n}'
+
+
+def _ndjson_lines(rows: Iterable[dict]) -> Iterator[str]:
+    for row in rows:
+        yield json.dumps(row) + '\n'
+
+
+def _csv_lines(rows: Iterable[dict]) -> Iterator[str]:
+    buffer = io.StringIO()
+    writer = None
+    for row in rows:
+        row = _flatten(row)
+        if writer is None:  # the columns are the same for every row of a type
+            writer = csv.DictWriter(buffer, fieldnames=list(row), extrasaction='ignore', restval='')
+            writer.writeheader()
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def _chunked(parts: Iterable[str]) -> Iterator[str]:
+    """ Groups the parts into chunks of about `CHUNK_SIZE`; the first is sent on its own so the download starts. """
+    chunk, size, first = [], 0, True
+    for part in parts:
+        chunk.append(part)
+        size += len(part)
+        if first or size >= CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk, size, first = [], 0, False
+    if chunk:
+        yield ''.join(chunk)
+
+
+def export_response(query, fmt: str, filename: str, query_str: str) -> Response:
+    """ Streams the results of the query as an attachment in the given format ('json', 'ndjson' or 'csv'). """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {fmt}")
+    rows = iter_dicts(query)
+    if fmt == 'ndjson':
+        lines = _ndjson_lines(rows)
+    elif fmt == 'csv':
+        lines = _csv_lines(rows)
+    else:
+        lines = _json_lines(rows, query_str)
+    return Response(stream_with_context(_chunked(lines)),
+                    mimetype=EXPORT_FORMATS[fmt],
+                    headers={'Content-disposition': f'attachment; filename={filename}.{fmt}',
+                             # tells a proxy in front (e.g., nginx) to pass it along as it comes
+                             'X-Accel-Buffering': 'no'})
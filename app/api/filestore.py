@@ -0,0 +1,87 @@
+# A local directory of content-addressed files, which the web server in front can send in place of a worker.
+# With `FILE_OFFLOAD` set, download routes do their checks as usual, make sure the file is in `FILE_STORE_DIR`,
+#   and answer with just a header naming it; the web server then sends the file itself (with ranges, etc.):
+#   'x-accel' - nginx's X-Accel-Redirect, to an `internal` location at `FILE_STORE_URL_PREFIX` that serves the
+#               directory, e.g.:  location /_files/ { internal; alias /path/to/FILE_STORE_DIR/; }
+#   'x-sendfile' - the X-Sendfile header (Apache's mod_xsendfile, lighttpd), with the file's full path
+# Files are named by the hash of their contents, so they never change once written and need no invalidation.
+import os
+import shutil
+import tempfile
+from typing import BinaryIO, Optional
+
+from flask import Response, current_app, request
+
+OFFLOAD_MODES = ('x-accel', 'x-sendfile')
+COPY_BUFFER_SIZE = 256 * 1024
+
+
+def offload_mode() -> Optional[str]:
+    """ Gets the configured offload mode, or None if files are sent by the workers. """
+    mode = (current_app.config['FILE_OFFLOAD'] or '').lower()
+    if not mode:
+        return None
+    if mode not in OFFLOAD_MODES:
+        raise ValueError(f"Unknown file offload mode: {mode}")
+    return mode
+
+
+def _relative_path(kind: str, key: str) -> str:
+    """ The path of a file within the store (spread across subdirectories by the start of its key). """
+    return f"{kind}/{key[:2]}/{key}"
+
+
+def file_path(kind: str, key: str) -> str:
+    """ Gets the full path that a file is (or would be) stored at. """
+    return os.path.join(current_app.config['FILE_STORE_DIR'], _relative_path(kind, key))
+
+
+def stored_path(kind: str, key: str) -> Optional[str]:
+    """ Gets the full path of a stored file, or None if it isn't stored. """
+    path = file_path(kind, key)
+    return path if os.path.isfile(path) else None
+
+
+def store_file(kind: str, key: str, source: BinaryIO) -> str:
+    """
+    Copies the contents of the file to the store, unless they're already there. Returns the full path.
+    The file is written under a temporary name and then renamed, so a partly written one is never sent.
+    """
+    path = file_path(kind, key)
+    if os.path.isfile(path):
+        return path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            shutil.copyfileobj(source, f, COPY_BUFFER_SIZE)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return path
+
+
+def offload_response(kind: str, key: str, mimetype: str, filename: str = None,
+                     cache_control: str = 'private, no-cache') -> Response:
+    """
+    Answers with a header telling the web server to send the stored file (see `offload_mode`).
+    The file has to be stored already, and the caller has to have done any permission checks.
+    Its key is used as the ETag; by default it's only cached privately (and revalidated).
+    """
+    mode = offload_mode()
+    if mode is None:
+        raise ValueError("File offloading isn't enabled.")
+    rv = Response(mimetype=mimetype)
+    rv.automatically_set_content_length = False  # the body is filled in by the web server
+    if mode == 'x-accel':
+        prefix = current_app.config['FILE_STORE_URL_PREFIX'].rstrip('/')
+        rv.headers['X-Accel-Redirect'] = f"{prefix}/{_relative_path(kind, key)}"
+    else:
+        rv.headers['X-Sendfile'] = os.path.abspath(file_path(kind, key))
+    if filename is not None:
+        rv.headers.set('Content-Disposition', 'attachment', filename=filename)
+    rv.set_etag(key)
+    rv.headers['Cache-Control'] = cache_control
+    # an unchanged file is answered here, without handing it off
+    return rv.make_conditional(request)
@@ -0,0 +1,279 @@
+# Avatars and banners, rendered locally (with Wand) in a fixed set of sizes and kept on disk.
+# An image is described by a "spec" (what to draw, e.g., the initials and color of an avatar, or which uploaded
+#   picture to resize, and at what size), and named by its hash. Pages only build URLs (the hash is part of it),
+#   so showing a page of cards does no image work; the first request for an image renders it in a process pool
+#   and saves it in the file store, and every request after that (with any worker) is just a file being sent.
+# The URLs change whenever what's drawn does, so the images are sent with long-lived cache headers.
+import colorsys
+import hashlib
+import io
+import os
+import tempfile
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from tempfile import SpooledTemporaryFile
+from threading import Lock
+from typing import BinaryIO, Tuple
+from zlib import crc32
+
+from flask import abort, current_app, request, send_file, url_for
+from flask_login import current_user
+
+from app.api import bp
+from app.api.filestore import file_path, offload_mode, offload_response, store_file, stored_path
+from app.models import CompanyProfile, SeekerProfile
+
+AVATAR_SIZES = (64, 96, 128)
+BANNER_SIZES = ((100, 20), (1000, 100))
+# bumped when the drawing changes, so the old renders aren't reused
+RENDER_VERSION = 1
+# an image is only rendered once, so its URL can be cached for a year
+IMAGE_CACHE_CONTROL = 'private, max-age=31536000, immutable'
+
+Spec = Tuple
+
+_pool = None
+_pool_lock = Lock()
+
+
+def _nearest(size, sizes):
+    """ The smallest of the sizes at least as wide as the one asked for (or the biggest, if none are). """
+    width = size[0] if isinstance(size, tuple) else size
+    for s in sizes:
+        if (s[0] if isinstance(s, tuple) else s) >= width:
+            return s
+    return sizes[-1]
+
+
+def _initials(*names: str) -> str:
+    return "".join(n.strip()[0] for n in names if n and n.strip())[:2].upper() or "?"
+
+
+def _color(seed: str, saturation: float = 0.25, value: float = 1.0) -> str:
+    """ A "random" hex color for the seed (the same one each time). """
+    hue = float(crc32(seed.encode("utf-8")) & 0xffffffff) / 2 ** 32
+    return "".join(f"{int(round(255 * x)):02x}" for x in colorsys.hsv_to_rgb(hue, saturation, value))
+
+
+def image_spec(owner, variant: str, uploaded: bool = True) -> Spec:
+    """
+    Gets the spec of a seeker's/company's image: 'avatar' or 'banner' (companies only).
+    Their uploaded picture is used if there is one (and `uploaded` is set), otherwise one is drawn from their name.
+    """
+    if variant == 'avatar':
+        if isinstance(owner, SeekerProfile):
+            if uploaded and owner.picture_hash is not None:
+                return ('picture', owner.picture_hash)
+            return ('initials', _initials(owner.first_name, owner.last_name), _color(owner._user.email))
+        if uploaded and owner.logo_hash is not None:
+            return ('picture', owner.logo_hash)
+        return ('initials', _initials(*owner.name.split()[:2]), _color(owner.name, 0.45, 0.95))
+    if variant == 'banner' and isinstance(owner, CompanyProfile):
+        if uploaded and owner.banner_hash is not None:
+            return ('picture', owner.banner_hash)
+        return ('gradient', _color(owner.name, 0.45, 0.95), _color(owner.name[::-1], 0.45, 0.75))
+    raise ValueError(f"Unknown image: {variant}")
+
+
+def image_key(spec: Spec, size) -> str:
+    """ The name of the rendered image: the hash of everything that goes into it. """
+    return hashlib.sha256(repr((RENDER_VERSION, spec, size)).encode('utf-8')).hexdigest()[:40]
+
+
+def _mimetype(spec: Spec) -> str:
+    return 'image/jpeg' if spec[0] == 'picture' else 'image/png'
+
+
+def image_url(owner, variant: str, size) -> str:
+    """ Gets the URL of a seeker's/company's image, at the nearest size that's rendered. """
+    size = _nearest(size, AVATAR_SIZES if variant == 'avatar' else BANNER_SIZES)
+    kind = 'seeker' if isinstance(owner, SeekerProfile) else 'company'
+    dims = f"{size[0]}x{size[1]}" if isinstance(size, tuple) else str(size)
+    return url_for('api.image', kind=kind, owner_id=owner.id, variant=variant, dims=dims,
+                   v=image_key(image_spec(owner, variant), size))
+
+
+##### RENDERING #####
+def _render(spec: Spec, size, source_path: str, path: str):
+    """ Draws the image and saves it to the path. Runs in the process pool, so has no app context. """
+    from wand.color import Color
+    from wand.drawing import Drawing
+    from wand.image import Image
+
+    width, height = size if isinstance(size, tuple) else (size, size)
+    if spec[0] == 'picture':
+        img = Image(filename=source_path)
+        img.auto_orient()
+        img.transform(resize=f"{width}x{height}^")  # fills the size, then the overflow is cropped
+        img.crop(width=width, height=height, gravity='center')
+        img.background_color = Color('white')
+        img.alpha_channel = 'remove'
+        img.strip()
+        img.format = 'jpeg'
+        img.compression_quality = 85
+    elif spec[0] == 'gradient':
+        img = Image(pseudo=f"gradient:#{spec[1]}-#{spec[2]}", width=height, height=width)
+        img.rotate(90)
+        img.format = 'png'
+    else:  # initials, in a circle
+        img = Image(width=width, height=height, background=Color('transparent'))
+        with Drawing() as draw:
+            draw.fill_color = Color(f"#{spec[2]}")
+            draw.circle((width / 2, height / 2), (width / 2, 0))
+            draw.fill_color = Color('#000000')
+            draw.font_weight = 700
+            draw.font_size = height * 0.4
+            draw.text_alignment = 'center'
+            draw.text(int(width / 2), int(height / 2 + height * 0.14), spec[1])
+            draw(img)
+        img.format = 'png'
+    with img:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                img.save(file=f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    """ The process pool of this worker (started on first use, so each forked worker gets its own). """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=current_app.config['IMAGE_RENDER_PROCESSES'])
+        return _pool
+
+
+def _replace_pool(broken: ProcessPoolExecutor):
+    """ Drops a pool whose process died (e.g., crashed on an image), so the next use starts a new one. """
+    global _pool
+    with _pool_lock:
+        if _pool is broken:
+            _pool = None
+    broken.shutdown(wait=False)
+
+
+def _submit(spec: Spec, size) -> Tuple[ProcessPoolExecutor, Future]:
+    """ Starts rendering the image in the pool (replacing the pool first if it's broken). """
+    source_path = file_path('image-sources', spec[1]) if spec[0] == 'picture' else None
+    args = (_render, spec, size, source_path, file_path('images', image_key(spec, size)))
+    pool = _get_pool()
+    try:
+        return pool, pool.submit(*args)
+    except BrokenProcessPool:
+        _replace_pool(pool)
+        pool = _get_pool()
+        return pool, pool.submit(*args)
+
+
+def rendered_path(spec: Spec, size) -> str:
+    """
+    Gets the path of the rendered image, rendering it first (in the pool) if it isn't yet.
+    If the pool breaks while rendering, it's replaced and the image is tried once more.
+    """
+    key = image_key(spec, size)
+    path = stored_path('images', key)
+    if path is None:
+        timeout = current_app.config['IMAGE_RENDER_TIMEOUT_SECONDS']
+        pool, future = _submit(spec, size)
+        try:
+            future.result(timeout=timeout)
+        except BrokenProcessPool:
+            _replace_pool(pool)
+            _submit(spec, size)[1].result(timeout=timeout)
+        path = file_path('images', key)
+    return path
+
+
+def render_failed(spec: Spec, size) -> bool:
+    """ Whether rendering the image failed before (see `_mark_failed`), so it shouldn't be tried again. """
+    return stored_path('image-failures', image_key(spec, size)) is not None
+
+
+def _mark_failed(spec: Spec, size, error: Exception):
+    """ Records that the image couldn't be rendered (e.g., an upload that isn't an image), with the error. """
+    store_file('image-failures', image_key(spec, size), io.BytesIO(str(error).encode('utf-8')))
+
+
+def prerender(owner):
+    """ Starts rendering every size of a seeker's/company's images (e.g., after a new picture is uploaded). """
+    variants = (('avatar', AVATAR_SIZES),) if isinstance(owner, SeekerProfile) \
+        else (('avatar', AVATAR_SIZES), ('banner', BANNER_SIZES))
+    for variant, sizes in variants:
+        spec = image_spec(owner, variant)
+        for size in sizes:
+            if stored_path('images', image_key(spec, size)) is None and not render_failed(spec, size):
+                _submit(spec, size)
+
+
+def store_picture(source: BinaryIO) -> str:
+    """ Stores an uploaded picture (the original, which the sizes are rendered from). Returns its hash. """
+    max_bytes = current_app.config['IMAGE_MAX_UPLOAD_BYTES']
+    with SpooledTemporaryFile(max_size=max_bytes) as spool:
+        digest, size = hashlib.sha256(), 0
+        for chunk in iter(lambda: source.read(64 * 1024), b''):
+            size += len(chunk)
+            if size > max_bytes:
+                raise ValueError(f"Picture is larger than the limit of {max_bytes} bytes.")
+            digest.update(chunk)
+            spool.write(chunk)
+        spool.seek(0)
+        key = digest.hexdigest()
+        store_file('image-sources', key, spool)
+    return key
+
+
+@bp.route('/image/<kind>/<int:owner_id>/<variant>/<dims>')
+def image(kind, owner_id, variant, dims):
+    """
+    Sends a seeker's/company's avatar or banner (rendering it if it's the first time it's asked for).
+    Companies' images are public (they're shown on the public company listing); seekers' need a login,
+        like the pages that show them.
+    """
+    model = {'seeker': SeekerProfile, 'company': CompanyProfile}.get(kind)
+    if model is None:
+        abort(404)
+    if model is SeekerProfile and not current_user.is_authenticated:
+        return current_app.login_manager.unauthorized()
+    owner = model.query.filter_by(id=owner_id).first()
+    if owner is None:
+        abort(404)
+    try:
+        size = tuple(int(d) for d in dims.split('x'))
+        size = size[0] if len(size) == 1 else size
+        if size not in (AVATAR_SIZES if variant == 'avatar' else BANNER_SIZES):
+            abort(404)
+        spec = image_spec(owner, variant)
+    except ValueError:
+        abort(404)
+
+    path = None
+    if spec[0] == 'picture' and render_failed(spec, size):
+        spec = image_spec(owner, variant, uploaded=False)
+    else:
+        try:
+            path = rendered_path(spec, size)
+        except TimeoutError:
+            abort(503)
+        except Exception as e:  # e.g., an upload that isn't an image; falls back to the drawn one
+            current_app.logger.warning(f"Couldn't render {kind} {owner_id}'s {variant}: {e}")
+            if spec[0] != 'picture':
+                raise
+            _mark_failed(spec, size, e)  # so it isn't decoded again on every view
+            spec = image_spec(owner, variant, uploaded=False)
+    key = image_key(spec, size)
+    if path is None:
+        path = rendered_path(spec, size)
+
+    # an old URL (from before the image changed) gets the current image, but it isn't kept for long
+    cache_control = IMAGE_CACHE_CONTROL if request.args.get('v') == key else 'private, no-cache'
+    if offload_mode() is not None:
+        return offload_response('images', key, _mimetype(spec), cache_control=cache_control)
+    rv = send_file(path, mimetype=_mimetype(spec), add_etags=False)
+    rv.set_etag(key)
+    rv.headers['Cache-Control'] = cache_control
+    return rv.make_conditional(request)
@@ -0,0 +1,148 @@
+# Per-request SQL instrumentation, built on the engine's cursor events.
+# For each request it counts the statements run, the time spent in the database and how often each statement
+#   "shape" (the SQL with its values taken out) repeats. A SELECT shape that runs more than `SQL_N_PLUS_ONE_THRESHOLD`
+#   times is flagged as a likely N+1 (e.g., a lazy load per row of a listing).
+# Statements slower than `SQL_SLOW_QUERY_MS` are logged with their parameters (and their EXPLAIN ANALYZE output
+#   when `SQL_EXPLAIN_SLOW` is set). Each request's summary is kept in a ring buffer for the admin analytics pages,
+#   and is added to the response headers in debug mode.
+import re
+import time
+from collections import Counter, deque
+from datetime import datetime
+from typing import List
+
+from flask import current_app, g, has_app_context, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_IN_LIST = re.compile(r"\(\s*(%\([^)]+\)s|\?|:\w+)(\s*,\s*(%\([^)]+\)s|\?|:\w+))*\s*\)")
+_PARAM = re.compile(r"%\([^)]+\)s|:\w+|\?")
+_NUMBER = re.compile(r"\b\d+(\.\d+)?\b")
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_SPACE = re.compile(r"\s+")
+# longest statement/parameter text kept in logs and summaries
+MAX_TEXT = 500
+
+# summaries of the most recent requests, newest last (sized by `SQL_STATS_BUFFER_SIZE` in `init_app`)
+_recent = deque(maxlen=200)
+
+
+def statement_shape(statement: str) -> str:
+    """ Gets a statement with its values (parameters, literals and IN lists) replaced, so repeats can be matched. """
+    shape = _STRING.sub("?", statement)
+    shape = _IN_LIST.sub("(?)", shape)
+    shape = _PARAM.sub("?", shape)
+    shape = _NUMBER.sub("?", shape)
+    return _SPACE.sub(" ", shape).strip()
+
+
+def _truncate(text: str) -> str:
+    return text if len(text) <= MAX_TEXT else text[:MAX_TEXT] + "..."
+
+
+class RequestStats:
+    """ The statements run during one request. """
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.count = 0
+        self.db_seconds = 0.0
+        self.shapes = Counter()
+        self.slow = []  # (milliseconds, statement)
+
+    def record(self, statement: str, seconds: float):
+        self.count += 1
+        self.db_seconds += seconds
+        self.shapes[statement_shape(statement)] += 1
+
+    def n_plus_one(self, threshold: int) -> List[tuple]:
+        """ Gets the (shape, count) of the SELECTs repeated more than the threshold, most repeated first. """
+        return [(shape, n) for shape, n in self.shapes.most_common()
+                if n > threshold and shape.lstrip('( ').upper().startswith('SELECT')]
+
+
+def _explain(conn, statement: str, parameters) -> str:
+    """
+    Runs EXPLAIN ANALYZE on a slow SELECT (which runs it again). It's run on a separate pooled connection
+        (a raw one, so these events are skipped) and rolled back, so it can't touch the request's transaction;
+        that connection can't see the request's uncommitted rows, and doesn't wait long on its locks.
+    """
+    raw_conn = conn.engine.raw_connection()
+    try:
+        cursor = raw_conn.cursor()
+        cursor.execute("SET LOCAL lock_timeout = '1s'")
+        cursor.execute(f"EXPLAIN ANALYZE {statement}", parameters)
+        return "\n".join(row[0] for row in cursor.fetchall())
+    except Exception as e:
+        return f"(could not explain: {e})"
+    finally:
+        raw_conn.rollback()
+        raw_conn.close()  # back to the pool
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('query_start')
+    if not starts:
+        return
+    seconds = time.perf_counter() - starts.pop()
+    if not has_app_context() or not current_app.config['SQL_INSTRUMENTATION']:
+        return  # e.g., another app in the same process that has it off
+    if has_request_context() and 'sql_stats' in g:
+        g.sql_stats.record(statement, seconds)
+
+    ms = seconds * 1000
+    if ms >= current_app.config['SQL_SLOW_QUERY_MS']:
+        message = f"Slow query ({ms:.1f} ms): {_truncate(statement)}\n    parameters: {_truncate(repr(parameters))}"
+        if current_app.config['SQL_EXPLAIN_SLOW'] and not executemany \
+                and statement.lstrip('( ').upper().startswith('SELECT'):
+            message += "\n" + _explain(conn, statement, parameters)
+        current_app.logger.warning(message)
+        if has_request_context() and 'sql_stats' in g:
+            g.sql_stats.slow.append((round(ms, 1), _truncate(statement)))
+
+
+def recent_requests() -> List[dict]:
+    """ Gets the summaries of the most recent requests, newest first. """
+    return list(reversed(_recent))
+
+
+def _start_request():
+    g.sql_stats = RequestStats()
+
+
+def _finish_request(response):
+    stats = g.pop('sql_stats', None)
+    if stats is None:
+        return response
+    threshold = current_app.config['SQL_N_PLUS_ONE_THRESHOLD']
+    suspects = stats.n_plus_one(threshold)
+    summary = dict(time=datetime.now().isoformat(timespec='seconds'), method=request.method, path=request.path,
+                   endpoint=request.endpoint, status=response.status_code, queries=stats.count,
+                   db_ms=round(stats.db_seconds * 1000, 1),
+                   total_ms=round((time.perf_counter() - stats.started) * 1000, 1),
+                   n_plus_one=[(_truncate(shape), n) for shape, n in suspects], slow=stats.slow)
+    _recent.append(summary)
+    if suspects:
+        current_app.logger.warning(f"Possible N+1 in {request.endpoint}: "
+                                   + "; ".join(f"{n}x {_truncate(shape)}" for shape, n in suspects))
+    if current_app.debug:
+        response.headers['X-SQL-Queries'] = str(stats.count)
+        response.headers['X-SQL-Time-Ms'] = str(summary['db_ms'])
+        response.headers['X-SQL-Repeated'] = str(sum(n for _, n in suspects))
+    return response
+
+
+def init_app(app):
+    """ Registers the per-request tracking with the app (and the statement timing, the first time it's on). """
+    if not app.config['SQL_INSTRUMENTATION']:
+        return
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    global _recent
+    _recent = deque(_recent, maxlen=app.config['SQL_STATS_BUFFER_SIZE'])
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
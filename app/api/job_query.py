@@ -1,11 +1,20 @@
 import re
+from datetime import datetime
 from typing import Tuple, List
 from itertools import groupby
 
+from sqlalchemy import and_, func, or_
 from werkzeug.datastructures import ImmutableMultiDict
 from werkzeug.urls import url_encode
 
-from app.models import Skill, Attitude, JobPost, WorkTypes, MatchScores
+from app.api.distance import ids_within
+from app.api.loading import with_profile
+from app.api.pagination import SortKeys, order_by_keys
+from app.api.search_cache import cached_ids, cache_ids
+from app.api.search_engine import job_index, use_memory_engine
+from app.api.spatial import radius_filter
+from app.models import Skill, Attitude, JobPost, WorkTypes, MatchScores, CompanyProfile, User, LocationCoordinates, \
+    decode_ids
 
 
 def _compress(indices: List[int], max_size: int) -> str:
@@ -36,11 +45,13 @@ def _compress(indices: List[int], max_size: int) -> str:
     return output
 
 
-def _decompress(cstr, output=None):
+def _decompress(cstr, output=None, width: int = None):
     """
     Decompresses the compressed attribute string to the given output type.
     Default method is to decompress to the list of IDs ("ids")
     Can also pass "int" to have it output as an integer representing the binary form.
+    With a width, the binary form is padded/cut to it first, so strings from before skills/attitudes were
+        added or removed still line up with the current IDs (see `encode_ids`).
     """
     bin_str = ""
     d, ptr, size = cstr[0], 1, 1
@@ -59,8 +70,10 @@ def _decompress(cstr, output=None):
         if size == 2:
             size = 1
             ptr += 1
+    if width is not None:
+        bin_str = bin_str[:width].ljust(width, '0')
     if output == "int":
-        return int(bin_str, base=2)
+        return int(bin_str or '0', base=2)
     return [i + 1 for i, v in enumerate(bin_str) if v == '1']  # add 1 to get ID
 
 
@@ -88,15 +101,15 @@ def job_form_to_url_params(form: ImmutableMultiDict) -> str:
 
     tlist = form.getlist('techs', type=int)
     if tlist:
-        tcmp = _compress(tlist, Skill.count())
+        tcmp = _compress(tlist, Skill.width())
         args['tech'] = tcmp
     blist = form.getlist('bizs', type=int)
     if blist:
-        bcmp = _compress(blist, Skill.count())
+        bcmp = _compress(blist, Skill.width())
         args['biz'] = bcmp
     alist = form.getlist('atts', type=int)
     if alist:
-        acmp = _compress(alist, Attitude.count())
+        acmp = _compress(alist, Attitude.width())
         args['att'] = acmp
 
     return url_encode(args)
@@ -187,77 +200,101 @@ def job_url_args_to_query_args(req_args: ImmutableMultiDict) -> dict:
 
     arg_tech = req_args.get('tech', '')
     if arg_tech:
-        kwargs['tech_skills'] = _decompress(arg_tech, output="int")
+        kwargs['tech_skills'] = _decompress(arg_tech, output="int", width=Skill.width())
     # if arg_tech.isdigit():  # for when arg is an int
     #     kwargs['tech_skills'] = int(arg_tech)
 
     arg_biz = req_args.get('biz', '')
     if arg_biz:
-        kwargs['biz_skills'] = _decompress(arg_biz, output="int")
+        kwargs['biz_skills'] = _decompress(arg_biz, output="int", width=Skill.width())
     # if arg_biz.isdigit():  # for when arg is an int
     #     kwargs['biz_skills'] = int(arg_biz)
 
     arg_att = req_args.get('att', '')
     if arg_att:
-        kwargs['atts'] = _decompress(arg_att, output="int")
+        kwargs['atts'] = _decompress(arg_att, output="int", width=Attitude.width())
     # if arg_att.isdigit():  # for when arg is an int
     #     kwargs['atts'] = int(arg_att)
     return kwargs
 
 
+def _work_type_filter(bin_worktype: int):
+    """
+    Converts a work type mask (full, part, contract, remote) to a filter on the job posts.
+    Only has a few possible work types, so the matching ones can be listed out instead of bit testing each row.
+    """
+    # work type only has the 3 types; shift to make room for remote before checking
+    types = [wt for wt in WorkTypes if (int(wt) << 1) & bin_worktype > 0]
+    clauses = [JobPost.work_type.in_(types)]
+    if WorkTypes.any in types:  # posts without a work type are treated as any
+        clauses.append(JobPost.work_type.is_(None))
+    if bin_worktype & 1:
+        clauses.append(JobPost.is_remote.is_(True))
+    return or_(*clauses)
+
+
+def job_sort_keys(seeker_id: int = None) -> SortKeys:
+    """
+    Gets the order of the job search results (see `pagination.keyset_paginate`):
+        by matching score when a seeker is searching, then by time created, then by ID to break any ties.
+    """
+    keys = [(func.coalesce(JobPost.created_timestamp, datetime.min), True), (JobPost.id, True)]
+    if seeker_id is not None:
+        keys.insert(0, (func.coalesce(MatchScores.score, 0), True))
+    return keys
+
+
 def get_job_query(
         worktype: Tuple[bool, bool, bool, bool] = None,
         sal_range: Tuple[int, int] = None,
         loc_distance: int = None, loc_citystate: Tuple[str, str] = None,
         tech_skills: int = None, biz_skills: int = None, atts: int = None,
-        seeker_id: int = None):
+        seeker_id: int = None, load: str = None):
     """
     Performs a search query on the jobs based on the provided filters.
     If seeker_id is passed results will be sorted by matching score, otherwise by date.
-    Returns a 'query' object that can then be passed to 'paginate'.
+    Returns a 'query' object that can then be passed to 'keyset_paginate' (along with `job_sort_keys`).
+    `load` is the name of a loading profile for the posts' related details (see `api.loading`).
     """
+    filters = dict(worktype=worktype, sal_range=sal_range, loc_distance=loc_distance, loc_citystate=loc_citystate,
+                   tech_skills=tech_skills, biz_skills=biz_skills, atts=atts)
+    ids = cached_ids('job', filters)
+    if ids is not None:
+        q = JobPost.query.filter(JobPost.id.in_(ids))
+    elif use_memory_engine():
+        # the filter stage runs on the in-memory snapshot; SQL only has to fetch and sort the matches
+        ids = job_index.search(**filters)
+        cache_ids('job', filters, ids)
+        q = JobPost.query.filter(JobPost.id.in_(ids))
+    else:
+        # always filter out any non-active jobs, as well as any jobs related to companies who are inactive
+        q = JobPost.query\
+            .join(CompanyProfile, JobPost.company_id == CompanyProfile.id)\
+            .join(User, CompanyProfile.user_id == User.id)\
+            .filter(JobPost.active.is_(True), User.is_active.is_(True))
+
+        if worktype is not None and any(worktype):
+            bin_worktype = sum(v << i for i, v in enumerate(worktype[::-1]))
+            q = q.filter(_work_type_filter(bin_worktype))
+        if sal_range is not None:
+            # accept any that overlap in range.
+            # since salaries may be None, default them to an appropriate extreme
+            q = q.filter(func.coalesce(JobPost.salary_min, 0) <= sal_range[1],
+                         func.coalesce(JobPost.salary_max, 1e9) >= sal_range[0])
+        if tech_skills is not None:
+            q = q.filter(JobPost.tech_skill_ids.overlap(decode_ids(tech_skills, Skill.width())))
+        if biz_skills is not None:
+            q = q.filter(JobPost.biz_skill_ids.overlap(decode_ids(biz_skills, Skill.width())))
+        if atts is not None:
+            q = q.filter(JobPost.attitude_ids.overlap(decode_ids(atts, Attitude.width())))
+        if loc_distance is not None and loc_citystate is not None:
+            # the indexed grid cells around the radius narrow it down first; then only the posts in them are measured
+            q = q.filter(radius_filter(JobPost, LocationCoordinates.get(*loc_citystate), loc_distance))
+            rows = q.with_entities(JobPost.id, JobPost.latitude, JobPost.longitude, JobPost.city, JobPost.state).all()
+            q = q.filter(JobPost.id.in_(ids_within(rows, loc_distance, *loc_citystate)))
+        cache_ids('job', filters, q.with_entities(JobPost.id))
 
-    matches = JobPost.query.all()
-
-    # first, always filter out any non-active jobs
-    matches = filter(lambda m: m.active, matches)
-    # also filter out any jobs related to companies who are inactive
-    matches = filter(lambda m: m._company._user.is_active, matches)
-
-    if worktype is not None and any(worktype):
-        bin_worktype = sum(v << i for i, v in enumerate(worktype[::-1]))
-        # work wanted only has for the 3 types; add in remote before checking for truthiness
-        matches = filter(lambda m: ((m.work_type or WorkTypes.any) << 1 | int(m.is_remote or False)) & bin_worktype > 0, matches)
-    if sal_range is not None:
-        # accept any that overlap in range.
-        # since salaries may be None, default them to an appropriate extreme
-        matches = filter(lambda m: (m.salary_min or 0) <= sal_range[1] and (m.salary_max or 1e9) >= sal_range[0], matches)
-    if loc_distance is not None and loc_citystate is not None:
-        matches = filter(lambda m: m.is_within(loc_distance, *loc_citystate), matches)
-    if tech_skills is not None:
-        matches = filter(lambda m: tech_skills & m.encode_tech_skills() > 0, matches)
-    if biz_skills is not None:
-        matches = filter(lambda m: biz_skills & m.encode_biz_skills() > 0, matches)
-    if atts is not None:
-        matches = filter(lambda m: atts & m.encode_attitudes() > 0, matches)
-    # This is the "right" way to use the filter command if someone knows how to set it up the proper way.
-    # q = q.filter(
-    #     SeekerProfile.work_wanted & bin_worktype > 0,
-    #     SeekerProfile.remote_wanted == remote,
-    #     edu_range[0] <= SeekerProfile.min_edu_level() <= edu_range[1],
-    #     work_range[0] <= SeekerProfile.years_job_experience() <= work_range[1],
-    #     q_dist_func(SeekerProfile),
-    #     tech_skills & SeekerProfile.encode_tech_skills > 0,
-    #     biz_skills & SeekerProfile.encode_biz_skills > 0,
-    #     atts & SeekerProfile.encode_attitudes > 0
-    # )
-
-    match_ids = [m.id for m in matches]
-    q = JobPost.query.filter(JobPost.id.in_(match_ids))
     if seeker_id is not None:  # sort by matching score, then by time created
-        q = q.join(MatchScores, JobPost.id == MatchScores.jobpost_id)\
-            .filter(MatchScores.seeker_id == seeker_id)\
-            .order_by(MatchScores.score.desc(), JobPost.created_timestamp.desc())
-    else:  # fallback to sorting just by time created
-        q = q.order_by(JobPost.created_timestamp.desc())
-    return q
+        # posts without a cached score can't earn any points (see `matchmaker.candidate_posts_for_seeker`)
+        q = q.outerjoin(MatchScores, and_(JobPost.id == MatchScores.jobpost_id, MatchScores.seeker_id == seeker_id))
+    return with_profile(q.order_by(*order_by_keys(job_sort_keys(seeker_id))), JobPost, load)
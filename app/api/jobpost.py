@@ -2,6 +2,7 @@ import traceback
 from typing import Tuple, Union, List
 
 from app import db
+from app.api.search_cache import invalidate_post
 from app.models import JobPost, JobPostSkill, SkillLevels, ImportanceLevel, Skill, JobPostAttitude, Attitude, WorkTypes
 
 
@@ -89,6 +90,7 @@ def new_jobpost(company_id: int, title: str,
             print("<<<< ROLLING BACK! >>>>")
             db.session.rollback()
 
+    invalidate_post(post)
     return post.id
 
 
@@ -179,3 +181,4 @@ def edit_jobpost(post_id: int,
 
     # submit all changes
     db.session.commit()
+    invalidate_post(post)
@@ -0,0 +1,57 @@
+# Named loading profiles: the related rows each kind of page needs, loaded along with the rows being shown.
+# Without them, every card on a page lazily loads its company, skills, etc. one query at a time;
+#   with them, a page runs a fixed number of queries no matter how many results it shows.
+#   'search_card' - the cards on the search and browse pages
+#   'profile_page' - a single seeker, job post or company's page
+#   'export' - everything `to_dict` uses, for the downloads
+from typing import Tuple
+
+from sqlalchemy.orm import joinedload, selectinload
+
+from app.models import JobPost, JobPostSkill, JobPostAttitude, SeekerProfile, SeekerSkill, SeekerAttitude, \
+    CompanyProfile
+
+_SEEKER_DETAILS = (
+    joinedload(SeekerProfile._user),
+    selectinload(SeekerProfile._skills).joinedload(SeekerSkill._skill),
+    selectinload(SeekerProfile._attitudes).joinedload(SeekerAttitude._attitude),
+    selectinload(SeekerProfile._history_edus),
+    selectinload(SeekerProfile._history_jobs)
+)
+_JOB_DETAILS = (
+    joinedload(JobPost._company),
+    selectinload(JobPost._skills).joinedload(JobPostSkill._skill),
+    selectinload(JobPost._attitudes).joinedload(JobPostAttitude._attitude)
+)
+
+LOADING_PROFILES = {
+    'search_card': {
+        JobPost: (joinedload(JobPost._company),),
+        SeekerProfile: _SEEKER_DETAILS,
+        CompanyProfile: (selectinload(CompanyProfile._job_posts),)
+    },
+    'profile_page': {
+        JobPost: _JOB_DETAILS,
+        SeekerProfile: _SEEKER_DETAILS,
+        CompanyProfile: ()
+    },
+    'export': {
+        JobPost: _JOB_DETAILS,
+        SeekerProfile: _SEEKER_DETAILS,
+        CompanyProfile: ()
+    }
+}
+
+
+def loading_options(model, profile: str) -> Tuple:
+    """ Gets the loader options of the named profile for the model, to pass to a query's `options`. """
+    if profile not in LOADING_PROFILES:
+        raise ValueError(f"Unknown loading profile: {profile}")
+    return LOADING_PROFILES[profile][model]
+
+
+def with_profile(query, model, profile: str = None):
+    """ Applies the named loading profile to a query of the model; None leaves it as is. """
+    if profile is None:
+        return query
+    return query.options(*loading_options(model, profile))
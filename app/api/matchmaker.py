@@ -1,30 +1,121 @@
+import heapq
+from typing import Dict, List, Tuple, Set
+
+import numpy as np
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
+
 from app import db
+from app.api.candidates import attribute_index
+from app.api.distance import bands
+from app.api.spatial import cells_within, radius_filter
+from app.models import SeekerProfile, JobPost, CompanyProfile, Skill, Attitude, MatchScores, SeekerSkill, \
+    SeekerAttitude, JobPostSkill, JobPostAttitude, LocationCoordinates, SkillLevels, ImportanceLevel
+
+# Point values
+WITHIN_50_MILES = 25
+WITHIN_100_MILES = 15
+SKILL_HIGH_IMPORTANCE = 7
+SKILL_LOW_IMPORTANCE = 5
+SAME_ATTITUDE = 4
+LOCATION_BANDS = (50, 100)
+LOCATION_POINTS = (WITHIN_50_MILES, WITHIN_100_MILES, 0)  # by index of the first band within (see `distance.bands`)
+
+
+def update_cache(jobpost_id: int = None, seeker_id: int = None, force: bool = False):
+    """
+    Update the database cache for the given job post and/or the seeker
+        (when nothing is passed, everything will be updated)
+    Only pairs that could have changed are rescored: if a post's (or seeker's) score signature is unchanged
+        since its last update, just the pairs missing from the cache are scored.
+    Pass `force` to rescore every pair regardless.
+    """
+    if jobpost_id is not None and seeker_id is not None:
+        upsert_scores({(int(jobpost_id), int(seeker_id)): get_score(jobpost_id, seeker_id, False)})
+    elif jobpost_id is not None:
+        post = JobPost.query.filter_by(id=jobpost_id).first()
+        if post is None:
+            raise ValueError(f"No job post with the ID of {jobpost_id}")
+        _update_post_cache(post, force)
+    elif seeker_id is not None:
+        seeker = SeekerProfile.query.filter_by(id=seeker_id).first()
+        if seeker is None:
+            raise ValueError(f"Seeker with id {seeker_id} could not be found.")
+        _update_seeker_cache(seeker, force)
+    else:
+        for post in JobPost.query.all():
+            _update_post_cache(post, force)
+        for seeker in SeekerProfile.query.all():
+            _update_seeker_cache(seeker, force)
+    db.session.commit()
 
-from app.models import SeekerProfile, JobPost, CompanyProfile, Skill, Attitude, MatchScores
 
+def _update_post_cache(post: JobPost, force: bool):
+    """
+    Rescores the seekers whose score for the given post is missing or out of date.
+    Only candidates (see `candidate_seekers_for_post`) are scored and cached;
+        a missing entry for any other seeker means a score of 0.
+    """
+    signature = post.get_score_signature()
+    candidates = candidate_seekers_for_post(post)
+    if force or signature != post.score_signature:
+        # post itself changed; clear out its old entries and rescore every candidate
+        MatchScores.query.filter_by(jobpost_id=post.id).delete(synchronize_session=False)
+        seeker_ids = candidates
+    else:
+        cached = {sid for (sid,) in db.session.query(MatchScores.seeker_id).filter_by(jobpost_id=post.id)}
+        seeker_ids = candidates - cached
+    if seeker_ids:
+        scores = score_seekers_for_post(post.id, sorted(seeker_ids))
+        upsert_scores({(post.id, sid): score for sid, score in scores.items()})
+    post.score_signature = signature
+
+
+def _update_seeker_cache(seeker: SeekerProfile, force: bool):
+    """
+    Rescores the job posts whose score for the given seeker is missing or out of date.
+    Only candidates (see `candidate_posts_for_seeker`) are scored and cached;
+        a missing entry for any other job post means a score of 0.
+    """
+    signature = seeker.get_score_signature()
+    candidates = candidate_posts_for_seeker(seeker)
+    if force or signature != seeker.score_signature:
+        # seeker itself changed; clear out their old entries and rescore every candidate
+        MatchScores.query.filter_by(seeker_id=seeker.id).delete(synchronize_session=False)
+        jobpost_ids = candidates
+    else:
+        cached = {pid for (pid,) in db.session.query(MatchScores.jobpost_id).filter_by(seeker_id=seeker.id)}
+        jobpost_ids = candidates - cached
+    if jobpost_ids:
+        scores = score_posts_for_seeker(seeker.id, sorted(jobpost_ids))
+        upsert_scores({(pid, seeker.id): score for pid, score in scores.items()})
+    seeker.score_signature = signature
+
+
+def upsert_scores(scores: Dict[Tuple[int, int], float], chunk_size: int = 5000):
+    """
+    Inserts or updates the match score cache, where `scores` maps (job post id, seeker id) pairs to their score.
+    Does not commit.
+    """
+    rows = [{'jobpost_id': pid, 'seeker_id': sid, 'score': score} for (pid, sid), score in scores.items()]
+    for i in range(0, len(rows), chunk_size):
+        stmt = insert(MatchScores).values(rows[i:i + chunk_size])
+        stmt = stmt.on_conflict_do_update(index_elements=[MatchScores.seeker_id, MatchScores.jobpost_id],
+                                          set_={'score': stmt.excluded.score})
+        db.session.execute(stmt)
 
 
-def update_cache(jobpost_id: int = None, seeker_id: int = None):
+def remove_duplicate_scores() -> int:
     """
-    Update the database cache for the given job post and/or the seeker
-        (when nothing is passed, everything will be updated)
+    Deletes all but the newest cache entry for each seeker-job post pair.
+    Needs to be run once on older databases before the unique constraint on `match_scores` can be added.
+    Returns the number of entries removed.
     """
-    posts = JobPost.query
-    if jobpost_id is not None:
-        posts = posts.filter_by(id = jobpost_id)
-    posts = posts.all()
-
-    seekers = SeekerProfile.query
-    if seeker_id is not None:
-        seekers = seekers.filter_by(id=seeker_id)
-    seekers = seekers.all()
-
-    for post in posts:
-        for seeker in seekers:
-            entry = MatchScores(jobpost_id=post.id, seeker_id=seeker.id,
-                                score=get_score(post.id, seeker.id, False))
-            db.session.add(entry)
+    newest = db.session.query(func.max(MatchScores.id))\
+        .group_by(MatchScores.seeker_id, MatchScores.jobpost_id)
+    n = MatchScores.query.filter(MatchScores.id.notin_(newest)).delete(synchronize_session=False)
     db.session.commit()
+    return n
 
 
 def get_score(jobpost_id, seeker_id, from_cache=True):
@@ -43,18 +134,11 @@ def get_score(jobpost_id, seeker_id, from_cache=True):
         entry = MatchScores.query.filter_by(jobpost_id=jobpost_id, seeker_id=seeker_id).first()
         if entry is None:  # not in cache!
             score = get_score(jobpost_id, seeker_id, False)
-            entry = MatchScores(jobpost_id=jobpost_id, seeker_id=seeker_id, score=score)
-            db.session.add(entry)
+            upsert_scores({(jobpost_id, seeker_id): score})
             db.session.commit()
+            return score
         return entry.score
 
-    # Point values
-    WITHIN_50_MILES = 25
-    WITHIN_100_MILES = 15
-    SKILL_HIGH_IMPORTANCE = 7
-    SKILL_LOW_IMPORTANCE = 5
-    SAME_ATTITUDE = 4
-
     post = JobPost.query.filter_by(id=jobpost_id).first()
     if post is None:
         raise ValueError(f"No job post with the ID of {jobpost_id}")
@@ -71,10 +155,9 @@ def get_score(jobpost_id, seeker_id, from_cache=True):
     seeker_points = 0  # initiate seeker points to 0
 
     if post.is_remote is False:
-        if seeker.is_within(50, post.city, post.state):
-            seeker_points += WITHIN_50_MILES
-        elif seeker.is_within(100, post.city, post.state):
-            seeker_points += WITHIN_100_MILES
+        # measured once for both the 50 and 100 mile bands
+        seeker_loc = (seeker.city, seeker.state)
+        seeker_points += _location_points_by_seeker_location(post.city, post.state, [seeker_loc])[seeker_loc]
 
     job_skills = post.get_skills_data()
     seeker_skills = seeker.get_tech_skills_levels() + seeker.get_biz_skills_levels()
@@ -141,25 +224,363 @@ def get_score(jobpost_id, seeker_id, from_cache=True):
 
     return seeker_points
 
-  
+
+##### CANDIDATES #####
+# A pair can only score above 0 if the seeker has one of the post's skills or attitudes,
+#   or if the post isn't remote and the seeker is within 100 miles of it (or hasn't given a location).
+# Everything else is skipped when updating the cache or ranking matches.
+
+def _location_points_for_post(post: JobPost) -> Dict[int, int]:
+    """ Maps the ID of every seeker that earns location points for the given post to those points. """
+    if post.is_remote is not False:
+        return dict()
+    # only the seekers in the grid cells around the post can be close enough
+    rows = db.session.query(SeekerProfile.id, SeekerProfile.city, SeekerProfile.state)\
+        .filter(radius_filter(SeekerProfile, LocationCoordinates.get(post.city, post.state), LOCATION_BANDS[-1]))\
+        .all()
+    points_by_loc = _location_points_by_seeker_location(post.city, post.state,
+                                                        [(city, state) for _, city, state in rows])
+    return {sid: points_by_loc[(city, state)] for sid, city, state in rows if points_by_loc[(city, state)] > 0}
+
+
+def _location_points_for_seeker(seeker: SeekerProfile) -> Dict[int, int]:
+    """ Maps the ID of every job post that the given seeker earns location points for to those points. """
+    rows = db.session.query(JobPost.id, JobPost.city, JobPost.state).filter(JobPost.is_remote.is_(False))
+    if seeker.city or seeker.state:  # otherwise every post earns points
+        # only the posts in the grid cells around the seeker can be close enough
+        rows = rows.filter(radius_filter(JobPost, LocationCoordinates.get(seeker.city, seeker.state),
+                                         LOCATION_BANDS[-1]))
+    rows = rows.all()
+    points_by_loc = _location_points_by_post_location([(city, state) for _, city, state in rows],
+                                                      seeker.city, seeker.state)
+    return {pid: points_by_loc[(city, state)] for pid, city, state in rows if points_by_loc[(city, state)] > 0}
+
+
+def candidate_seekers_for_post(post: JobPost) -> Set[int]:
+    """ Gets the IDs of the seekers that can score above 0 for the given post. """
+    skill_ids = {s.skill_id for s in post._skills}
+    attitude_ids = {a.attitude_id for a in post._attitudes}
+    return attribute_index.seekers_sharing(skill_ids, attitude_ids) | set(_location_points_for_post(post))
+
+
+def candidate_posts_for_seeker(seeker: SeekerProfile) -> Set[int]:
+    """ Gets the IDs of the job posts that the given seeker can score above 0 for. """
+    skill_ids = {s.skill_id for s in seeker._skills}
+    attitude_ids = {a.attitude_id for a in seeker._attitudes}
+    return attribute_index.posts_sharing(skill_ids, attitude_ids) | set(_location_points_for_seeker(seeker))
+
+
+##### BATCH SCORING #####
+# The functions below apply the same point rules as `get_score`, but score one job post against many seekers
+#   (or one seeker against many job posts) at once.
+# All of the needed rows are loaded in a few queries and held in NumPy arrays, so the number of queries
+#   no longer grows with the number of pairs being scored.
+# Points are accumulated in the same order as `get_score` (location, then each skill, then attitudes)
+#   so the float results are identical.
+
+def _location_points_by_seeker_location(post_city, post_state, locations) -> Dict[Tuple[str, str], int]:
+    """
+    Gets the location points of each seeker (city, state) in regards to a non-remote job post.
+    Mirrors the two `SeekerProfile.is_within` calls made by `get_score`, but measures all locations at once.
+    """
+    locations = set(locations)
+    # seekers without a city or a state are always considered within range
+    points = {loc: WITHIN_50_MILES for loc in locations if not loc[0] and not loc[1]}
+    known = [loc for loc in locations if loc not in points]
+    if known:
+        idx = bands(LocationCoordinates.get(post_city, post_state),
+                    [LocationCoordinates.get(*loc) for loc in known], LOCATION_BANDS)
+        points.update((loc, LOCATION_POINTS[i]) for loc, i in zip(known, idx.tolist()))
+    return points
+
+
+def _location_points_by_post_location(locations, seeker_city, seeker_state) -> Dict[Tuple[str, str], int]:
+    """ Same as `_location_points_by_seeker_location`, but for one seeker and the (city, state) of many posts. """
+    locations = set(locations)
+    if not seeker_city and not seeker_state:
+        return {loc: WITHIN_50_MILES for loc in locations}
+    locations = list(locations)
+    idx = bands(LocationCoordinates.get(seeker_city, seeker_state),
+                [LocationCoordinates.get(*loc) for loc in locations], LOCATION_BANDS)
+    return {loc: LOCATION_POINTS[i] for loc, i in zip(locations, idx.tolist())}
+
+
+def _skill_points(seeker_levels: np.ndarray, job_levels: np.ndarray, importances: np.ndarray, has_skill: np.ndarray):
+    """
+    Vectorized version of the skill rules in `get_score`.
+    Each index is a single (seeker skill, job post skill) pairing.
+    Returns a tuple of arrays (base points, bonus points); they should be added in that order
+        to get the same rounding as `get_score`.
+    """
+    diff = seeker_levels - job_levels
+    high = has_skill & (importances > 3)
+    low = has_skill & (importances < 4)
+
+    base = np.zeros(len(diff))
+    base[high & (diff >= 0)] = SKILL_HIGH_IMPORTANCE
+    base[low & (diff >= 0)] = SKILL_LOW_IMPORTANCE
+    base[low & (diff == -1)] = SKILL_LOW_IMPORTANCE / 2
+    base[low & (diff == -2)] = SKILL_LOW_IMPORTANCE / 3
+
+    bonus = np.zeros(len(diff))
+    bonus[high & (diff >= 0)] = diff[high & (diff >= 0)] * 1.5  # bonus multiplier for high importance
+    bonus[low & (diff >= 0)] = diff[low & (diff >= 0)]
+    return base, bonus
+
+
+def score_seekers_for_post(jobpost_id: int, seeker_ids: List[int] = None) -> Dict[int, float]:
+    """
+    Scores the given job post against the given seekers (or every seeker when none are passed).
+    Returns a dictionary mapping each seeker's ID to their score.
+    """
+    jobpost_id = int(jobpost_id)
+    post = JobPost.query.filter_by(id=jobpost_id).first()
+    if post is None:
+        raise ValueError(f"No job post with the ID of {jobpost_id}")
+
+    seekers = db.session.query(SeekerProfile.id, SeekerProfile.city, SeekerProfile.state, SeekerProfile.grid_cell)
+    if seeker_ids is not None:
+        seekers = seekers.filter(SeekerProfile.id.in_([int(i) for i in seeker_ids]))
+    seekers = seekers.order_by(SeekerProfile.id).all()
+    if not seekers:
+        return dict()
+    ids = np.array([s.id for s in seekers], dtype=np.int64)
+    lookup = {sid: i for i, sid in enumerate(ids.tolist())}
+    totals = np.zeros(len(ids))
+
+    # location; each distinct city/state only needs to be measured once,
+    #   and seekers outside the grid cells around the post are too far to measure at all
+    if post.is_remote is False:
+        near = set(cells_within(LocationCoordinates.get(post.city, post.state), LOCATION_BANDS[-1]))
+        locations = [(s.city, s.state) if s.grid_cell is None or s.grid_cell in near else None for s in seekers]
+        points_by_loc = _location_points_by_seeker_location(post.city, post.state,
+                                                            [loc for loc in locations if loc is not None])
+        totals += np.array([points_by_loc[loc] if loc is not None else 0 for loc in locations], dtype=float)
+
+    # skills; build a (seeker x job skill) matrix of the seekers' levels in each required skill
+    job_skills = db.session.query(JobPostSkill.skill_id, JobPostSkill.skill_level_min, JobPostSkill.importance_level)\
+        .filter_by(jobpost_id=jobpost_id)\
+        .order_by(JobPostSkill.id)\
+        .all()
+    if job_skills:
+        columns = dict()  # skill id -> column(s) in the matrix
+        for col, (sid, _, _) in enumerate(job_skills):
+            columns.setdefault(sid, []).append(col)
+        levels = np.full((len(ids), len(job_skills)), np.iinfo(np.int64).max, dtype=np.int64)
+        rows = db.session.query(SeekerSkill.seeker_id, SeekerSkill.skill_id, SeekerSkill.skill_level)\
+            .filter(SeekerSkill.skill_id.in_(list(columns)))\
+            .all()
+        for skr_id, sid, lvl in rows:
+            row = lookup.get(skr_id)
+            if row is None:
+                continue
+            for col in columns[sid]:
+                # duplicated skills keep the lowest level, matching `dict(seeker_skills)` in `get_score`
+                levels[row, col] = min(levels[row, col], int(lvl))
+        has_skill = levels != np.iinfo(np.int64).max
+        levels[~has_skill] = 0
+        for col, (_, job_lvl, importance) in enumerate(job_skills):
+            base, bonus = _skill_points(levels[:, col], np.full(len(ids), int(job_lvl)),
+                                        np.full(len(ids), int(importance)), has_skill[:, col])
+            totals += base
+            totals += bonus
+
+    # attitudes; only the first requirement for each attitude is counted, as in `get_score`
+    job_attitudes = dict()
+    for aid, importance in db.session.query(JobPostAttitude.attitude_id, JobPostAttitude.importance_level)\
+            .filter_by(jobpost_id=jobpost_id)\
+            .order_by(JobPostAttitude.id):
+        job_attitudes.setdefault(aid, int(importance))
+    if job_attitudes:
+        pairs = db.session.query(SeekerAttitude.seeker_id, SeekerAttitude.attitude_id)\
+            .filter(SeekerAttitude.attitude_id.in_(list(job_attitudes)))\
+            .distinct()\
+            .all()
+        pairs = [(lookup[skr_id], aid) for skr_id, aid in pairs if skr_id in lookup]
+        if pairs:
+            rows, aids = zip(*pairs)
+            points = np.array([SAME_ATTITUDE * (job_attitudes[aid] / 2) for aid in aids])
+            np.add.at(totals, np.array(rows), points)
+
+    return dict(zip(ids.tolist(), totals.tolist()))
+
+
+def score_posts_for_seeker(seeker_id: int, jobpost_ids: List[int] = None) -> Dict[int, float]:
+    """
+    Scores the given seeker against the given job posts (or every job post when none are passed).
+    Returns a dictionary mapping each job post's ID to the seeker's score for it.
+    """
+    seeker_id = int(seeker_id)
+    seeker = SeekerProfile.query.filter_by(id=seeker_id).first()
+    if seeker is None:
+        raise ValueError(f"Seeker with id {seeker_id} could not be found.")
+
+    posts = db.session.query(JobPost.id, JobPost.city, JobPost.state, JobPost.is_remote, JobPost.grid_cell)
+    if jobpost_ids is not None:
+        posts = posts.filter(JobPost.id.in_([int(i) for i in jobpost_ids]))
+    posts = posts.order_by(JobPost.id).all()
+    if not posts:
+        return dict()
+    ids = np.array([p.id for p in posts], dtype=np.int64)
+    lookup = {pid: i for i, pid in enumerate(ids.tolist())}
+    totals = np.zeros(len(ids))
+
+    # location; each distinct city/state only needs to be measured once,
+    #   and posts outside the grid cells around the seeker are too far to measure at all
+    near = None
+    if seeker.city or seeker.state:
+        near = set(cells_within(LocationCoordinates.get(seeker.city, seeker.state), LOCATION_BANDS[-1]))
+    locations = []
+    for p in posts:
+        measure = p.is_remote is False and (near is None or p.grid_cell is None or p.grid_cell in near)
+        locations.append((p.city, p.state) if measure else None)
+    points_by_loc = _location_points_by_post_location([loc for loc in locations if loc is not None],
+                                                      seeker.city, seeker.state)
+    totals += np.array([points_by_loc[loc] if loc is not None else 0 for loc in locations], dtype=float)
+
+    # skills; only requirements for skills the seeker has can earn points
+    seeker_levels = dict()
+    for sid, lvl in db.session.query(SeekerSkill.skill_id, SeekerSkill.skill_level).filter_by(seeker_id=seeker_id):
+        seeker_levels[sid] = min(seeker_levels.get(sid, int(lvl)), int(lvl))
+    if seeker_levels:
+        reqs = db.session.query(JobPostSkill.jobpost_id, JobPostSkill.skill_id,
+                                JobPostSkill.skill_level_min, JobPostSkill.importance_level)\
+            .filter(JobPostSkill.skill_id.in_(list(seeker_levels)))\
+            .order_by(JobPostSkill.jobpost_id, JobPostSkill.id)\
+            .all()
+        reqs = [r for r in reqs if r.jobpost_id in lookup]
+        if reqs:
+            rows = np.array([lookup[r.jobpost_id] for r in reqs])
+            base, bonus = _skill_points(np.array([seeker_levels[r.skill_id] for r in reqs]),
+                                        np.array([int(r.skill_level_min) for r in reqs]),
+                                        np.array([int(r.importance_level) for r in reqs]),
+                                        np.ones(len(reqs), dtype=bool))
+            # add each post's requirements one "rank" at a time so every post's points are summed in order
+            starts = np.r_[0, np.flatnonzero(np.diff(rows)) + 1]
+            ranks = np.arange(len(rows)) - np.repeat(starts, np.diff(np.r_[starts, len(rows)]))
+            for rank in range(ranks.max() + 1):
+                sel = ranks == rank
+                totals[rows[sel]] += base[sel]
+                totals[rows[sel]] += bonus[sel]
+
+    # attitudes; only the first requirement for each attitude is counted, as in `get_score`
+    seeker_attitudes = {aid for (aid,) in db.session.query(SeekerAttitude.attitude_id).filter_by(seeker_id=seeker_id)}
+    if seeker_attitudes:
+        reqs = db.session.query(JobPostAttitude.jobpost_id, JobPostAttitude.attitude_id,
+                                JobPostAttitude.importance_level)\
+            .filter(JobPostAttitude.attitude_id.in_(list(seeker_attitudes)))\
+            .order_by(JobPostAttitude.id)\
+            .all()
+        firsts = dict()
+        for pid, aid, importance in reqs:
+            if pid in lookup:
+                firsts.setdefault((pid, aid), int(importance))
+        if firsts:
+            rows = np.array([lookup[pid] for pid, _ in firsts])
+            points = np.array([SAME_ATTITUDE * (importance / 2) for importance in firsts.values()])
+            np.add.at(totals, rows, points)
+
+    return dict(zip(ids.tolist(), totals.tolist()))
+
+
+##### RANKING #####
+# Finding the best matches doesn't require every candidate's score.
+# Each candidate gets a cheap upper bound on its score (from the number of skills and attitudes it shares,
+#   plus its location points), and candidates are then scored in order of that bound.
+# Once the bound falls below the lowest score in the current top K, no remaining candidate can make it in.
+
+MAX_SKILL_POINTS = SKILL_HIGH_IMPORTANCE + (max(SkillLevels) - min(SkillLevels)) * 1.5
+MAX_ATTITUDE_POINTS = SAME_ATTITUDE * (max(ImportanceLevel) / 2)
+
+
+def _top_k(bounds: Dict[int, float], fetch_scores, limit: int, chunk_size: int = 200) -> List[Tuple[int, float]]:
+    """
+    Gets the (up to) `limit` highest scoring candidates with a score above 0, sorted from best to worst.
+    `bounds` maps each candidate's ID to the upper bound of its score.
+    `fetch_scores` is given a list of candidate IDs and returns a dictionary of their actual scores.
+    """
+    ordered = sorted(bounds.items(), key=lambda item: item[1], reverse=True)
+    heap = []  # min-heap of (score, id); heap[0] is the lowest score in the current top K
+    for i in range(0, len(ordered), chunk_size):
+        chunk = ordered[i:i + chunk_size]
+        # drop whatever can't beat the current top K (or can't score above 0)
+        floor = heap[0][0] if len(heap) >= limit else 0
+        chunk = [(_id, bound) for _id, bound in chunk if bound > 0 and bound >= floor]
+        if not chunk:
+            break  # candidates are sorted by bound, so the rest can't make it either
+        scores = fetch_scores([_id for _id, _ in chunk])
+        for _id, _ in chunk:
+            score = scores.get(_id, 0)
+            if score <= 0:
+                continue
+            if len(heap) < limit:
+                heapq.heappush(heap, (score, _id))
+            elif (score, _id) > heap[0]:
+                heapq.heapreplace(heap, (score, _id))
+    return [(_id, score) for score, _id in sorted(heap, reverse=True)]
+
+
+def get_scores_for_seeker(seeker_id: int, jobpost_ids: List[int]) -> Dict[int, float]:
+    """
+    Gets the seeker's scores for the given posts in one query, scoring any that aren't cached yet together.
+    Batch version of `get_score` (e.g., for a page of search results). Nothing is written: the missing scores
+        are only computed here, and are cached by the score worker (see `app.api.tasks`).
+    """
+    seeker_id = int(seeker_id)
+    jobpost_ids = [int(i) for i in jobpost_ids]
+    if not jobpost_ids:
+        return dict()
+    scores = {pid: float(score) for pid, score in db.session.query(MatchScores.jobpost_id, MatchScores.score)
+              .filter(MatchScores.seeker_id == seeker_id, MatchScores.jobpost_id.in_(jobpost_ids))}
+    missing = [pid for pid in jobpost_ids if pid not in scores]
+    if missing:
+        scores.update(score_posts_for_seeker(seeker_id, missing))
+    return scores
+
+
+def get_scores_for_post(jobpost_id: int, seeker_ids: List[int]) -> Dict[int, float]:
+    """
+    Gets the given seekers' scores for the post in one query, scoring any that aren't cached yet together.
+    Batch version of `get_score` (e.g., for a page of search results). Nothing is written: the missing scores
+        are only computed here, and are cached by the score worker (see `app.api.tasks`).
+    """
+    jobpost_id = int(jobpost_id)
+    seeker_ids = [int(i) for i in seeker_ids]
+    if not seeker_ids:
+        return dict()
+    scores = {sid: float(score) for sid, score in db.session.query(MatchScores.seeker_id, MatchScores.score)
+              .filter(MatchScores.jobpost_id == jobpost_id, MatchScores.seeker_id.in_(seeker_ids))}
+    missing = [sid for sid in seeker_ids if sid not in scores]
+    if missing:
+        scores.update(score_seekers_for_post(jobpost_id, missing))
+    return scores
+
+
 def get_jobs_sorted(seeker_id, jobs_list=None, limit=50):
     """
     Get a list of the best matching jobs for a seeker, where each entry contains:
         1. The job id
         2. The score the seeker got for that particular job (used for sorting jobs)
     """
-    if jobs_list is None:
-        jobs_list = [job.id for job in JobPost.query.all()]
-    # maybe pass some options to `get_score` in the following call
-    jobs_by_score = []
-    for job_id in jobs_list:
-        score = get_score(job_id, seeker_id)
-        if score > 0:
-            jobs_by_score.append((job_id, score))
+    seeker_id = int(seeker_id)
+    seeker = SeekerProfile.query.filter_by(id=seeker_id).first()
+    if seeker is None:
+        raise ValueError(f"Seeker with id {seeker_id} could not be found.")
+
+    # only candidates get a bound; everyone else can't score above 0
+    attribute_index.refresh()
+    bounds = _location_points_for_seeker(seeker)
+    for sid in {s.skill_id for s in seeker._skills}:
+        for pid, n in attribute_index.posts_by_skill.get(sid).items():
+            bounds[pid] = bounds.get(pid, 0) + n * MAX_SKILL_POINTS
+    for aid in {a.attitude_id for a in seeker._attitudes}:
+        for pid in attribute_index.posts_by_attitude.get(aid):
+            bounds[pid] = bounds.get(pid, 0) + MAX_ATTITUDE_POINTS
+    if jobs_list is not None:
+        allowed = {int(j) for j in jobs_list}
+        bounds = {pid: bound for pid, bound in bounds.items() if pid in allowed}
 
-    jobs_by_score_sorted = sorted(jobs_by_score, key=lambda tup: tup[1])
-    jobs_by_score_sorted.reverse()
-    return jobs_by_score_sorted[:limit]
+    return _top_k(bounds, lambda ids: get_scores_for_seeker(seeker_id, ids), limit)
 
 
 def get_seekers_sorted(job_id, seeker_list=None, limit=50):
@@ -168,15 +589,22 @@ def get_seekers_sorted(job_id, seeker_list=None, limit=50):
         1. The seeker id
         2. The score that particular seeker got for the given job (used for sorting seekers)
     """
-    if seeker_list is None:
-        seeker_list = [seeker.id for seeker in SeekerProfile.query.all()]
-
-    seekers_by_score = []
-    for seeker_id in seeker_list:
-        score = get_score(job_id, seeker_id)
-        if score > 0:
-            seekers_by_score.append((seeker_id, score))
-
-    seekers_by_score_sorted = sorted(seekers_by_score, key=lambda tup: tup[1])
-    seekers_by_score_sorted.reverse()
-    return seekers_by_score_sorted[:limit]
+    job_id = int(job_id)
+    post = JobPost.query.filter_by(id=job_id).first()
+    if post is None:
+        raise ValueError(f"No job post with the ID of {job_id}")
+
+    # only candidates get a bound; everyone else can't score above 0
+    attribute_index.refresh()
+    bounds = _location_points_for_post(post)
+    for jp_skill in post._skills:
+        for sid in attribute_index.seekers_by_skill.get(jp_skill.skill_id):
+            bounds[sid] = bounds.get(sid, 0) + MAX_SKILL_POINTS
+    for aid in {a.attitude_id for a in post._attitudes}:
+        for sid in attribute_index.seekers_by_attitude.get(aid):
+            bounds[sid] = bounds.get(sid, 0) + MAX_ATTITUDE_POINTS
+    if seeker_list is not None:
+        allowed = {int(s) for s in seeker_list}
+        bounds = {sid: bound for sid, bound in bounds.items() if sid in allowed}
+
+    return _top_k(bounds, lambda ids: get_scores_for_post(job_id, ids), limit)
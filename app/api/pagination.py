@@ -0,0 +1,252 @@
+# Keyset ("seek") pagination for the search and browse pages.
+# Instead of an OFFSET (which has to walk past every earlier row), each page continues from the sort key of the last
+#   row shown, so a deep page costs the same as the first one. The position is passed around as an opaque cursor
+#   (signed, so it can't be tampered with) in the URL's 'cursor' argument.
+# Totals come from a short-lived cache, or from the planner's estimate when that's above `SEARCH_COUNT_EXACT_THRESHOLD`.
+import json
+import math
+import time
+from datetime import datetime
+from decimal import Decimal
+from threading import Lock
+from typing import Optional, Sequence, Tuple
+
+from flask import current_app
+from itsdangerous import BadSignature, URLSafeSerializer
+from sqlalchemy import and_, or_, tuple_
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+from app import db
+from app.api.routing import modify_query
+
+# (sort expression, whether it's descending); the last key must be unique (i.e., the ID) so the order is total
+SortKeys = Sequence[Tuple[object, bool]]
+
+
+def order_by_keys(keys: SortKeys) -> list:
+    """ Converts the sort keys to the arguments for `order_by`. """
+    return [expr.desc() if desc else expr.asc() for expr, desc in keys]
+
+
+def _serializer() -> URLSafeSerializer:
+    return URLSafeSerializer(current_app.config['SECRET_KEY'], salt='search-cursor')
+
+
+def _dump_value(value):
+    # JSON doesn't have these types; tag them so they can be restored exactly
+    if isinstance(value, datetime):
+        return {'t': value.isoformat()}
+    if isinstance(value, Decimal):
+        return {'d': str(value)}
+    return value
+
+
+def _load_value(value):
+    if isinstance(value, dict):
+        if 't' in value:
+            return datetime.fromisoformat(value['t'])
+        return Decimal(value['d'])
+    return value
+
+
+def encode_cursor(values: Sequence, page: int, before: bool = False) -> str:
+    """
+    Encodes a position in the results: the sort key values of the row to continue from, the page number being
+        navigated to, and whether that page comes before the row (when going back) or after it.
+    """
+    return _serializer().dumps([[_dump_value(v) for v in values], page, int(before)])
+
+
+def decode_cursor(token: str, num_keys: int) -> Optional[Tuple[list, int, bool]]:
+    """ Decodes the cursor to its (values, page, before); None if it's invalid or was made for a different sort. """
+    try:
+        values, page, before = _serializer().loads(token)
+        values = [_load_value(v) for v in values]
+    except (BadSignature, ValueError, TypeError, KeyError):
+        return None
+    if len(values) != num_keys or page < 1:
+        return None
+    return values, page, bool(before)
+
+
+def _seek_filter(keys: SortKeys, values: Sequence, before: bool):
+    """ Gets the filter for the rows after (or before) the one with the given key values in the sort order. """
+    descending = [desc for _, desc in keys]
+    exprs = [expr for expr, _ in keys]
+    if all(descending) or not any(descending):
+        # a single row comparison can use a matching index
+        later = (tuple_(*exprs) < tuple_(*values)) if descending[0] != before else (tuple_(*exprs) > tuple_(*values))
+        return later
+    # mixed directions: (a after x) or (a = x and b after y) or ...
+    clauses = []
+    for i, (expr, desc) in enumerate(keys):
+        cmp = expr < values[i] if desc != before else expr > values[i]
+        clauses.append(and_(*[e == v for e, v in zip(exprs[:i], values[:i])], cmp))
+    return or_(*clauses)
+
+
+# TOTALS
+_count_cache = dict()  # statement key -> (expiry, total, exact)
+_count_lock = Lock()
+
+
+class _Explain(Executable, ClauseElement):
+    """
+    `EXPLAIN` of a statement, as a construct (rather than text) so its parameters go through
+        the usual type processing (e.g., enum members are sent as the names their columns store).
+    """
+    inherit_cache = False
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(_Explain)
+def _compile_explain(element, compiler, **kw):
+    return f"EXPLAIN (FORMAT JSON) {compiler.process(element.statement, **kw)}"
+
+
+def _statement(query):
+    return query.order_by(None).enable_eagerloads(False).statement
+
+
+def _cache_key(statement) -> tuple:
+    compiled = statement.compile(dialect=db.engine.dialect, compile_kwargs={"render_postcompile": True})
+    return str(compiled), repr(sorted(compiled.params.items()))
+
+
+def _planner_estimate(statement) -> Optional[int]:
+    """ Gets the number of rows the planner expects the statement to return (without running it). """
+    try:
+        # in a savepoint, so a failure doesn't abort the request's transaction
+        with db.session.begin_nested():
+            plan = db.session.execute(_Explain(statement)).scalar()
+    except Exception:
+        current_app.logger.exception("Could not estimate the search total")
+        return None
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def count_total(query) -> Tuple[int, bool]:
+    """
+    Gets the (total, whether it's exact) number of results for the query.
+    Small results are counted exactly; beyond the `SEARCH_COUNT_EXACT_THRESHOLD` the planner's estimate is used.
+    Either way, it's kept for `SEARCH_COUNT_CACHE_SECONDS` so flipping through the pages doesn't recount.
+    """
+    statement = _statement(query)
+    key = _cache_key(statement)
+    now = time.monotonic()
+    with _count_lock:
+        cached = _count_cache.get(key)
+    if cached is not None and cached[0] > now:
+        return cached[1], cached[2]
+
+    estimate = _planner_estimate(statement)
+    if estimate is None or estimate <= current_app.config['SEARCH_COUNT_EXACT_THRESHOLD']:
+        total, exact = query.order_by(None).enable_eagerloads(False).count(), True
+    else:
+        total, exact = estimate, False
+
+    with _count_lock:
+        # drop anything expired while here so the cache doesn't keep old searches around
+        for k in [k for k, v in _count_cache.items() if v[0] <= now]:
+            del _count_cache[k]
+        _count_cache[key] = (now + current_app.config['SEARCH_COUNT_CACHE_SECONDS'], total, exact)
+    return total, exact
+
+
+class KeysetPage:
+    """
+    One page of results, in the spirit of Flask-SQLAlchemy's `Pagination`,
+        but with cursors to the neighboring pages instead of their offsets.
+    """
+    def __init__(self, items: list, page: int, per_page: int, has_prev: bool, has_next: bool,
+                 prev_cursor: Optional[str], next_cursor: Optional[str], total: int, total_exact: bool):
+        self.items = items
+        self.page = page
+        self.per_page = per_page
+        self.has_prev = has_prev
+        self.has_next = has_next
+        self.prev_cursor = prev_cursor
+        self.next_cursor = next_cursor
+        self.total = total
+        self.total_exact = total_exact
+
+    @property
+    def pages(self) -> int:
+        return max(1, math.ceil(self.total / self.per_page))
+
+    def template_args(self, request) -> dict:
+        """ Gets the arguments the templates' page navigation uses. """
+        # the first page never needs a cursor; dropping it keeps that URL canonical
+        first_url = modify_query(request, cursor=None, page=None)
+        prev_url = "#"
+        if self.has_prev:
+            prev_url = first_url if self.page == 2 else modify_query(request, cursor=self.prev_cursor, page=None)
+        next_url = modify_query(request, cursor=self.next_cursor, page=None) if self.has_next else "#"
+        # only the neighboring pages can be linked to; the others in the window are just shown
+        page_urls = {self.page: modify_query(request)}
+        if self.page > 1:
+            page_urls.update({1: first_url, self.page - 1: prev_url})
+        if self.has_next:
+            page_urls[self.page + 1] = next_url
+
+        # get lower and upper page count for (up to) 5 surrounding pages
+        max_window = min(5, self.pages)
+        pg_lower = pg_upper = self.page
+        while pg_upper - pg_lower + 1 < max_window:
+            pg_lower = max(1, pg_lower - 1)
+            pg_upper = min(self.pages, pg_upper + 1)
+        return dict(total=self.total, total_exact=self.total_exact, page=self.page,
+                    plwr=pg_lower, pupr=pg_upper, page_urls=page_urls,
+                    dprev="" if self.has_prev else "disabled", prev_url=prev_url,
+                    dnext="" if self.has_next else "disabled", next_url=next_url)
+
+
+def keyset_paginate(query, keys: SortKeys, cursor: str = None, per_page: int = None, page: int = 1) -> KeysetPage:
+    """
+    Gets a page of the query's results, sorted by the keys.
+    `cursor` is the token from a previous page's `next_cursor`/`prev_cursor`; without one, it's the first page.
+    `page` is only for links from before cursors existed, and falls back to an offset.
+    """
+    per_page = per_page or current_app.config['RESULTS_PER_PAGE']
+    exprs = [expr for expr, _ in keys]
+    position = decode_cursor(cursor, len(keys)) if cursor else None
+    q = query.order_by(None).add_columns(*exprs)
+
+    before = False
+    if position is not None:
+        values, page, before = position
+        q = q.filter(_seek_filter(keys, values, before))
+    elif page > 1:
+        q = q.offset((page - 1) * per_page)
+    else:
+        page = 1
+
+    # going back reads the rows in reverse from the cursor, then flips them
+    reverse = [(expr, desc != before) for expr, desc in keys]
+    rows = q.order_by(*order_by_keys(reverse)).limit(per_page + 1).all()
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if before:
+        rows.reverse()
+    if not rows and page > 1:  # e.g., the rows after the cursor were removed since
+        return keyset_paginate(query, keys, per_page=per_page)
+
+    has_prev = page > 1
+    has_next = more if not before else True
+    items = [row[0] for row in rows]
+    first_values = list(rows[0][1:]) if rows else []
+    last_values = list(rows[-1][1:]) if rows else []
+    prev_cursor = encode_cursor(first_values, page - 1, before=True) if has_prev and rows else None
+    next_cursor = encode_cursor(last_values, page + 1) if has_next and rows else None
+
+    if not has_next:  # everything up to here is known, so the total is too
+        total, exact = (page - 1) * per_page + len(items), True
+    else:
+        total, exact = count_total(query)
+        total = max(total, page * per_page + 1)  # an estimate (or a stale count) can't be less than what's been seen
+    return KeysetPage(items, page, per_page, has_prev, has_next, prev_cursor, next_cursor, total, exact)
@@ -1,5 +1,7 @@
 from werkzeug.datastructures import ImmutableMultiDict
 
+from app.api.images import prerender, store_picture
+from app.api.search_cache import invalidate_seeker
 from app.api.users import edit_seeker, reset_seeker, update_seeker_skill, add_seeker_attitude, remove_seeker_skill, \
     remove_seeker_attitude, add_seeker_education, add_seeker_job, edit_company
 from app.models import SeekerProfile, WorkTypes, Skill, Attitude, CompanyProfile
@@ -32,10 +34,15 @@ def update_seeker(seeker: SeekerProfile, form: ImmutableMultiDict, files: Immuta
     elif 'reactivate' in form:
         seeker._user.is_active = True
 
+    # a new picture is stored as is, and resized in the background (see `app.api.images`)
+    picture = files.get('profilePicFile')
+    if picture is not None and picture.filename:
+        seeker.picture_hash = store_picture(picture.stream)
+
     # update basic Profile information
     if 'resumeFile' in files:
         file = files['resumeFile']
-        resume = file.read()
+        resume = file.stream if file.filename else None  # no file chosen
     else:
         resume = None
 
@@ -102,6 +109,11 @@ def update_seeker(seeker: SeekerProfile, form: ImmutableMultiDict, files: Immuta
         if key in form:
             add_seeker_job(seeker.id, title, years)
 
+    # the skills, attitudes and history were committed separately; their changes can affect searches too
+    invalidate_seeker(seeker)
+    if picture is not None and picture.filename:
+        prerender(seeker)
+
 # [COMPANY]
 # form = ImmutableMultiDict([('name', 'company'), ('website', ''), ('city', ''), ('state', ''),
 # ('tagline', ''), ('summary', ''), ('submit', '')])
@@ -110,7 +122,16 @@ def update_seeker(seeker: SeekerProfile, form: ImmutableMultiDict, files: Immuta
 #              name=None, city=None, state=None, website=None,
 #              tagline=None, summary=None):
 def update_company(company: CompanyProfile, form: ImmutableMultiDict, files: ImmutableMultiDict):
+    # new pictures are stored as is, and resized in the background (see `app.api.images`)
+    uploaded = False
+    for field, attr in (('logoFile', 'logo_hash'), ('bannerFile', 'banner_hash')):
+        picture = files.get(field)
+        if picture is not None and picture.filename:
+            setattr(company, attr, store_picture(picture.stream))
+            uploaded = True
     edit_company(company.id,
                  name=form.get('name'), city=form.get('city'), state=form.get('state'),
                  website=form.get('website'),
                  tagline=form.get('tagline'), summary=form.get('summary'))
+    if uploaded:
+        prerender(company)
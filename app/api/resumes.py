@@ -0,0 +1,388 @@
+# Storage of seekers' resumes, which live in their own table (`ResumeBlob`) rather than on the profile row.
+# Uploads are copied to a spooled temporary file (in memory up to `RESUME_SPOOL_BYTES`, on disk past that) while
+#   being hashed, then written to the database in one statement (it's bounded by `RESUME_MAX_BYTES`, and
+#   growing a value a chunk at a time would rewrite it each time). Downloads are read back a chunk at a time as
+#   they're sent, with ETags and range requests supported, so a worker never holds a whole resume in memory.
+# Resumes that compress well are stored compressed (see `app.compression`) and decompressed as they're read.
+import hashlib
+import io
+import mimetypes
+from tempfile import SpooledTemporaryFile
+from typing import BinaryIO, Optional, Tuple, Union
+
+from flask import Response, current_app, request
+from sqlalchemy import LargeBinary, Text, exists, func, inspect, literal, select, text, update
+from sqlalchemy.dialects.postgresql import insert
+from werkzeug.wsgi import wrap_file
+
+from app import db
+from app.api.filestore import offload_mode, offload_response, store_file
+from app.compression import TEXT_HEADER, compress_text, compressor, decompressor, default_codec, min_bytes
+from app.models import JobPost, ResumeBlob, SeekerProfile
+
+# a resume is only stored compressed if that makes it at most this much of its size
+COMPRESSED_RATIO = 0.9
+
+
+def _spool(source: Union[bytes, BinaryIO]) -> Tuple[SpooledTemporaryFile, str, int]:
+    """ Copies the upload to a spooled temporary file, getting its SHA-256 and size along the way. """
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    max_bytes = current_app.config['RESUME_MAX_BYTES']
+    chunk_size = current_app.config['RESUME_CHUNK_BYTES']
+    spool = SpooledTemporaryFile(max_size=current_app.config['RESUME_SPOOL_BYTES'])
+    digest, size = hashlib.sha256(), 0
+    for chunk in iter(lambda: source.read(chunk_size), b''):
+        size += len(chunk)
+        if size > max_bytes:
+            spool.close()
+            raise ValueError(f"Resume is larger than the limit of {max_bytes} bytes.")
+        digest.update(chunk)
+        spool.write(chunk)
+    spool.seek(0)
+    return spool, digest.hexdigest(), size
+
+
+def _compressed(spool: SpooledTemporaryFile, size: int) -> Tuple[Optional[SpooledTemporaryFile], Optional[str]]:
+    """
+    Compresses the spooled upload to another spooled file. Returns it and its codec,
+        or None for both if it's too small or doesn't compress well enough to be worth it.
+    """
+    if size < min_bytes():
+        return None, None
+    codec = default_codec()
+    chunk_size = current_app.config['RESUME_CHUNK_BYTES']
+    packed = SpooledTemporaryFile(max_size=current_app.config['RESUME_SPOOL_BYTES'])
+    c = compressor(codec)
+    for chunk in iter(lambda: spool.read(chunk_size), b''):
+        packed.write(c.compress(chunk))
+    packed.write(c.flush())
+    spool.seek(0)
+    if packed.tell() > size * COMPRESSED_RATIO:
+        packed.close()
+        return None, None
+    packed.seek(0)
+    return packed, codec
+
+
+def _write_blob(sha256: str, size: int, codec: Optional[str], source: BinaryIO) -> bool:
+    """
+    Inserts a blob, with its data (read from the spooled file) as a single parameter.
+    Returns False (writing nothing) if it was stored by someone else in the meantime.
+    """
+    stmt = insert(ResumeBlob).values(sha256=sha256, size=size, codec=codec, data=source.read())
+    inserted = db.session.execute(stmt.on_conflict_do_nothing(index_elements=[ResumeBlob.sha256])
+                                  .returning(ResumeBlob.sha256)).scalar()
+    return inserted is not None
+
+
+def store_resume(source: Union[bytes, BinaryIO]) -> Tuple[str, int]:
+    """
+    Stores a resume (its bytes or a file to read them from), unless an identical one already is.
+    Returns its SHA-256 and size. Doesn't commit.
+    """
+    spool, sha256, size = _spool(source)
+    with spool:
+        if db.session.query(exists().where(ResumeBlob.sha256 == sha256)).scalar():
+            return sha256, size
+        packed, codec = _compressed(spool, size)
+        if packed is None:
+            _write_blob(sha256, size, None, spool)
+        else:
+            with packed:
+                _write_blob(sha256, size, codec, packed)
+    return sha256, size
+
+
+def set_resume(seeker: SeekerProfile, source: Union[bytes, BinaryIO]):
+    """ Stores the resume and makes it the seeker's. Doesn't commit. """
+    seeker.resume_hash, seeker.resume_size = store_resume(source)
+
+
+class _CodecChanged(Exception):
+    """ Raised by `ResumeReader` when the blob was rewritten with another codec since it was opened. """
+    def __init__(self, codec: Optional[str]):
+        super().__init__(f"The resume is now stored with the codec {codec}.")
+        self.codec = codec
+
+
+class ResumeReader(io.RawIOBase):
+    """
+    A read-only, seekable file of a blob's data (as stored with the given codec) that fetches just the bytes asked for.
+    It reads on its own connections, so it can still be read once the request's session is gone
+        (i.e., while the response is being sent). Each read checks the codec in the same statement,
+        and raises `_CodecChanged` rather than return bytes of a differently stored copy.
+    """
+    def __init__(self, engine, sha256: str, size: int = None, codec: str = None):
+        super().__init__()
+        self._engine = engine
+        self._sha256 = sha256
+        self._size = size  # None if not known (it's then read until there's nothing left)
+        self._codec = codec
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_END and self._size is None:
+            raise io.UnsupportedOperation("The size of the data isn't known.")
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: self._size}[whence]
+        self._pos = max(0, base + offset)
+        return self._pos
+
+    def readinto(self, buffer):
+        n = len(buffer) if self._size is None else min(len(buffer), self._size - self._pos)
+        if n <= 0:
+            return 0
+        stmt = select(func.substring(ResumeBlob.data, self._pos + 1, n, type_=LargeBinary), ResumeBlob.codec)\
+            .where(ResumeBlob.sha256 == self._sha256)
+        with self._engine.connect() as conn:
+            row = conn.execute(stmt).first()
+        if row is None:
+            return 0
+        if row.codec != self._codec:
+            raise _CodecChanged(row.codec)
+        data = row[0] or b''
+        buffer[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+
+class DecompressingReader(io.RawIOBase):
+    """
+    A read-only file of the decompressed contents of a compressed file.
+    Seeking forward decompresses (and skips) up to there; seeking back starts over from the beginning,
+        which is fine for range requests (e.g., resuming a download), as they mostly go forward.
+    """
+    def __init__(self, raw: BinaryIO, codec: str, size: int, chunk_size: int = io.DEFAULT_BUFFER_SIZE):
+        super().__init__()
+        self._raw = raw
+        self._codec = codec
+        self._size = size
+        self._chunk_size = chunk_size
+        self._pos = 0  # the position asked for
+        self._restart()
+
+    def _restart(self):
+        self._raw.seek(0)
+        self._decompressor = decompressor(self._codec)
+        self._out = 0  # how far it's decompressed up to
+        self._pending = b''  # decompressed, but not read yet
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: self._size}[whence]
+        self._pos = max(0, base + offset)
+        return self._pos
+
+    def _fill(self) -> bool:
+        """ Decompresses the next chunk into the pending bytes. Returns False at the end. """
+        chunk = self._raw.read(self._chunk_size)
+        if not chunk:
+            return False
+        self._pending += self._decompressor.decompress(chunk)
+        return True
+
+    def readinto(self, buffer):
+        if self._pos < self._out:
+            self._restart()
+        while True:
+            skip = min(self._pos - self._out, len(self._pending))
+            self._pending, self._out = self._pending[skip:], self._out + skip
+            if self._out == self._pos and self._pending:
+                break
+            if not self._fill():
+                return 0
+        n = min(len(buffer), len(self._pending))
+        buffer[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        self._out += n
+        self._pos += n
+        return n
+
+
+class ResumeFile(io.RawIOBase):
+    """
+    A read-only, seekable file of a resume's contents (decompressed, if stored compressed).
+    If the blob is rewritten while it's being read (i.e., compressed by `compress_stored`), it carries on
+        from the same position in the new copy, so a download in progress never mixes the two.
+    """
+    def __init__(self, engine, sha256: str, size: int, codec: Optional[str], chunk_size: int):
+        super().__init__()
+        self._engine = engine
+        self._sha256 = sha256
+        self._size = size
+        self._chunk_size = chunk_size
+        self._open(codec)
+
+    def _open(self, codec: Optional[str]):
+        if codec is None:
+            self._raw = ResumeReader(self._engine, self._sha256, self._size)
+        else:
+            self._raw = DecompressingReader(ResumeReader(self._engine, self._sha256, codec=codec), codec, self._size,
+                                            self._chunk_size)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._raw.tell()
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self._raw.seek(offset, whence)
+
+    def readinto(self, buffer):
+        try:
+            return self._raw.readinto(buffer)
+        except _CodecChanged as e:
+            pos = self._raw.tell()  # only moved by reads that succeeded
+            self._open(e.codec)
+            self._raw.seek(pos)
+            return self._raw.readinto(buffer)
+
+
+def open_resume(sha256: str, size: int, codec: Optional[str], buffer_size: int) -> io.BufferedReader:
+    """ Opens a stored resume for reading (decompressed, if stored compressed); see `ResumeFile`. """
+    return io.BufferedReader(ResumeFile(db.engine, sha256, size, codec, buffer_size), buffer_size=buffer_size)
+
+
+def resume_response(seeker: SeekerProfile, filename: str) -> Response:
+    """
+    Sends the seeker's resume as an attachment, `RESUME_CHUNK_BYTES` at a time.
+    Its hash is the ETag, so a repeat download is answered with a 304, and range requests
+        (e.g., a resumed download) only read the bytes asked for.
+    With `FILE_OFFLOAD` set, it's sent by the web server instead (see `app.api.filestore`).
+    """
+    chunk_size = current_app.config['RESUME_CHUNK_BYTES']
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    codec = db.session.query(ResumeBlob.codec).filter(ResumeBlob.sha256 == seeker.resume_hash).scalar()
+    if offload_mode() is not None:
+        # copied to the file store on its first download, then sent by the web server from there
+        with open_resume(seeker.resume_hash, seeker.resume_size, codec, chunk_size) as reader:
+            store_file('resumes', seeker.resume_hash, reader)
+        return offload_response('resumes', seeker.resume_hash, mimetype, filename=filename)
+    reader = open_resume(seeker.resume_hash, seeker.resume_size, codec, chunk_size)
+    rv = Response(wrap_file(request.environ, reader, buffer_size=chunk_size), mimetype=mimetype,
+                  direct_passthrough=True)
+    rv.headers.set('Content-Disposition', 'attachment', filename=filename)
+    rv.content_length = seeker.resume_size
+    rv.set_etag(seeker.resume_hash)
+    # it's only for logged in users, but can be kept as long as it's revalidated
+    rv.cache_control.private = True
+    rv.cache_control.no_cache = True
+    return rv.make_conditional(request, accept_ranges=True, complete_length=seeker.resume_size)
+
+
+def prune_resumes() -> int:
+    """ Deletes the stored resumes no seeker has anymore (e.g., ones replaced since). Returns the number deleted. """
+    n = ResumeBlob.query.filter(~exists().where(SeekerProfile.resume_hash == ResumeBlob.sha256))\
+        .delete(synchronize_session=False)
+    db.session.commit()
+    return n
+
+
+def move_legacy_resumes(batch_size: int = 50) -> int:
+    """
+    Moves the resumes still in the old `seeker_profile.resume` column (from before `ResumeBlob`) to the blob table,
+        clearing the column as it goes. Returns the number moved.
+    """
+    columns = {c['name'] for c in inspect(db.engine).get_columns(SeekerProfile.__tablename__)}
+    if 'resume' not in columns:
+        return 0
+    n = 0
+    while True:
+        rows = db.session.execute(text("SELECT id, resume FROM seeker_profile WHERE resume IS NOT NULL LIMIT :n"),
+                                  dict(n=batch_size)).all()
+        if not rows:
+            break
+        for seeker_id, data in rows:
+            sha256, size = store_resume(bytes(data))
+            db.session.execute(update(SeekerProfile)
+                               .where(SeekerProfile.id == seeker_id)
+                               .values(resume_hash=sha256, resume_size=size)
+                               .execution_options(synchronize_session=False))
+            db.session.execute(text("UPDATE seeker_profile SET resume = NULL WHERE id = :id"), dict(id=seeker_id))
+        db.session.commit()
+        n += len(rows)
+    return n
+
+
+def _compress_resume(sha256: str, size: int) -> bool:
+    """
+    Rewrites an uncompressed blob compressed, if it's worth it. Returns whether it was
+        (False also if it was compressed by someone else in the meantime).
+    The whole value is replaced in one statement, which only matches while the blob is still uncompressed;
+        downloads already reading it switch over to the compressed copy (see `ResumeFile`).
+    """
+    chunk_size = current_app.config['RESUME_CHUNK_BYTES']
+    spool = SpooledTemporaryFile(max_size=current_app.config['RESUME_SPOOL_BYTES'])
+    with spool, open_resume(sha256, size, None, chunk_size) as reader:
+        for chunk in iter(lambda: reader.read(chunk_size), b''):
+            spool.write(chunk)
+        spool.seek(0)
+        packed, codec = _compressed(spool, size)
+        if packed is None:
+            return False
+        with packed:
+            updated = db.session.execute(update(ResumeBlob)
+                                         .where(ResumeBlob.sha256 == sha256, ResumeBlob.codec.is_(None))
+                                         .values(codec=codec, data=packed.read())
+                                         .execution_options(synchronize_session=False)).rowcount
+    return updated == 1
+
+
+def compress_stored(batch_size: int = 200) -> dict:
+    """
+    Compresses the stored values from before compression was added (or from when it was below the thresholds):
+        the resumes, job post descriptions and seeker summaries. Commits after each batch, so it can be stopped
+        and rerun. Returns the number of each that were compressed.
+    """
+    counts = dict(resumes=0, descriptions=0, summaries=0)
+    for sha256, size in db.session.query(ResumeBlob.sha256, ResumeBlob.size)\
+            .filter(ResumeBlob.codec.is_(None), ResumeBlob.size >= min_bytes()).all():
+        if _compress_resume(sha256, size):
+            counts['resumes'] += 1
+            db.session.commit()
+
+    for key, model, column in (('descriptions', JobPost, JobPost.description),
+                               ('summaries', SeekerProfile, SeekerProfile.summary)):
+        last_id = 0
+        while True:
+            # compared as plain text, so the header isn't taken for a value to compress
+            rows = db.session.query(model.id, column)\
+                .filter(model.id > last_id, func.length(column) >= min_bytes(),
+                        func.substr(column, 1, 1) != literal(TEXT_HEADER, Text))\
+                .order_by(model.id)\
+                .limit(batch_size)\
+                .all()
+            if not rows:
+                break
+            for row_id, value in rows:
+                if compress_text(value) != value:
+                    # keeps the updated timestamp, as nothing searchable changed
+                    db.session.execute(update(model)
+                                       .where(model.id == row_id)
+                                       .values({column: value, model.updated_timestamp: model.updated_timestamp})
+                                       .execution_options(synchronize_session=False))
+                    counts[key] += 1
+            db.session.commit()
+            last_id = rows[-1][0]
+    return counts
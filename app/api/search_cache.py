@@ -0,0 +1,232 @@
+# A cache of search results (the IDs matching a set of filters), shared by everyone running the same search.
+# The search URLs come from a small set of common selections, so the same filters get run over and over;
+#   the filters are put into a canonical form so that equivalent URLs share an entry.
+# Entries expire after `SEARCH_CACHE_TTL_SECONDS`, the least recently used are evicted past `SEARCH_CACHE_SIZE`,
+#   and writes to a job post or seeker only drop the entries whose results it could change (see `_join_tags`).
+# (De)activating an account changes whether its seeker profile or company's job posts are found at all, so that
+#   drops their entries too, once committed (see `_collect_account_changes`).
+# The cache is per process, so with several workers a write elsewhere can take up to the TTL to show.
+import time
+from collections import OrderedDict
+from itertools import chain
+from threading import Lock
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
+
+from flask import current_app, jsonify, flash, redirect, url_for
+from flask_login import current_user, login_required
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Query, Session
+
+from app.api import bp
+from app.api.spatial import MAX_FILTER_CELLS, cells_within
+from app.models import AccountTypes, CompanyProfile, JobPost, SeekerProfile, User, LocationCoordinates, Skill, \
+    Attitude, decode_ids
+
+CacheKey = Tuple[str, tuple]
+
+
+def _canonical(value):
+    """ Normalizes a filter value so equivalent ones compare (and hash) the same. """
+    if isinstance(value, (list, tuple)):
+        return tuple(_canonical(v) for v in value)
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, str):
+        return value.strip().lower()
+    return value
+
+
+def canonical_filters(filters: dict) -> tuple:
+    """
+    Gets the canonical form of the search filters (the keyword arguments of `get_job_query`/`get_seeker_query`):
+        unset or no-op filters are dropped, and the rest are normalized and sorted.
+    """
+    filters = {k: v for k, v in filters.items() if v is not None}
+    if not any(filters.get('worktype') or ()):  # nothing checked doesn't filter anything
+        filters.pop('worktype', None)
+    if 'loc_distance' not in filters or 'loc_citystate' not in filters:
+        filters.pop('loc_distance', None)
+        filters.pop('loc_citystate', None)
+    return tuple(sorted((k, _canonical(v)) for k, v in filters.items()))
+
+
+def _join_tags(kind: str, filters: dict) -> Set[str]:
+    """
+    Gets the tags that a row which newly matches the filters has to have (see `write_tags`).
+    A row has to match every filter to be included, so it's enough to pick one of them:
+        the grid cells around a location, otherwise the IDs of one of the attribute filters.
+    Without either, any write of that kind could change the results.
+    """
+    if filters.get('loc_distance') is not None and filters.get('loc_citystate') is not None:
+        cells = cells_within(LocationCoordinates.get(*filters['loc_citystate']), filters['loc_distance'])
+        if len(cells) <= MAX_FILTER_CELLS:
+            # rows without a cell are measured by their city/state, so any of them could be within
+            return {f"{kind}:cell:{c}" for c in cells} | {f"{kind}:cell:none"}
+    for name, ids_name, width in (('tech_skills', 'tech', Skill.width()), ('biz_skills', 'biz', Skill.width()),
+                                  ('atts', 'att', Attitude.width())):
+        if filters.get(name) is not None:
+            return {f"{kind}:{ids_name}:{i}" for i in decode_ids(filters[name], width)}
+    return {f"{kind}:any"}
+
+
+def write_tags(kind: str, row) -> Set[str]:
+    """
+    Gets the tags of the entries that a write to the job post/seeker (`kind` of 'job'/'seeker') could affect:
+        the ones it's already in, and the ones it might now match.
+    """
+    tags = {f"{kind}:id:{row.id}", f"{kind}:any", f"{kind}:cell:{'none' if row.grid_cell is None else row.grid_cell}"}
+    for ids_name, ids in (('tech', row.tech_skill_ids), ('biz', row.biz_skill_ids), ('att', row.attitude_ids)):
+        tags.update(f"{kind}:{ids_name}:{i}" for i in ids or [])
+    return tags
+
+
+class SearchCache:
+    """
+    A TTL + LRU cache of search result IDs, with each entry tagged so writes can drop just the related ones.
+    """
+    def __init__(self):
+        self._entries = OrderedDict()  # key -> (expiry, ids, tags)
+        self._by_tag = dict()  # type: Dict[str, Set[CacheKey]]
+        self._lock = Lock()
+        self.hits = self.misses = self.evictions = self.expirations = self.invalidations = 0
+
+    @staticmethod
+    def enabled() -> bool:
+        return current_app.config['SEARCH_CACHE_SIZE'] > 0
+
+    def _remove(self, key: CacheKey):
+        _, _, tags = self._entries.pop(key)
+        for tag in tags:
+            keys = self._by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_tag[tag]
+
+    def get(self, kind: str, filters: dict) -> Optional[List[int]]:
+        """ Gets the cached IDs for the search, or None if they aren't cached. """
+        key = (kind, canonical_filters(filters))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return list(entry[1])
+
+    def put(self, kind: str, filters: dict, ids: Iterable[int]):
+        """ Caches the IDs for the search; skipped when there are more than `SEARCH_CACHE_MAX_IDS`. """
+        ids = tuple(sorted(ids))
+        if len(ids) > current_app.config['SEARCH_CACHE_MAX_IDS']:
+            return
+        key = (kind, canonical_filters(filters))
+        tags = {f"{kind}:id:{i}" for i in ids} | _join_tags(kind, filters)
+        expiry = time.monotonic() + current_app.config['SEARCH_CACHE_TTL_SECONDS']
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (expiry, ids, tags)
+            for tag in tags:
+                self._by_tag.setdefault(tag, set()).add(key)
+            while len(self._entries) > current_app.config['SEARCH_CACHE_SIZE']:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, tags: Iterable[str]) -> int:
+        """ Drops the entries with any of the tags. Returns the number dropped. """
+        with self._lock:
+            keys = set()
+            for tag in tags:
+                keys |= self._by_tag.get(tag, set())
+            for key in keys:
+                self._remove(key)
+            self.invalidations += len(keys)
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_tag.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return dict(entries=len(self._entries), hits=self.hits, misses=self.misses,
+                        hit_rate=self.hits / lookups if lookups else 0.0,
+                        evictions=self.evictions, expirations=self.expirations, invalidations=self.invalidations)
+
+
+search_cache = SearchCache()
+
+
+def cached_ids(kind: str, filters: dict) -> Optional[List[int]]:
+    """ Gets the cached results of a search, if caching is enabled and they're cached. """
+    if not search_cache.enabled() or not canonical_filters(filters):
+        return None
+    return search_cache.get(kind, filters)
+
+
+def cache_ids(kind: str, filters: dict, ids: Union[Iterable[int], Query]):
+    """
+    Caches the results of a search, if caching is enabled.
+    `ids` can also be a query of just the ID column, which is only run when it's going to be cached.
+    """
+    if not search_cache.enabled() or not canonical_filters(filters):
+        return
+    if isinstance(ids, Query):
+        ids = [_id for _id, in ids.limit(current_app.config['SEARCH_CACHE_MAX_IDS'] + 1)]
+    search_cache.put(kind, filters, ids)
+
+
+def invalidate_post(post: JobPost):
+    """ Drops the cached job searches that a change to the post could affect. Call after committing it. """
+    search_cache.invalidate(write_tags('job', post))
+
+
+def invalidate_seeker(seeker: SeekerProfile):
+    """ Drops the cached seeker searches that a change to the seeker could affect. Call after committing it. """
+    search_cache.invalidate(write_tags('seeker', seeker))
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_account_changes(session, flush_context):
+    """ Notes the entries to drop for the seekers and job posts of accounts that were (de)activated. """
+    user_ids = {obj.id for obj in chain(session.new, session.dirty)
+                if isinstance(obj, User) and inspect(obj).attrs.is_active.history.has_changes()}
+    if not user_ids:
+        return
+    tags = session.info.setdefault('search_cache_tags', set())
+    columns = ('id', 'grid_cell', 'tech_skill_ids', 'biz_skill_ids', 'attitude_ids')
+    for kind, model, condition in (
+            ('seeker', SeekerProfile, SeekerProfile.user_id.in_(user_ids)),
+            ('job', JobPost, JobPost.company_id.in_(select(CompanyProfile.id)
+                                                    .where(CompanyProfile.user_id.in_(user_ids))))):
+        for row in session.execute(select(*(getattr(model, c) for c in columns)).where(condition)):
+            tags |= write_tags(kind, row)
+
+
+@event.listens_for(Session, 'after_commit')
+def _drop_account_changes(session):
+    tags = session.info.pop('search_cache_tags', None)
+    if tags:
+        search_cache.invalidate(tags)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_account_changes(session, previous_transaction):
+    session.info.pop('search_cache_tags', None)
+
+
+@bp.route('/search-cache')
+@login_required
+def search_cache_endpoint():
+    """ Hit/miss counts and size of the search result cache. """
+    if current_user.account_type != AccountTypes.a:
+        flash(f"Operation not allowed.")
+        return redirect(url_for('main.index'))
+    return jsonify(search_cache.stats())
@@ -0,0 +1,293 @@
+# An optional in-memory search engine for the job and seeker filters.
+# Holds a columnar (NumPy) snapshot of the searchable details of every job post and seeker,
+#   so the filter stage of a search doesn't need to touch the database.
+# Enabled with `SEARCH_ENGINE = 'memory'` in the config; `get_job_query`/`get_seeker_query` then only
+#   use SQL to fetch and sort the matching IDs.
+import time
+from threading import Lock
+from typing import Dict, List, Tuple
+
+import numpy as np
+from flask import current_app
+from sqlalchemy import or_, text
+
+from app import db
+from app.api.distance import within
+from app.models import JobPost, SeekerProfile, CompanyProfile, User, LocationCoordinates, Skill, Attitude, \
+    decode_ids
+
+NO_SALARY_MAX = 1e9  # same extreme as the SQL filter
+
+
+def _pack(ids: List[int], n_words: int) -> np.ndarray:
+    """ Packs a list of attribute IDs into a bitset of 64-bit words (the ID `i` is bit `i - 1`). """
+    words = np.zeros(n_words, dtype=np.uint64)
+    for _id in ids or []:
+        word, bit = divmod(_id - 1, 64)
+        if word < n_words:
+            words[word] |= np.uint64(1) << np.uint64(bit)
+    return words
+
+
+def _n_words(width: int) -> int:
+    return max(1, (width + 63) // 64)
+
+
+def _work_type_mask(work_types: np.ndarray, remotes: np.ndarray, worktype: Tuple[bool, ...]) -> np.ndarray:
+    """
+    Vectorized version of the work type filters in `job_query`/`seeker_query`.
+    Rows without a work type are stored as `WorkTypes.any`, which matches any of the 3 types.
+    """
+    bin_worktype = sum(v << i for i, v in enumerate(worktype[::-1]))
+    # work type only has the 3 types; shift to make room for remote before checking
+    mask = ((work_types.astype(np.int64) << 1) & bin_worktype) > 0
+    if bin_worktype & 1:
+        mask |= remotes
+    return mask
+
+
+def _changed_since(table: str, watermark: int):
+    """
+    Checks whether a row of the table was written by a transaction at or after the watermark (see `refresh`).
+    `xmin` is the 32-bit ID of the transaction that wrote the row, so it's compared the way Postgres does,
+        modulo 2^32 (very old rows may look new again after wraparound, which only means they're re-read).
+    """
+    return text(f'(("{table}".xmin::text::bigint - {watermark % 2 ** 32} + 4294967296) % 4294967296) < 2147483648')
+
+
+class _ColumnarIndex:
+    """
+    A snapshot of one table as NumPy columns, with one row per ID.
+    Subclasses define the query to load rows and how to turn them into column values.
+    Refreshes are incremental: only rows written by transactions that hadn't finished at the last refresh are re-read.
+    """
+    model = None
+    tables = ()  # tables whose changes are picked up by a refresh
+    columns = ()  # names of the scalar columns
+    bitsets = ()  # names of the attribute ID columns, stored as packed bitsets
+
+    def __init__(self):
+        self.rows = dict()  # type: Dict[int, int]
+        self.data = {'id': np.zeros(0, dtype=np.int64)}  # type: Dict[str, np.ndarray]
+        self.locations = [None]  # (lat, lng) per location code; code 0 is 'no location' (always within)
+        self.location_codes = dict()  # type: Dict[Tuple[float, float], int]
+        self.watermark = None
+        self._checked_at = None
+        self._lock = Lock()
+
+    def _query(self):
+        raise NotImplementedError
+
+    def _values(self, row) -> dict:
+        """ Converts a row from `_query` to a dictionary of column values (attribute columns as lists of IDs). """
+        raise NotImplementedError
+
+    def _location_code(self, latitude: float, longitude: float) -> int:
+        """ Gets the code of the row's stored coordinates (set when the row is saved, so nothing is looked up). """
+        if latitude is None or longitude is None:
+            return 0
+        key = (latitude, longitude)
+        if key not in self.location_codes:
+            self.location_codes[key] = len(self.locations)
+            self.locations.append(key)
+        return self.location_codes[key]
+
+    def refresh(self, force: bool = False):
+        """
+        Loads the rows changed since the last refresh.
+        Checks the database at most once every `SEARCH_ENGINE_REFRESH_SECONDS`, unless forced.
+        Changes are found by commit order rather than by timestamp (a row's timestamp is set when it's flushed,
+            so a transaction committing late could be missed): the watermark is the oldest transaction still
+            running when the last refresh started, and every row written by it or a later one is re-read.
+        """
+        now = time.monotonic()
+        if not force and self._checked_at is not None \
+                and now - self._checked_at < current_app.config['SEARCH_ENGINE_REFRESH_SECONDS']:
+            return
+        with self._lock:
+            # read first, so anything committed before it is seen by the query below
+            watermark = db.session.execute(text("SELECT txid_snapshot_xmin(txid_current_snapshot())")).scalar()
+            q = self._query()
+            if self.watermark is not None:
+                q = q.filter(or_(*(_changed_since(table, self.watermark) for table in self.tables)))
+            rows = q.all()
+            self._checked_at = now
+            if rows:
+                self._apply([self._values(row) for row in rows])
+            self.watermark = watermark
+
+    def _apply(self, values: List[dict]):
+        """
+        Writes the given rows into a copy of the columns, then swaps the copy in,
+            so searches running at the same time always see a complete snapshot.
+        """
+        n_words = {name: max(_n_words(max(v[name] or [0])) for v in values) for name in self.bitsets}
+        data = dict()
+        for name in self.bitsets:
+            old = self.data.get(name, np.zeros((0, 1), dtype=np.uint64))
+            n_words[name] = max(n_words[name], old.shape[1])
+            data[name] = np.zeros((len(old), n_words[name]), dtype=np.uint64)
+            data[name][:, :old.shape[1]] = old
+        for name in self.columns:
+            data[name] = self.data[name].copy() if name in self.data else None
+
+        ids = self.data['id']
+        rows = dict(self.rows)
+        new_ids = [v['id'] for v in values if v['id'] not in rows]
+        if new_ids:
+            start = len(ids)
+            ids = np.concatenate([ids, np.array(new_ids, dtype=np.int64)])
+            for i, _id in enumerate(new_ids):
+                rows[_id] = start + i
+            for name in self.bitsets:
+                data[name] = np.vstack([data[name], np.zeros((len(new_ids), n_words[name]), dtype=np.uint64)])
+
+        for name in self.columns:
+            sample = np.asarray([v[name] for v in values])
+            if data[name] is None:
+                data[name] = np.zeros(len(ids), dtype=sample.dtype)
+            elif len(data[name]) < len(ids):
+                data[name] = np.concatenate([data[name], np.zeros(len(ids) - len(data[name]), dtype=data[name].dtype)])
+            data[name][[rows[v['id']] for v in values]] = sample
+        for name in self.bitsets:
+            for v in values:
+                data[name][rows[v['id']]] = _pack(v[name], n_words[name])
+
+        data['id'] = ids
+        self.rows, self.data = rows, data
+
+    @staticmethod
+    def _overlaps(bits: np.ndarray, mask: int, width: int) -> np.ndarray:
+        """ Checks which rows have at least one of the attributes in the mask (see `encode_ids`). """
+        query = _pack(decode_ids(mask, width), bits.shape[1])
+        return (bits & query).any(axis=1)
+
+    def _within(self, locations: np.ndarray, distance: int, city: str, state: str) -> np.ndarray:
+        """ Checks which rows are within the distance; each distinct location is only measured once. """
+        measured = within(LocationCoordinates.get(city, state), self.locations[1:], distance)
+        return np.concatenate([[True], measured])[locations]
+
+    def _attribute_mask(self, d: Dict[str, np.ndarray], tech_skills: int, biz_skills: int, atts: int) -> np.ndarray:
+        mask = d['visible'].copy()
+        if tech_skills is not None:
+            mask &= self._overlaps(d['tech_skill_ids'], tech_skills, Skill.width())
+        if biz_skills is not None:
+            mask &= self._overlaps(d['biz_skill_ids'], biz_skills, Skill.width())
+        if atts is not None:
+            mask &= self._overlaps(d['attitude_ids'], atts, Attitude.width())
+        return mask
+
+
+class JobIndex(_ColumnarIndex):
+    model = JobPost
+    tables = (JobPost.__tablename__, User.__tablename__)
+    columns = ('visible', 'created', 'work_type', 'is_remote', 'salary_min', 'salary_max', 'location')
+    bitsets = ('tech_skill_ids', 'biz_skill_ids', 'attitude_ids')
+
+    def _query(self):
+        return db.session.query(JobPost.id, JobPost.active, User.is_active,
+                                JobPost.created_timestamp, JobPost.work_type, JobPost.is_remote,
+                                JobPost.salary_min, JobPost.salary_max, JobPost.latitude, JobPost.longitude,
+                                JobPost.tech_skill_ids, JobPost.biz_skill_ids, JobPost.attitude_ids)\
+            .join(CompanyProfile, JobPost.company_id == CompanyProfile.id)\
+            .join(User, CompanyProfile.user_id == User.id)
+
+    def _values(self, row) -> dict:
+        return {
+            'id': row.id,
+            'visible': bool(row.active) and bool(row.is_active),
+            'created': row.created_timestamp.timestamp() if row.created_timestamp else 0.0,
+            'work_type': int(row.work_type) if row.work_type is not None else 7,  # None is treated as any
+            'is_remote': bool(row.is_remote),
+            'salary_min': float(row.salary_min) if row.salary_min is not None else 0.0,
+            'salary_max': float(row.salary_max) if row.salary_max is not None else NO_SALARY_MAX,
+            'location': self._location_code(row.latitude, row.longitude),
+            'tech_skill_ids': row.tech_skill_ids,
+            'biz_skill_ids': row.biz_skill_ids,
+            'attitude_ids': row.attitude_ids
+        }
+
+    def search(self, worktype: Tuple[bool, bool, bool, bool] = None,
+               sal_range: Tuple[int, int] = None,
+               loc_distance: int = None, loc_citystate: Tuple[str, str] = None,
+               tech_skills: int = None, biz_skills: int = None, atts: int = None,
+               **_) -> List[int]:
+        """
+        Gets the IDs of the active job posts matching the filters (same arguments as `get_job_query`),
+            newest first.
+        """
+        self.refresh()
+        d = self.data  # the whole snapshot is swapped at once by `refresh`, so only read it once
+        if not len(d['id']):
+            return []
+        mask = self._attribute_mask(d, tech_skills, biz_skills, atts)
+        if worktype is not None and any(worktype):
+            mask &= _work_type_mask(d['work_type'], d['is_remote'], worktype)
+        if sal_range is not None:
+            mask &= (d['salary_min'] <= sal_range[1]) & (d['salary_max'] >= sal_range[0])
+        if loc_distance is not None and loc_citystate is not None:
+            mask &= self._within(d['location'], loc_distance, *loc_citystate)
+        idx = np.flatnonzero(mask)
+        idx = idx[np.argsort(-d['created'][idx], kind='stable')]
+        return d['id'][idx].tolist()
+
+
+class SeekerIndex(_ColumnarIndex):
+    model = SeekerProfile
+    tables = (SeekerProfile.__tablename__, User.__tablename__)
+    columns = ('visible', 'work_wanted', 'remote_wanted', 'min_edu_level', 'years_job_experience', 'location')
+    bitsets = ('tech_skill_ids', 'biz_skill_ids', 'attitude_ids')
+
+    def _query(self):
+        return db.session.query(SeekerProfile.id, User.is_active,
+                                SeekerProfile.work_wanted, SeekerProfile.remote_wanted,
+                                SeekerProfile.min_edu_level.label('min_edu_level'),
+                                SeekerProfile.years_job_experience.label('years_job_experience'),
+                                SeekerProfile.latitude, SeekerProfile.longitude,
+                                SeekerProfile.tech_skill_ids, SeekerProfile.biz_skill_ids, SeekerProfile.attitude_ids)\
+            .join(User, SeekerProfile.user_id == User.id)
+
+    def _values(self, row) -> dict:
+        return {
+            'id': row.id,
+            'visible': bool(row.is_active),
+            'work_wanted': int(row.work_wanted) if row.work_wanted is not None else 7,  # None is treated as any
+            'remote_wanted': bool(row.remote_wanted),
+            'min_edu_level': int(row.min_edu_level or 0),
+            'years_job_experience': float(row.years_job_experience or 0),
+            'location': self._location_code(row.latitude, row.longitude),
+            'tech_skill_ids': row.tech_skill_ids,
+            'biz_skill_ids': row.biz_skill_ids,
+            'attitude_ids': row.attitude_ids
+        }
+
+    def search(self, worktype: Tuple[bool, bool, bool, bool] = None,
+               edu_range: Tuple[int, int] = None, work_range: Tuple[int, int] = None,
+               loc_distance: int = None, loc_citystate: Tuple[str, str] = None,
+               tech_skills: int = None, biz_skills: int = None, atts: int = None,
+               **_) -> List[int]:
+        """ Gets the IDs of the active seekers matching the filters (same arguments as `get_seeker_query`). """
+        self.refresh()
+        d = self.data  # the whole snapshot is swapped at once by `refresh`, so only read it once
+        if not len(d['id']):
+            return []
+        mask = self._attribute_mask(d, tech_skills, biz_skills, atts)
+        if worktype is not None and any(worktype):
+            mask &= _work_type_mask(d['work_wanted'], d['remote_wanted'], worktype)
+        if edu_range is not None:
+            mask &= (d['min_edu_level'] >= edu_range[0]) & (d['min_edu_level'] <= edu_range[1])
+        if work_range is not None:
+            mask &= (d['years_job_experience'] >= work_range[0]) & (d['years_job_experience'] <= work_range[1])
+        if loc_distance is not None and loc_citystate is not None:
+            mask &= self._within(d['location'], loc_distance, *loc_citystate)
+        idx = np.flatnonzero(mask)
+        return np.sort(d['id'][idx]).tolist()
+
+
+job_index = JobIndex()
+seeker_index = SeekerIndex()
+
+
+def use_memory_engine() -> bool:
+    """ Whether the searches should filter with this engine instead of SQL. """
+    return current_app.config['SEARCH_ENGINE'] == 'memory'
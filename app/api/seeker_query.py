@@ -2,10 +2,18 @@ import re
 from typing import Tuple, List
 from itertools import groupby
 
+from sqlalchemy import and_, func, or_
 from werkzeug.datastructures import ImmutableMultiDict
 from werkzeug.urls import url_encode, url_decode
 
-from app.models import SeekerProfile, Skill, Attitude, MatchScores
+from app.api.distance import ids_within
+from app.api.loading import with_profile
+from app.api.pagination import SortKeys, order_by_keys
+from app.api.search_cache import cached_ids, cache_ids
+from app.api.search_engine import seeker_index, use_memory_engine
+from app.api.spatial import radius_filter
+from app.models import SeekerProfile, Skill, Attitude, MatchScores, User, WorkTypes, LocationCoordinates, \
+    decode_ids
 
 
 def _compress(indices: List[int], max_size: int) -> str:
@@ -36,11 +44,13 @@ def _compress(indices: List[int], max_size: int) -> str:
     return output
 
 
-def _decompress(cstr, output=None):
+def _decompress(cstr, output=None, width: int = None):
     """
     Decompresses the compressed attribute string to the given output type.
     Default method is to decompress to the list of IDs ("ids")
     Can also pass "int" to have it output as an integer representing the binary form.
+    With a width, the binary form is padded/cut to it first, so strings from before skills/attitudes were
+        added or removed still line up with the current IDs (see `encode_ids`).
     """
     bin_str = ""
     d, ptr, size = cstr[0], 1, 1
@@ -59,8 +69,10 @@ def _decompress(cstr, output=None):
         if size == 2:
             size = 1
             ptr += 1
+    if width is not None:
+        bin_str = bin_str[:width].ljust(width, '0')
     if output == "int":
-        return int(bin_str, base=2)
+        return int(bin_str or '0', base=2)
     return [i + 1 for i, v in enumerate(bin_str) if v == '1']  # add 1 to get ID
 
 
@@ -89,6 +101,8 @@ def seeker_form_to_url_params(form: ImmutableMultiDict, existing_query_str: str
         if existing_query_str is not None and len(form) == 1:  # only want this to fire when POSTing from job select field
             existing_args = url_decode(existing_query_str)  # remove job select/sort by so it doesn't override
             _ = existing_args.pop('sortby', None)
+            # a cursor is a position in the old order
+            _ = existing_args.pop('cursor', None)
             args.update(existing_args)
             return url_encode(args)
 
@@ -104,15 +118,15 @@ def seeker_form_to_url_params(form: ImmutableMultiDict, existing_query_str: str
 
     tlist = form.getlist('techs', type=int)
     if tlist:
-        tcmp = _compress(tlist, Skill.count())
+        tcmp = _compress(tlist, Skill.width())
         args['tech'] = tcmp
     blist = form.getlist('bizs', type=int)
     if blist:
-        bcmp = _compress(blist, Skill.count())
+        bcmp = _compress(blist, Skill.width())
         args['biz'] = bcmp
     alist = form.getlist('atts', type=int)
     if alist:
-        acmp = _compress(alist, Attitude.count())
+        acmp = _compress(alist, Attitude.width())
         args['att'] = acmp
 
     return url_encode(args)
@@ -218,84 +232,100 @@ def seeker_url_args_to_query_args(req_args: ImmutableMultiDict) -> dict:
 
     arg_tech = req_args.get('tech', '')
     if arg_tech:
-        kwargs['tech_skills'] = _decompress(arg_tech, output="int")
+        kwargs['tech_skills'] = _decompress(arg_tech, output="int", width=Skill.width())
     # if arg_tech.isdigit():  # for when arg is an int
     #     kwargs['tech_skills'] = int(arg_tech)
 
     arg_biz = req_args.get('biz', '')
     if arg_biz:
-        kwargs['biz_skills'] = _decompress(arg_biz, output="int")
+        kwargs['biz_skills'] = _decompress(arg_biz, output="int", width=Skill.width())
     # if arg_biz.isdigit():  # for when arg is an int
     #     kwargs['biz_skills'] = int(arg_biz)
 
     arg_att = req_args.get('att', '')
     if arg_att:
-        kwargs['atts'] = _decompress(arg_att, output="int")
+        kwargs['atts'] = _decompress(arg_att, output="int", width=Attitude.width())
     # if arg_att.isdigit():  # for when arg is an int
     #     kwargs['atts'] = int(arg_att)
     return kwargs
 
 
+def _work_wanted_filter(bin_worktype: int):
+    """
+    Converts a work type mask (full, part, contract, remote) to a filter on the seekers.
+    Only has a few possible work types, so the matching ones can be listed out instead of bit testing each row.
+    """
+    # work wanted only has the 3 types; shift to make room for remote before checking
+    types = [wt for wt in WorkTypes if (int(wt) << 1) & bin_worktype > 0]
+    clauses = [SeekerProfile.work_wanted.in_(types)]
+    if WorkTypes.any in types:  # seekers without a work type are treated as any
+        clauses.append(SeekerProfile.work_wanted.is_(None))
+    if bin_worktype & 1:
+        clauses.append(SeekerProfile.remote_wanted.is_(True))
+    return or_(*clauses)
+
+
+def seeker_sort_keys(jobpost_id: int = None) -> SortKeys:
+    """
+    Gets the order of the seeker search results (see `pagination.keyset_paginate`):
+        by matching score when searching for a job post, otherwise just by ID.
+    """
+    if jobpost_id is not None:
+        return [(func.coalesce(MatchScores.score, 0), True), (SeekerProfile.id, True)]
+    return [(SeekerProfile.id, False)]
+
+
 def get_seeker_query(
         worktype: Tuple[bool, bool, bool, bool] = None,
         edu_range: Tuple[int, int] = None, work_range: Tuple[int, int] = None,
         loc_distance: int = None, loc_citystate: Tuple[str, str] = None,
         tech_skills: int = None, biz_skills: int = None, atts: int = None,
-        jobpost_id: int = None):
+        jobpost_id: int = None, load: str = None):
     """
     Performs a search query on the seekers based on the provided filters.
-    Returns a 'query' object that can then be passed to 'paginate'.
+    Returns a 'query' object that can then be passed to 'keyset_paginate' (along with `seeker_sort_keys`).
+    `load` is the name of a loading profile for the seekers' related details (see `api.loading`).
     """
-    # Couldn't figure out how to convert some of these filters to pure SQL
-    #   (necessary as part of the 'hybrid_property'/'hybrid_method' annotations to be used in calls to a query's
-    #   'filter' call),
-    #   so the entire list of seekers is queried as a Python list, then filtered thru Python's built-in function.
-    #
-    # To make this work with `paginate`, it needs to be a query, so the seeker objects left at the end of the filter
-    #   are then converted to their IDs for querying the "proper" way.
-    #
-
-    matches = SeekerProfile.query.all()
-    # first, always filter out any non-active jobs
-    matches = filter(lambda m: m._user.is_active, matches)
-
-    if worktype is not None and any(worktype):
-        bin_worktype = sum(v << i for i, v in enumerate(worktype[::-1]))
-        # work wanted only has for the 3 types; add in remote before checking for truthiness
-        matches = filter(lambda m: (m.work_wanted << 1 | int(m.remote_wanted)) & bin_worktype > 0, matches)
-
-        # old way below; filtered out remote when worktype was 1111
-        # bin_worktype = sum(v << i for i, v in enumerate(worktype[-2::-1]))
-        # matches = filter(lambda m: m.work_wanted & bin_worktype > 0, matches)
-        # matches = filter(lambda m: m.remote_wanted == worktype[-1], matches)
-    if edu_range is not None:
-        matches = filter(lambda m: edu_range[0] <= m.min_edu_level <= edu_range[1], matches)
-    if work_range is not None:
-        matches = filter(lambda m: work_range[0] <= m.years_job_experience <= work_range[1], matches)
-    if loc_distance is not None and loc_citystate is not None:
-        matches = filter(lambda m: m.is_within(loc_distance, *loc_citystate), matches)
-    if tech_skills is not None:
-        matches = filter(lambda m: tech_skills & m.encode_tech_skills() > 0, matches)
-    if biz_skills is not None:
-        matches = filter(lambda m: biz_skills & m.encode_biz_skills() > 0, matches)
-    if atts is not None:
-        matches = filter(lambda m: atts & m.encode_attitudes() > 0, matches)
-    # This is the "right" way to use the filter command if someone knows how to set it up the proper way.
-    # q = q.filter(
-    #     SeekerProfile.work_wanted & bin_worktype > 0,
-    #     SeekerProfile.remote_wanted == remote,
-    #     edu_range[0] <= SeekerProfile.min_edu_level() <= edu_range[1],
-    #     work_range[0] <= SeekerProfile.years_job_experience() <= work_range[1],
-    #     q_dist_func(SeekerProfile),
-    #     tech_skills & SeekerProfile.encode_tech_skills > 0,
-    #     biz_skills & SeekerProfile.encode_biz_skills > 0,
-    #     atts & SeekerProfile.encode_attitudes > 0
-    # )
-
-    match_ids = [m.id for m in matches]
-    q = SeekerProfile.query.filter(SeekerProfile.id.in_(match_ids))
+    filters = dict(worktype=worktype, edu_range=edu_range, work_range=work_range,
+                   loc_distance=loc_distance, loc_citystate=loc_citystate,
+                   tech_skills=tech_skills, biz_skills=biz_skills, atts=atts)
+    ids = cached_ids('seeker', filters)
+    if ids is not None:
+        q = SeekerProfile.query.filter(SeekerProfile.id.in_(ids))
+    elif use_memory_engine():
+        # the filter stage runs on the in-memory snapshot; SQL only has to fetch and sort the matches
+        ids = seeker_index.search(**filters)
+        cache_ids('seeker', filters, ids)
+        q = SeekerProfile.query.filter(SeekerProfile.id.in_(ids))
+    else:
+        # first, always filter out any inactive seekers
+        q = SeekerProfile.query\
+            .join(User, SeekerProfile.user_id == User.id)\
+            .filter(User.is_active.is_(True))
+
+        if worktype is not None and any(worktype):
+            bin_worktype = sum(v << i for i, v in enumerate(worktype[::-1]))
+            q = q.filter(_work_wanted_filter(bin_worktype))
+        if edu_range is not None:
+            q = q.filter(SeekerProfile.min_edu_level.between(edu_range[0], edu_range[1]))
+        if work_range is not None:
+            q = q.filter(SeekerProfile.years_job_experience.between(work_range[0], work_range[1]))
+        if tech_skills is not None:
+            q = q.filter(SeekerProfile.tech_skill_ids.overlap(decode_ids(tech_skills, Skill.width())))
+        if biz_skills is not None:
+            q = q.filter(SeekerProfile.biz_skill_ids.overlap(decode_ids(biz_skills, Skill.width())))
+        if atts is not None:
+            q = q.filter(SeekerProfile.attitude_ids.overlap(decode_ids(atts, Attitude.width())))
+        if loc_distance is not None and loc_citystate is not None:
+            # the indexed grid cells around the radius narrow it down first; then only the seekers in them are measured
+            q = q.filter(radius_filter(SeekerProfile, LocationCoordinates.get(*loc_citystate), loc_distance))
+            rows = q.with_entities(SeekerProfile.id, SeekerProfile.latitude, SeekerProfile.longitude,
+                                   SeekerProfile.city, SeekerProfile.state).all()
+            q = q.filter(SeekerProfile.id.in_(ids_within(rows, loc_distance, *loc_citystate)))
+        cache_ids('seeker', filters, q.with_entities(SeekerProfile.id))
+
     if jobpost_id is not None:  # sort by matching score
-        q = q.join(MatchScores, SeekerProfile.id == MatchScores.seeker_id) \
-            .filter(MatchScores.jobpost_id == jobpost_id) \
-            .order_by(MatchScores.score.desc())
-    return q
+        # seekers without a cached score can't earn any points (see `matchmaker.candidate_seekers_for_post`)
+        q = q.outerjoin(MatchScores, and_(SeekerProfile.id == MatchScores.seeker_id,
+                                          MatchScores.jobpost_id == jobpost_id))
+    return with_profile(q.order_by(*order_by_keys(seeker_sort_keys(jobpost_id))), SeekerProfile, load)
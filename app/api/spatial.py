@@ -0,0 +1,90 @@
+# Lookups on the spatial grid that seekers and job posts are placed in (see `models.grid_cell`).
+# Finding the rows near a point only needs the few cells around it instead of measuring the distance to every row.
+import math
+from typing import List, Tuple
+
+from flask import jsonify, flash, redirect, url_for
+from flask_login import current_user, login_required
+from sqlalchemy import func, or_
+
+from app import db
+from app.api import bp
+from app.api.distance import EARTH_RADIUS_MI, HAVERSINE_MAX_ERROR, Coordinates, bounding_box_filter, haversine_miles
+from app.models import GRID_DEGREES, GRID_COLUMNS, grid_cell, AccountTypes, SeekerProfile, JobPost
+
+# past this many cells, the IN list costs more than it saves; a bounding box is used instead
+MAX_FILTER_CELLS = 400
+# the nearest point of a cell is approximated by clamping; pad the radius to cover the difference
+CELL_PAD = 0.02
+
+
+def cell_bounds(cell: int) -> Tuple[float, float, float, float]:
+    """ Gets the (min latitude, min longitude, max latitude, max longitude) of a grid cell. """
+    row, col = divmod(cell, GRID_COLUMNS)
+    lat0, lng0 = row * GRID_DEGREES - 90, col * GRID_DEGREES - 180
+    return lat0, lng0, lat0 + GRID_DEGREES, lng0 + GRID_DEGREES
+
+
+def cell_center(cell: int) -> Coordinates:
+    lat0, lng0, lat1, lng1 = cell_bounds(cell)
+    return (lat0 + lat1) / 2, (lng0 + lng1) / 2
+
+
+def cells_within(origin: Coordinates, distance: float) -> List[int]:
+    """ Gets the cells that have at least some area within the distance (in miles) of the origin. """
+    lat, lng = float(origin[0]), float(origin[1])
+    limit = distance * (1 + HAVERSINE_MAX_ERROR + CELL_PAD)
+    dlat = math.degrees(limit / EARTH_RADIUS_MI)
+    max_lat = min(abs(lat) + dlat, 89.9)
+    dlng = min(math.degrees(limit / (EARTH_RADIUS_MI * math.cos(math.radians(max_lat)))), 180)
+
+    origin_cell = grid_cell(lat, lng)
+    cells, nearest = [], []
+    for row in range(grid_cell(max(lat - dlat, -90), 0) // GRID_COLUMNS,
+                     grid_cell(min(lat + dlat, 90), 0) // GRID_COLUMNS + 1):
+        first = int((lng - dlng + 180) // GRID_DEGREES)
+        last = int((lng + dlng + 180) // GRID_DEGREES)
+        for col in {c % GRID_COLUMNS for c in range(first, last + 1)}:
+            cell = row * GRID_COLUMNS + col
+            lat0, lng0, lat1, lng1 = cell_bounds(cell)
+            cells.append(cell)
+            # closest point of the cell to the origin (the origin itself if it's inside)
+            nearest.append((min(max(lat, lat0), lat1), min(max(lng, lng0), lng1)))
+    if not cells:
+        return [origin_cell]
+    keep = haversine_miles(origin, nearest) <= limit
+    return sorted({c for c, k in zip(cells, keep.tolist()) if k} | {origin_cell})
+
+
+def radius_filter(model, origin: Coordinates, distance: float):
+    """
+    Converts a radius search to an indexed SQL filter on a model with latitude/longitude/grid cell columns:
+        the rows in the cells near the radius, plus those without a cell (which still need their city/state checked).
+    Wide searches that cover a lot of cells fall back to a bounding box on the coordinates.
+    """
+    cells = cells_within(origin, distance)
+    if len(cells) > MAX_FILTER_CELLS:
+        return bounding_box_filter(model.latitude, model.longitude, origin, distance)
+    return or_(model.grid_cell.in_(cells), model.grid_cell.is_(None))
+
+
+def density_by_cell(model) -> List[Tuple[float, float, int]]:
+    """ Counts the rows of the model in each grid cell, as (latitude, longitude of the cell's center, count). """
+    rows = db.session.query(model.grid_cell, func.count(model.id))\
+        .filter(model.grid_cell.isnot(None))\
+        .group_by(model.grid_cell)\
+        .all()
+    return [(*cell_center(cell), count) for cell, count in rows]
+
+
+@bp.route('/density/<kind>')
+@login_required
+def density_endpoint(kind):
+    """ Number of seekers or job posts (`kind` of 'seekers' or 'jobs') per grid cell, for the analytics maps. """
+    if current_user.account_type != AccountTypes.a:
+        flash(f"Operation not allowed.")
+        return redirect(url_for('main.index'))
+    model = {'seekers': SeekerProfile, 'jobs': JobPost}.get(kind)
+    if model is None:
+        return jsonify(error=f"Unknown kind: {kind}"), 404
+    return jsonify([dict(lat=lat, lng=lng, count=count) for lat, lng, count in density_by_cell(model)])
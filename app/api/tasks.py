@@ -0,0 +1,213 @@
+# A queue for running match score updates outside of the request.
+# Routes call `enqueue_post_scores`/`enqueue_seeker_scores` and return right away;
+#   the worker (started with `python worker.py`) claims the pending tasks and runs them in a process pool.
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait
+from datetime import datetime, timedelta
+from multiprocessing import get_context
+from typing import Iterable
+
+from flask import current_app, jsonify, flash, redirect, url_for
+from flask_login import current_user, login_required
+from sqlalchemy import and_, delete, exists, func, select, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
+
+from app import db
+from app.api import bp
+from app.models import ScoreTask, AccountTypes
+
+KIND_POST = 'post'
+KIND_SEEKER = 'seeker'
+
+
+def _enqueue(kind: str, target_id: int):
+    """
+    Adds a pending task for the given post/seeker.
+    Nothing is added if one is already pending (the pending one will pick up the latest changes when it runs).
+    """
+    stmt = insert(ScoreTask).values(kind=kind, target_id=int(target_id), status='pending',
+                                    attempts=0, enqueued_timestamp=datetime.utcnow())
+    stmt = stmt.on_conflict_do_nothing(index_elements=[ScoreTask.kind, ScoreTask.target_id],
+                                       index_where=ScoreTask.status == 'pending')
+    db.session.execute(stmt)
+    db.session.commit()
+
+
+def enqueue_many(kind: str, target_ids: Iterable[int]):
+    """ Adds pending tasks for many posts/seekers at once (e.g., after a bulk import). Doesn't commit. """
+    rows = [dict(kind=kind, target_id=int(target_id), status='pending', attempts=0,
+                 enqueued_timestamp=datetime.utcnow()) for target_id in target_ids]
+    if not rows:
+        return
+    stmt = insert(ScoreTask).on_conflict_do_nothing(index_elements=[ScoreTask.kind, ScoreTask.target_id],
+                                                    index_where=ScoreTask.status == 'pending')
+    db.session.execute(stmt, rows)
+
+
+def enqueue_post_scores(jobpost_id: int):
+    """ Queues an update of the match scores between the given job post and every seeker. """
+    _enqueue(KIND_POST, jobpost_id)
+
+
+def enqueue_seeker_scores(seeker_id: int):
+    """ Queues an update of the match scores between the given seeker and every job post. """
+    _enqueue(KIND_SEEKER, seeker_id)
+
+
+def claim_tasks(limit: int):
+    """
+    Marks up to `limit` of the oldest pending tasks as running and returns them as (id, kind, target id) tuples.
+    Rows locked by another worker are skipped, so multiple workers can safely share the queue.
+    """
+    pending = select(ScoreTask.id)\
+        .where(ScoreTask.status == 'pending')\
+        .order_by(ScoreTask.id)\
+        .limit(limit)\
+        .with_for_update(skip_locked=True)\
+        .scalar_subquery()
+    stmt = update(ScoreTask)\
+        .where(ScoreTask.id.in_(pending))\
+        .values(status='running', started_timestamp=datetime.utcnow(), attempts=ScoreTask.attempts + 1)\
+        .returning(ScoreTask.id, ScoreTask.kind, ScoreTask.target_id)\
+        .execution_options(synchronize_session=False)
+    claimed = db.session.execute(stmt).all()
+    db.session.commit()
+    return [tuple(row) for row in claimed]
+
+
+def _requeue(condition) -> int:
+    """
+    Puts the tasks matching the condition back in the queue, as one statement (so a concurrent enqueue can't
+        slip in between a check and the update). Where the same post/seeker already has a pending task
+        (or several match), just one is kept and the rest are dropped. Returns the number of tasks re-queued.
+    """
+    pending = aliased(ScoreTask)
+    has_pending = exists().where(pending.kind == ScoreTask.kind, pending.target_id == ScoreTask.target_id,
+                                 pending.status == 'pending')
+    # not correlated with the update, so it sees all the matching tasks
+    first_per_target = select(func.min(ScoreTask.id)).where(condition)\
+        .group_by(ScoreTask.kind, ScoreTask.target_id).correlate(None)
+    try:
+        n = db.session.execute(update(ScoreTask)
+                               .where(condition, ScoreTask.id.in_(first_per_target), ~has_pending)
+                               .values(status='pending', started_timestamp=None)
+                               .execution_options(synchronize_session=False)).rowcount
+        db.session.execute(delete(ScoreTask).where(condition).execution_options(synchronize_session=False))
+        db.session.commit()
+    except IntegrityError:  # a task for one of them was enqueued meanwhile; they're retried on the next pass
+        db.session.rollback()
+        return 0
+    return n
+
+
+def requeue_stale_tasks(timeout_minutes: int) -> int:
+    """
+    Puts tasks that have been running for longer than the timeout (e.g., their worker died) back in the queue.
+    If the same post/seeker already has a newer pending task, the stale one is dropped instead.
+    Returns the number of tasks re-queued.
+    """
+    cutoff = datetime.utcnow() - timedelta(minutes=timeout_minutes)
+    return _requeue(and_(ScoreTask.status == 'running', ScoreTask.started_timestamp < cutoff))
+
+
+def requeue_failed_tasks(max_attempts: int) -> int:
+    """
+    Puts failed tasks that have been tried fewer than `max_attempts` times back in the queue
+        (the rest are kept for inspection). Returns the number of tasks re-queued.
+    """
+    return _requeue(and_(ScoreTask.status == 'failed', ScoreTask.attempts < max_attempts))
+
+
+def delete_finished_tasks(older_than_days: int = 1) -> int:
+    """ Removes completed tasks older than the given number of days (failed ones are kept for inspection). """
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    n = ScoreTask.query.filter(ScoreTask.status == 'done', ScoreTask.finished_timestamp < cutoff)\
+        .delete(synchronize_session=False)
+    db.session.commit()
+    return n
+
+
+def queue_status() -> dict:
+    """ Gets the number of tasks in each state and the age of the oldest pending task. """
+    counts = dict(db.session.query(ScoreTask.status, func.count(ScoreTask.id)).group_by(ScoreTask.status).all())
+    oldest = db.session.query(func.min(ScoreTask.enqueued_timestamp)).filter(ScoreTask.status == 'pending').scalar()
+    return {
+        'depth': counts.get('pending', 0),
+        'running': counts.get('running', 0),
+        'done': counts.get('done', 0),
+        'failed': counts.get('failed', 0),
+        'oldest_pending_seconds': (datetime.utcnow() - oldest).total_seconds() if oldest else 0
+    }
+
+
+@bp.route('/queue')
+@login_required
+def queue_status_endpoint():
+    if current_user.account_type != AccountTypes.a:
+        flash(f"Operation not allowed.")
+        return redirect(url_for('main.index'))
+    return jsonify(queue_status())
+
+
+##### WORKER #####
+# The functions below run inside the worker's child processes; each one sets up its own app and DB connection.
+
+_worker_app = None
+
+
+def _init_worker_process():
+    global _worker_app
+    from app import create_app
+    _worker_app = create_app()
+
+
+def _run_task(task_id: int, kind: str, target_id: int) -> bool:
+    """ Runs a single claimed task and records its outcome. Returns whether it succeeded. """
+    from app.api.matchmaker import update_cache
+    with _worker_app.app_context():
+        try:
+            if kind == KIND_POST:
+                update_cache(jobpost_id=target_id)
+            else:
+                update_cache(seeker_id=target_id)
+            status, error = 'done', None
+        except Exception:
+            db.session.rollback()
+            status, error = 'failed', traceback.format_exc()
+        db.session.execute(update(ScoreTask)
+                           .where(ScoreTask.id == task_id)
+                           .values(status=status, error=error, finished_timestamp=datetime.utcnow()))
+        db.session.commit()
+        db.session.remove()
+    return status == 'done'
+
+
+def run_worker(processes: int = None, once: bool = False):
+    """
+    Claims and runs queued tasks until stopped (or until the queue is empty, if `once` is true).
+    Must be called within an app context.
+    """
+    processes = processes or current_app.config['SCORE_WORKER_PROCESSES']
+    poll_seconds = current_app.config['SCORE_WORKER_POLL_SECONDS']
+    timeout_minutes = current_app.config['SCORE_TASK_TIMEOUT_MINUTES']
+    max_attempts = current_app.config['SCORE_TASK_MAX_ATTEMPTS']
+
+    with ProcessPoolExecutor(max_workers=processes, mp_context=get_context('spawn'),
+                             initializer=_init_worker_process) as pool:
+        while True:
+            requeue_stale_tasks(timeout_minutes)
+            requeue_failed_tasks(max_attempts)
+            claimed = claim_tasks(processes * 2)
+            if not claimed:
+                if once:
+                    break
+                delete_finished_tasks()
+                time.sleep(poll_seconds)
+                continue
+            futures = [pool.submit(_run_task, *task) for task in claimed]
+            wait(futures)
+            n_failed = sum(1 for f in futures if f.exception() is not None or not f.result())
+            current_app.logger.info(f"Ran {len(futures)} match score tasks ({n_failed} failed)")
@@ -1,14 +1,23 @@
 # TODO add functions to create/update/get entries in database related to users or their account/profile
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from typing import Union
+from itertools import islice
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import DataError, IntegrityError
+from werkzeug.security import generate_password_hash
 
 from app import db
+from app.api.resumes import set_resume, store_resume
+from app.api.search_cache import invalidate_seeker, search_cache
+from app.api.tasks import KIND_SEEKER, enqueue_many
 from app.models import AccountTypes, WorkTypes, SkillLevels, SeekerSkill, SeekerAttitude, EducationLevel, \
     SeekerHistoryEducation, SeekerHistoryJob, CompanySeekerSearch, SeekerJobSearch, Skill, Attitude
-from app.models import User, CompanyProfile, SeekerProfile
-
+from app.models import User, CompanyProfile, SeekerProfile, LocationCoordinates, grid_cell, sync_attribute_ids, \
+    taxonomy
 
-# TODO should add arg for commiting? May increase performance when updating in bulk
+# for adding many users at once (e.g., an import), see `bulk_new_seekers`/`bulk_new_companies`
 
 def update_last_login(user_id):
     entry = User.query.filter_by(id=user_id).first()
@@ -59,10 +68,10 @@ def new_company(email, password, join_date=None,
     if join_date is not None:
         user.join_date = join_date
 
-    # before the profile can be created, it needs to committed
+    # before the profile can be created, the user needs to be flushed
     # (as that's when the id field is generated)
     db.session.add(user)
-    db.session.commit()
+    db.session.flush()
 
     profile = CompanyProfile()
     profile.user_id = user.id
@@ -119,10 +128,10 @@ def new_seeker(email, password, join_date=None,
     if join_date is not None:
         user.join_date = join_date
 
-    # before the profile can be created, it needs to committed
+    # before the profile can be created, the user needs to be flushed
     # (as that's when the id field is generated)
     db.session.add(user)
-    db.session.commit()
+    db.session.flush()
 
     profile = SeekerProfile()
     profile.user_id = user.id
@@ -136,7 +145,8 @@ def new_seeker(email, password, join_date=None,
     profile.remote_wanted = remote_wanted or False
     profile.tagline = tagline
     profile.summary = summary
-    profile.resume = resume
+    if resume is not None:
+        set_resume(profile, resume)
 
     db.session.add(profile)
     db.session.commit()
@@ -149,7 +159,7 @@ def edit_seeker(seeker_id,
                 city: str = None, state: str = None,
                 work_wanted: WorkTypes = None, remote_wanted: bool = False,
                 tagline: str = None, summary: str = None,
-                resume: bin = None
+                resume: Union[bytes, BinaryIO] = None
                 ):
     """
     Edits a seeker in the database
@@ -176,8 +186,9 @@ def edit_seeker(seeker_id,
     if summary is not None:
         profile.summary = summary
     if resume is not None:
-        profile.resume = resume
+        set_resume(profile, resume)
     db.session.commit()
+    invalidate_seeker(profile)
 
 
 def reset_seeker(seeker_id: int, skills=False, attitudes=False, educations=False, jobs=False):
@@ -288,3 +299,231 @@ def new_admin(email, password):
     db.session.commit()
 
     # TODO add profile after creating adminprofile table
+
+
+##### BULK #####
+BULK_CHUNK_SIZE = 500
+
+# the outcome of a bulk insert: the new profile IDs (in the order given, None for rows that failed)
+#   and the error of each row that failed, by its position
+BulkResult = Tuple[List[Optional[int]], Dict[int, str]]
+
+
+def _chunks(rows: Iterable, size: int) -> Iterator[list]:
+    it = iter(rows)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _hash_passwords(rows: List[dict], processes: int = None) -> List[dict]:
+    """
+    Gets copies of the rows with the `password_hash` filled in where only a `password` was given
+        (hashed in a process pool, if given one). The caller's rows are left as they are.
+    """
+    rows = [dict(row) for row in rows]
+    todo = [row for row in rows if not row.get('password_hash') and row.get('password')]
+    if processes and processes > 1 and len(todo) > 1:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            hashes = list(pool.map(generate_password_hash, [row['password'] for row in todo], chunksize=64))
+    else:
+        hashes = [generate_password_hash(row['password']) for row in todo]
+    for row, pw_hash in zip(todo, hashes):
+        row['password_hash'] = pw_hash
+    return rows
+
+
+def _user_values(row: dict, account_type: AccountTypes) -> dict:
+    if not row.get('email') or not row.get('password_hash'):
+        raise ValueError("An email and password are required.")
+    # every row of a multi-row insert needs the same columns, so the defaults are filled in here
+    return dict(account_type=account_type, email=row['email'], password=row['password_hash'], is_active=True,
+                join_date=row.get('join_date') or datetime.utcnow())
+
+
+def _location_values(row: dict, with_cell: bool) -> dict:
+    """
+    The location columns that `_fill_coordinates` sets on a flush (bulk inserts don't go through it).
+    Like it, new lookups aren't saved (so the import's chunks aren't committed by a lookup).
+    """
+    city, state = row.get('city'), row.get('state')
+    lat, lng = LocationCoordinates.get(city, state, persist=False) if city or state else (None, None)
+    values = dict(city=city, state=state, latitude=lat, longitude=lng)
+    if with_cell:
+        values['grid_cell'] = grid_cell(lat, lng)
+    return values
+
+
+def _prepare_seeker(row: dict) -> dict:
+    """ Checks a row of `bulk_new_seekers` and converts it to the values to insert. Raises a ValueError if bad. """
+    snapshot = taxonomy.get()
+    email = row.get('email') or ''
+    if '@' not in email:
+        raise ValueError(f"Invalid email: {email}")
+    prepared = dict(
+        user=_user_values(row, AccountTypes.s),
+        profile=dict(first_name=row.get('first_name') or email[:email.index('@')],
+                     last_name=row.get('last_name') or "Seeker",
+                     phone_number=row.get('phone_number'),
+                     work_wanted=WorkTypes(row.get('work_wanted') or WorkTypes.any),
+                     remote_wanted=row.get('remote_wanted') or False,
+                     tagline=row.get('tagline'), summary=row.get('summary'),
+                     resume_hash=None, resume_size=None,
+                     **_location_values(row, with_cell=True)),
+        skills=[], attitudes=[], educations=[], jobs=[])
+    if row.get('resume') is not None:
+        # stored up front, so it isn't read again if the chunk has to be retried
+        prepared['profile']['resume_hash'], prepared['profile']['resume_size'] = store_resume(row['resume'])
+    for skill, level in row.get('skills') or ():
+        skill_id = snapshot.skill_ids.get(skill) if isinstance(skill, str) else skill
+        if skill_id not in snapshot.skill_titles:
+            raise ValueError(f"Unknown skill: {skill}")
+        prepared['skills'].append(dict(skill_id=skill_id, skill_level=SkillLevels(level)))
+    for attitude in set(row.get('attitudes') or ()):
+        attitude_id = snapshot.attitude_ids.get(attitude) if isinstance(attitude, str) else attitude
+        if attitude_id not in snapshot.attitude_titles:
+            raise ValueError(f"Unknown attitude: {attitude}")
+        prepared['attitudes'].append(dict(attitude_id=attitude_id))
+    for school, education_lvl, study_field in row.get('educations') or ():
+        prepared['educations'].append(dict(school=school, education_lvl=EducationLevel(education_lvl),
+                                           study_field=study_field))
+    for job_title, years_employed in row.get('jobs') or ():
+        prepared['jobs'].append(dict(job_title=job_title, years_employed=years_employed))
+    return prepared
+
+
+def _prepare_company(row: dict) -> dict:
+    """ Checks a row of `bulk_new_companies` and converts it to the values to insert. Raises a ValueError if bad. """
+    email = row.get('email') or ''
+    if '@' not in email or '.' not in email[email.index('@'):]:
+        raise ValueError(f"Invalid email: {email}")
+    website = row.get('website')
+    if website and not website.startswith("http"):
+        website = "http://" + website
+    return dict(
+        user=_user_values(row, AccountTypes.c),
+        profile=dict(name=row.get('name') or email[email.index('@') + 1:email.rindex('.')],
+                     website=website, tagline=row.get('tagline'), summary=row.get('summary'),
+                     **_location_values(row, with_cell=False)))
+
+
+def _insert_users(rows: List[Tuple[int, dict]], model) -> Tuple[Dict[int, int], Dict[int, str]]:
+    """
+    Inserts the users and their profiles (of the model) in one statement each, getting their IDs back.
+    Rows whose email is already registered are skipped. Returns the profile IDs and errors by row position.
+    """
+    ids, errors = dict(), dict()
+    new_users = db.session.execute(insert(User)
+                                   .values([r['user'] for _, r in rows])
+                                   .on_conflict_do_nothing(index_elements=[User.email])
+                                   .returning(User.id, User.email)).all()
+    user_ids = {email: user_id for user_id, email in new_users}
+    profile_rows = []
+    for i, r in rows:
+        user_id = user_ids.get(r['user']['email'])
+        if user_id is None:
+            errors[i] = f"User {r['user']['email']} is already registered."
+            continue
+        profile_rows.append(dict(r['profile'], user_id=user_id))
+    if profile_rows:
+        new_profiles = db.session.execute(insert(model)
+                                          .values(profile_rows)
+                                          .returning(model.id, model.user_id)).all()
+        profile_ids = {user_id: profile_id for profile_id, user_id in new_profiles}
+        for i, r in rows:
+            if i not in errors:
+                ids[i] = profile_ids[user_ids[r['user']['email']]]
+    return ids, errors
+
+
+def _insert_seekers(rows: List[Tuple[int, dict]]) -> Tuple[Dict[int, int], Dict[int, str]]:
+    """ Inserts the seekers, then their skills, attitudes and history (as one executemany each). """
+    ids, errors = _insert_users(rows, SeekerProfile)
+    for key, model in (('skills', SeekerSkill), ('attitudes', SeekerAttitude),
+                       ('educations', SeekerHistoryEducation), ('jobs', SeekerHistoryJob)):
+        entries = [dict(entry, seeker_id=ids[i]) for i, r in rows if i in ids for entry in r[key]]
+        if entries:
+            db.session.execute(insert(model), entries)
+    # done on a flush for single changes, which these inserts don't go through
+    sync_attribute_ids(db.session, list(ids.values()), [])
+    return ids, errors
+
+
+def _bulk_insert(rows: Iterable[dict], prepare, insert_rows, chunk_size: int, hash_processes: int = None,
+                 on_chunk=None) -> BulkResult:
+    """
+    Inserts the rows a chunk at a time, committing after each.
+    A chunk is inserted together in a savepoint; if any row of it makes a statement fail (e.g., a constraint),
+        the chunk is retried a row at a time, so just the bad rows are reported and the rest are still added.
+    """
+    ids, errors = [], dict()
+    seen_emails = set()
+    for chunk in _chunks(rows, chunk_size):
+        start = len(ids)
+        ids.extend([None] * len(chunk))
+        chunk = _hash_passwords(chunk, hash_processes)
+        prepared = []
+        for i, row in enumerate(chunk, start):
+            try:
+                email = row.get('email')
+                if email in seen_emails:
+                    raise ValueError(f"User {email} is listed more than once.")
+                prepared.append((i, prepare(row)))
+                seen_emails.add(email)  # only once it's valid, so a bad row doesn't block a later fix of it
+            except (ValueError, TypeError, KeyError) as e:
+                errors[i] = str(e)
+        if not prepared:
+            continue
+
+        try:
+            with db.session.begin_nested():
+                chunk_ids, chunk_errors = insert_rows(prepared)
+        except (IntegrityError, DataError):
+            chunk_ids, chunk_errors = dict(), dict()
+            for i, r in prepared:
+                try:
+                    with db.session.begin_nested():
+                        row_ids, row_errors = insert_rows([(i, r)])
+                    chunk_ids.update(row_ids)
+                    chunk_errors.update(row_errors)
+                except (IntegrityError, DataError) as e:
+                    chunk_errors[i] = str(e.orig).strip()
+        if on_chunk is not None:
+            on_chunk(list(chunk_ids.values()))
+        db.session.commit()
+        for i, profile_id in chunk_ids.items():
+            ids[i] = profile_id
+        errors.update(chunk_errors)
+    return ids, errors
+
+
+def bulk_new_seekers(seekers: Iterable[dict], chunk_size: int = BULK_CHUNK_SIZE, hash_processes: int = None,
+                     enqueue_scores: bool = True) -> BulkResult:
+    """
+    Adds many seekers at once (e.g., an import), committing once per `chunk_size` of them.
+    Each is a dictionary of the arguments of `new_seeker` (with `password_hash` usable in place of `password`)
+        and optionally their `skills` as (skill ID or title, level) pairs, `attitudes` as IDs or titles,
+        `educations` as (school, education level, field) and `jobs` as (title, years employed).
+    Hashing passwords is the slowest part, so pass `hash_processes` to spread it across processes.
+    A bad row doesn't stop the others from being added; see `BulkResult` for what's returned.
+    """
+    def on_chunk(seeker_ids):
+        if enqueue_scores:
+            enqueue_many(KIND_SEEKER, seeker_ids)
+
+    result = _bulk_insert(seekers, _prepare_seeker, _insert_seekers, chunk_size, hash_processes, on_chunk)
+    search_cache.clear()  # simpler than working out which searches each new seeker joins
+    return result
+
+
+def bulk_new_companies(companies: Iterable[dict], chunk_size: int = BULK_CHUNK_SIZE,
+                       hash_processes: int = None) -> BulkResult:
+    """
+    Adds many companies at once (e.g., an import), committing once per `chunk_size` of them.
+    Each is a dictionary of the arguments of `new_company` (with `password_hash` usable in place of `password`).
+    A bad row doesn't stop the others from being added; see `BulkResult` for what's returned.
+    """
+    return _bulk_insert(companies, _prepare_company, lambda rows: _insert_users(rows, CompanyProfile),
+                        chunk_size, hash_processes)
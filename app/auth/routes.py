@@ -2,6 +2,7 @@ from flask import url_for, flash, render_template
 from flask_login import current_user, login_user, login_required, logout_user
 from werkzeug.utils import redirect
 
+from app.api.tasks import enqueue_seeker_scores
 from app.api.users import new_seeker, new_company, update_last_login
 from app.auth import bp
 from app.auth.forms import LoginForm, RegisterForm
@@ -43,10 +44,11 @@ def register():
             return redirect(url_for('auth.login'))
         # create new user and add to the database
         if form.account_type.data.lower().startswith("s"):
-            new_func = new_seeker
+            seeker_id = new_seeker(form.email.data, form.password.data)
+            # new seekers have no location yet, so they earn location points for every non-remote post
+            enqueue_seeker_scores(seeker_id)
         else:
-            new_func = new_company
-        new_func(form.email.data, form.password.data)
+            new_company(form.email.data, form.password.data)
         # atype = AccountTypes.s if form.account_type.data.lower().startswith("s") else AccountTypes.c
         # user = User(account_type = atype, email = form.email.data)
         # user.set_password(form.password.data)  # hashes it
@@ -0,0 +1,99 @@
+# Compression of large stored values: long text columns (see `CompressedText`) and resumes (see `app.api.resumes`).
+# zlib is always available; zstd ('zstd') is faster at about the same ratio, and is used when the `zstandard`
+#   package is installed and `COMPRESSION_CODEC` asks for it.
+# Compressed text is stored as `TEXT_HEADER`, a character naming the codec, then the compressed bytes in base64.
+#   Values without the header (e.g., rows from before compression was added, or ones too short to be worth it)
+#   are read as they are, so the columns can be compressed gradually (see `compress_stored` in `app.api.resumes`).
+import base64
+import zlib
+from typing import Optional
+
+from flask import current_app, has_app_context
+from sqlalchemy.types import Text, TypeDecorator
+
+try:
+    import zstandard
+except ImportError:  # optional; zlib is used instead
+    zstandard = None
+
+CODECS = ('zlib', 'zstd')
+# marks a compressed text value (a control character, which a form never submits)
+TEXT_HEADER = '\x01'
+_TEXT_TAGS = {'zlib': 'z', 'zstd': 's'}
+_TAG_CODECS = {tag: codec for codec, tag in _TEXT_TAGS.items()}
+# used outside of the app (e.g., in scripts); see `COMPRESSION_MIN_BYTES`
+DEFAULT_MIN_BYTES = 512
+
+
+def default_codec() -> str:
+    """ Gets the codec to compress with: the configured one, or zlib if it isn't available. """
+    codec = current_app.config['COMPRESSION_CODEC'] if has_app_context() else 'zlib'
+    if codec not in CODECS:
+        raise ValueError(f"Unknown compression codec: {codec}")
+    if codec == 'zstd' and zstandard is None:
+        return 'zlib'
+    return codec
+
+
+def min_bytes() -> int:
+    """ Values shorter than this are stored as they are. """
+    return current_app.config['COMPRESSION_MIN_BYTES'] if has_app_context() else DEFAULT_MIN_BYTES
+
+
+def compressor(codec: str):
+    """ Gets an incremental compressor (with `compress` and `flush`) for the codec. """
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor().compressobj()
+    return zlib.compressobj(6)
+
+
+def decompressor(codec: str):
+    """ Gets an incremental decompressor (with `decompress`) for the codec. """
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ValueError("Reading zstd-compressed data needs the zstandard package.")
+        return zstandard.ZstdDecompressor().decompressobj()
+    return zlib.decompressobj()
+
+
+def compress(data: bytes, codec: str) -> bytes:
+    c = compressor(codec)
+    return c.compress(data) + c.flush()
+
+
+def decompress(data: bytes, codec: str) -> bytes:
+    return decompressor(codec).decompress(data)
+
+
+def compress_text(value: Optional[str]) -> Optional[str]:
+    """ Gets the stored form of a text value: compressed (with the header) if long enough and worth it. """
+    if value is None or len(value) < min_bytes():
+        return value
+    codec = default_codec()
+    packed = base64.b64encode(compress(value.encode('utf-8'), codec)).decode('ascii')
+    if len(packed) + 2 >= len(value):
+        return value
+    return TEXT_HEADER + _TEXT_TAGS[codec] + packed
+
+
+def is_compressed_text(value: Optional[str]) -> bool:
+    return value is not None and len(value) > 1 and value[0] == TEXT_HEADER and value[1] in _TAG_CODECS
+
+
+def decompress_text(value: Optional[str]) -> Optional[str]:
+    """ Gets a text value back from its stored form (values without the header are returned as they are). """
+    if not is_compressed_text(value):
+        return value
+    return decompress(base64.b64decode(value[2:]), _TAG_CODECS[value[1]]).decode('utf-8')
+
+
+class CompressedText(TypeDecorator):
+    """ A text column whose long values are stored compressed, and read back transparently. """
+    impl = Text
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return compress_text(value)
+
+    def process_result_value(self, value, dialect):
+        return decompress_text(value)
@@ -1,27 +1,29 @@
 # Routes are the different URLs that the application implements.
 # The functions below handle the routing/behavior.
-import json
 import traceback
-from datetime import datetime
-from io import BytesIO
 
-from flask import render_template, flash, redirect, url_for, send_file, Response
+from flask import render_template, flash, redirect, url_for
 from flask import request
 from flask_login import current_user, login_required
 
 import app
 from app.api.colors import lerp_color
 from app.api.db import count_rows, job_activeness_count, seeker_activeness_count
+from app.api.export import EXPORT_FORMATS, export_response
+from app.api.instrumentation import recent_requests
 from app.api.job_query import job_url_args_to_query_args, get_job_query, job_url_args_to_input_states, \
-    job_form_to_url_params
+    job_form_to_url_params, job_sort_keys
 from app.api.jobpost import new_jobpost, extract_details, edit_jobpost
-from app.api.matchmaker import get_score, update_cache
+from app.api.loading import with_profile
+from app.api.matchmaker import get_scores_for_seeker, get_scores_for_post
+from app.api.pagination import keyset_paginate
 from app.api.profile import update_seeker, update_company
+from app.api.resumes import set_resume, resume_response
 from app.api.seeker_query import get_seeker_query, seeker_form_to_url_params, seeker_url_args_to_query_args, \
-    seeker_url_args_to_input_states
-from app.api.routing import modify_query
+    seeker_url_args_to_input_states, seeker_sort_keys
 from app.api.statistics import get_coordinate_info, get_seeker_counts_by_skill, get_post_counts_by_skill, \
     get_seeker_counts_by_attitude, get_post_counts_by_attitude
+from app.api.tasks import enqueue_post_scores, enqueue_seeker_scores
 from app.api.users import save_seeker_search, delete_seeker_search, save_job_search, delete_job_search
 from app.main import bp
 from app.main.forms import JobPostForm
@@ -55,7 +57,7 @@ def index():
         _state = prof.state
         _tagline = prof.tagline
         _summary = prof.summary
-        _resume = prof.resume
+        _resume = prof.has_resume
         _skills = prof._skills
         _attitudes = prof._attitudes
         _history_edus = prof._history_edus
@@ -96,7 +98,7 @@ def seeker_profile(seeker_id):
     """
     Navigate to a specific seeker's profile page.
     """
-    skr = SeekerProfile.query.filter_by(id=seeker_id).first()
+    skr = with_profile(SeekerProfile.query, SeekerProfile, 'profile_page').filter_by(id=seeker_id).first()
     if skr is None:
         # could not find profile with that id
         flash(f'No seeker with the id {seeker_id}.')
@@ -119,7 +121,11 @@ def seeker_resume_upload(seeker_id):
         flash(f'No seeker with the id {seeker_id}.')
         return redirect(url_for('main.index'))
     file = request.files['inputFile']
-    skr.resume = file.read()
+    try:
+        set_resume(skr, file.stream)
+    except ValueError as e:
+        flash(str(e))
+        return redirect(url_for('main.seeker_profile', seeker_id=seeker_id))
     app.db.session.commit()
     return redirect(url_for('main.seeker_profile', seeker_id=seeker_id))
 
@@ -132,12 +138,12 @@ def seeker_resume_download(seeker_id):
         # could not find profile with that id
         flash(f'No seeker with the id {seeker_id}.')
         return redirect(url_for('main.index'))
-    if skr.resume is None:
+    if not skr.has_resume:
         flash('Seeker does not have a resume uploaded.')
         return redirect(url_for('main.seeker_profile', seeker_id=seeker_id))
     # TODO assume docx okay?
     filename = f"resume_{skr.last_name},{skr.first_name}.docx"
-    return send_file(BytesIO(skr.resume), attachment_filename=filename, as_attachment=True)
+    return resume_response(skr, filename)
 
 
 @bp.route("/company/<company_id>")
@@ -177,12 +183,20 @@ def edit_profile():
         # print(request.form)
         # print(request.files)
         if current_user.account_type == AccountTypes.s:
-            update_seeker(current_user._seeker, request.form, request.files)
-            # also update the match score cache
-            # update_cache(seeker_id = current_user._seeker.id)
+            try:
+                update_seeker(current_user._seeker, request.form, request.files)
+            except ValueError as e:  # e.g., a resume or picture over the size limit
+                flash(str(e))
+                return redirect(url_for('main.profile'))
+            # also queue an update of the match score cache (only rescores if skills, attitudes, or location changed)
+            enqueue_seeker_scores(current_user._seeker.id)
             flash("Updated!")
         else:  # company user
-            update_company(current_user._company, request.form, request.files)
+            try:
+                update_company(current_user._company, request.form, request.files)
+            except ValueError as e:  # e.g., a picture over the size limit
+                flash(str(e))
+                return redirect(url_for('main.profile'))
             flash("Updated!")
         return redirect(url_for('main.profile'))
 
@@ -224,8 +238,8 @@ def new_job():
         deets = extract_details(form)
         post_id = new_jobpost(current_user._company.id, deets.pop('title'), **deets)
 
-        # now update the cache for this new post
-        update_cache(jobpost_id=post_id)
+        # now queue an update of the cache for this new post
+        enqueue_post_scores(post_id)
 
         flash(f"Created job post with ID {post_id}")
         return redirect(url_for('main.job_page', job_id=post_id))
@@ -251,8 +265,8 @@ def edit_job(job_id):
         #print("POST w/", deets)
         edit_jobpost(job_id, **deets)
 
-        # now update the cache for this post
-        update_cache(jobpost_id=job_id)
+        # now queue an update of the cache for this post
+        enqueue_post_scores(job_id)
 
         flash(f"Edited job successfully.")
         return redirect(url_for('main.job_page', job_id=job_id))
@@ -306,44 +320,33 @@ def job_search():
         return redirect(new_path)
 
     # `request` is a global value that lets you check the URL request.
+    # pages continue from a cursor rather than an offset (see `api.pagination`); 'page' is from older links
+    cursor = request.args.get('cursor')
     page_num = request.args.get('page', 1, type=int)
 
-    # query.all can be replaced with query.paginate to iteratively get that page's results.
-    # https://flask-sqlalchemy.palletsprojects.com/en/2.x/api/#flask_sqlalchemy.BaseQuery.paginate
     req_kwargs = job_url_args_to_query_args(request.args)
 
     # add in seeker's ID if that's who is conducting the search
     if current_user._seeker is not None:
         req_kwargs['seeker_id'] = current_user._seeker.id
 
-    pager = get_job_query(**req_kwargs).paginate(
-        page_num, app.Config.RESULTS_PER_PAGE, False)
-
-    prev_url = modify_query(request, page=pager.prev_num) if pager.has_prev else "#"
-    prev_link_clz = "disabled" if not pager.has_prev else ""
-
-    next_url = modify_query(request, page=pager.next_num) if pager.has_next else "#"
-    next_link_clz = "disabled" if not pager.has_next else ""
-
-    # get lower and upper page count for (up to) 5 surrounding pages
-    max_window = min(5, pager.pages)
-    pg_lower = pg_upper = page_num
-    while pg_upper - pg_lower + 1 < max_window:
-        pg_lower = max(1, pg_lower - 1)
-        pg_upper = min(pager.pages, pg_upper + 1)
+    pager = keyset_paginate(get_job_query(**req_kwargs, load='search_card'),
+                            job_sort_keys(req_kwargs.get('seeker_id')), cursor, app.Config.RESULTS_PER_PAGE, page_num)
 
     filter_options_set = job_url_args_to_input_states(request.args)
 
+    # all of the page's scores at once, rather than one query per card
+    match_scores = dict()
+    if current_user._seeker is not None:
+        scores = get_scores_for_seeker(current_user._seeker.id, [job.id for job in pager.items])
+        match_scores = {pid: f"{round(score, 1):g}" for pid, score in scores.items()}
+
     return render_template('company/search.html',
                            tech_tuples=Skill.to_tech_tuples(0), biz_tuples=Skill.to_biz_tuples(0),
                            att_tuples=Attitude.to_tuples(0),
                            job_posts=pager.items,
-                           total=pager.total,
-                           page=page_num,
-                           plwr=pg_lower, pupr=pg_upper,
-                           dprev=prev_link_clz, prev_url=prev_url,
-                           dnext=next_link_clz, next_url=next_url,
-                           get_match_score=lambda jp, s: f"{round(float(get_score(jp, s)),1):g}",
+                           **pager.template_args(request),
+                           match_scores=match_scores,
                            show_saveload=False,
                            opts=filter_options_set
                            )
@@ -352,13 +355,16 @@ def job_search():
 @bp.route("/jobs/download")
 @login_required
 def job_search_download():
+    """
+    Downloads all of the search's results; `format` can be 'json' (default), 'ndjson' or 'csv'.
+    """
+    fmt = request.args.get('format', 'json')
+    if fmt not in EXPORT_FORMATS:
+        flash(f"Unknown download format: {fmt}")
+        return redirect(url_for('main.job_search'))
     req_kwargs = job_url_args_to_query_args(request.args)
-    results = get_job_query(**req_kwargs).all()
-    results = [s.to_dict() for s in results]
-    output = {"timestamp": datetime.now().isoformat(), "query": f"?{request.query_string.decode()}", "results": results}
-    return Response(json.dumps(output, indent=4),
-                    mimetype='text/json',
-                    headers={'Content-disposition': 'attachment; filename=job_search_results.json'})
+    return export_response(get_job_query(**req_kwargs, load='export'), fmt, 'job_search_results',
+                           f"?{request.query_string.decode()}")
 
 
 @bp.route("/job/<job_id>")
@@ -367,7 +373,7 @@ def job_page(job_id: int):
     """
     Navigate to the job page with the specified id.
     """
-    job_post = JobPost.query.filter_by(id=job_id).first_or_404()
+    job_post = with_profile(JobPost.query, JobPost, 'profile_page').filter_by(id=job_id).first_or_404()
     return render_template('company/jobpost.html', job=job_post)
 
 
@@ -405,40 +411,30 @@ def seeker_search():
         return redirect(new_path)
 
     # `request` is a global value that lets you check the URL request.
+    # pages continue from a cursor rather than an offset (see `api.pagination`); 'page' is from older links
+    cursor = request.args.get('cursor')
     page_num = request.args.get('page', 1, type=int)
 
-    # query.all can be replaced with query.paginate to iteratively get that page's results.
-    # https://flask-sqlalchemy.palletsprojects.com/en/2.x/api/#flask_sqlalchemy.BaseQuery.paginate
     req_kwargs = seeker_url_args_to_query_args(request.args)
 
-    pager = get_seeker_query(**req_kwargs).paginate(
-        page_num, app.Config.RESULTS_PER_PAGE, False)
-
-    prev_url = modify_query(request, page=pager.prev_num) if pager.has_prev else "#"
-    prev_link_clz = "disabled" if not pager.has_prev else ""
-
-    next_url = modify_query(request, page=pager.next_num) if pager.has_next else "#"
-    next_link_clz = "disabled" if not pager.has_next else ""
-
-    # get lower and upper page count for (up to) 5 surrounding pages
-    max_window = min(5, pager.pages)
-    pg_lower = pg_upper = page_num
-    while pg_upper - pg_lower + 1 < max_window:
-        pg_lower = max(1, pg_lower - 1)
-        pg_upper = min(pager.pages, pg_upper + 1)
+    pager = keyset_paginate(get_seeker_query(**req_kwargs, load='search_card'),
+                            seeker_sort_keys(req_kwargs.get('jobpost_id')),
+                            cursor, app.Config.RESULTS_PER_PAGE, page_num)
 
     filter_options_set = seeker_url_args_to_input_states(request.args)
 
+    # all of the page's scores at once, rather than one query per card
+    match_scores = dict()
+    if 'jobpost_id' in req_kwargs:
+        scores = get_scores_for_post(req_kwargs['jobpost_id'], [seeker.id for seeker in pager.items])
+        match_scores = {sid: f"{round(score, 1):g}" for sid, score in scores.items()}
+
     return render_template('seeker/search.html',
                            tech_tuples=Skill.to_tech_tuples(0), biz_tuples=Skill.to_biz_tuples(0),
                            att_tuples=Attitude.to_tuples(0),
                            seeker_profiles=pager.items,  # .items gets the list of profiles
-                           total=pager.total,
-                           page=page_num,
-                           plwr=pg_lower, pupr=pg_upper,
-                           dprev=prev_link_clz, prev_url=prev_url,
-                           dnext=next_link_clz, next_url=next_url,
-                           get_match_score=lambda jp, s: f"{round(float(get_score(jp, s)), 1):g}",
+                           **pager.template_args(request),
+                           match_scores=match_scores,
                            show_saveload=False,
                            opts=filter_options_set
                            )
@@ -447,41 +443,28 @@ def seeker_search():
 @bp.route("/companies")
 def company_browse():
     # `request` is a global value that lets you check the URL request.
+    cursor = request.args.get('cursor')
     page_num = request.args.get('page', 1, type=int)
 
-    pager = CompanyProfile.query.paginate(
-        page_num, app.Config.RESULTS_PER_PAGE, False)
-
-    prev_url = modify_query(request, page=pager.prev_num) if pager.has_prev else "#"
-    prev_link_clz = "disabled" if not pager.has_prev else ""
-
-    next_url = modify_query(request, page=pager.next_num) if pager.has_next else "#"
-    next_link_clz = "disabled" if not pager.has_next else ""
-
-    # get lower and upper page count for (up to) 5 surrounding pages
-    max_window = min(5, pager.pages)
-    pg_lower = pg_upper = page_num
-    while pg_upper - pg_lower + 1 < max_window:
-        pg_lower = max(1, pg_lower - 1)
-        pg_upper = min(pager.pages, pg_upper + 1)
+    pager = keyset_paginate(with_profile(CompanyProfile.query, CompanyProfile, 'search_card'),
+                            [(CompanyProfile.id, False)], cursor, app.Config.RESULTS_PER_PAGE, page_num)
     return render_template('company/browse.html', companies=pager.items,
-                           total=pager.total,
-                           page=page_num,
-                           plwr=pg_lower, pupr=pg_upper,
-                           dprev=prev_link_clz, prev_url=prev_url,
-                           dnext=next_link_clz, next_url=next_url)
+                           **pager.template_args(request))
 
 
 @bp.route("/seekers/download")
 @login_required
 def seeker_search_download():
+    """
+    Downloads all of the search's results; `format` can be 'json' (default), 'ndjson' or 'csv'.
+    """
+    fmt = request.args.get('format', 'json')
+    if fmt not in EXPORT_FORMATS:
+        flash(f"Unknown download format: {fmt}")
+        return redirect(url_for('main.seeker_search'))
     req_kwargs = seeker_url_args_to_query_args(request.args)
-    results = get_seeker_query(**req_kwargs).all()
-    results = [s.to_dict() for s in results]
-    output = {"timestamp": datetime.now().isoformat(), "query": f"?{request.query_string.decode()}", "results": results}
-    return Response(json.dumps(output, indent=4),
-                    mimetype='text/json',
-                    headers={'Content-disposition': 'attachment; filename=seeker_search_results.json'})
+    return export_response(get_seeker_query(**req_kwargs, load='export'), fmt, 'seeker_search_results',
+                           f"?{request.query_string.decode()}")
 
   
 @bp.route("/admin/edit", methods=["GET", "POST"])
@@ -631,3 +614,14 @@ def stats_realtime():
         flash(f"Operation not allowed.")
         return redirect(url_for('main.index'))
     return render_template('admin/stats_google_realtime.html')
+
+
+@bp.route("/analytics/sql")
+@login_required
+def stats_sql():
+    if current_user.account_type != AccountTypes.a:
+        flash(f"Operation not allowed.")
+        return redirect(url_for('main.index'))
+    return render_template('admin/stats_sql.html', requests=recent_requests(),
+                           n_plus_one_threshold=app.Config.SQL_N_PLUS_ONE_THRESHOLD,
+                           slow_query_ms=app.Config.SQL_SLOW_QUERY_MS)
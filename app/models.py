@@ -1,32 +1,55 @@
-import colorsys
+import csv
 import enum
+import os
 import re
+import time
+from collections import OrderedDict
 from datetime import datetime
+from functools import lru_cache
 from hashlib import md5
+from itertools import chain
 from operator import itemgetter
-from typing import List, Tuple, Union
-from zlib import crc32
+from threading import Lock
+from typing import Dict, List, Tuple, Union
 from datetime import datetime as dt
 
+from flask import current_app, has_app_context, has_request_context
 from flask_login import UserMixin
-from geopy.distance import geodesic
+from geopy.exc import GeopyError
 from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, \
-    Text, MetaData, DateTime
-from sqlalchemy.dialects.postgresql import ENUM
-from sqlalchemy.orm import relationship, validates
-from sqlalchemy.sql.sqltypes import LargeBinary, Numeric
+    Text, MetaData, DateTime, UniqueConstraint, Index, text, case, func, select, event, update, literal_column, \
+    inspect
+from sqlalchemy.dialects.postgresql import ARRAY, ENUM, insert
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import Session, deferred, relationship, validates
+from sqlalchemy.sql.sqltypes import Float, LargeBinary, Numeric
 from sqlalchemy_imageattach.entity import Image, image_attachment
 from werkzeug.security import generate_password_hash, check_password_hash
 
 from app import db, login, geolocator
+from app.compression import CompressedText
 
 metadata = MetaData()
 
-TINYGRAPH_THEMES = ["sugarsweets", "heatwave", "daisygarden", "seascape", "summerwarmth",
-                    "bythepool", "duskfalling", "frogideas", "berrypie"]
-TSKILL_TITLEIDS = None
-BSKILL_TITLEIDS = None
-ATTITUDE_TITLEIDS = None
+GAZETTEER_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                              'resources', 'us_gazetteer.csv')
+LOCATION_CACHE_SIZE = 4096
+
+
+def encode_ids(ids: List[int], width: int) -> int:
+    """
+    Converts a list of skill/attitude IDs to an integer with the bit for ID `i` at position `width - i`
+        (e.g., for a width of 4, [1, 3] becomes 0b1010).
+    """
+    enc = 0
+    for _id in set(ids or []):
+        enc |= 1 << (width - _id)
+    return enc
+
+
+def decode_ids(mask: int, width: int) -> List[int]:
+    """ Converts an integer from `encode_ids` back to the list of IDs it contains. """
+    return [i for i in range(1, width + 1) if (mask >> (width - i)) & 1]
 
 
 class AccountTypes(enum.Enum):
@@ -119,19 +142,21 @@ class Attitude(db.Model):
 
     @staticmethod
     def to_tuples(sort_index=None, reverse=False) -> List[Tuple[str, int]]:
-        global ATTITUDE_TITLEIDS
-        if ATTITUDE_TITLEIDS is None:
-            ATTITUDE_TITLEIDS = [(a.title, a.id) for a in Attitude.query.all()]
-
+        """ Gets the title and ID of all attitude entries """
+        tups = taxonomy.get().attitudes
         if sort_index is None:
-            return ATTITUDE_TITLEIDS
+            return list(tups)
         else:
-            return sorted(ATTITUDE_TITLEIDS, key=itemgetter(sort_index), reverse=reverse)
+            return sorted(tups, key=itemgetter(sort_index), reverse=reverse)
 
     @staticmethod
     def count() -> int:
-        tups = Attitude.to_tuples()
-        return len(tups)
+        return taxonomy.get().attitude_count
+
+    @staticmethod
+    def width() -> int:
+        """ Number of bits needed to encode a set of attitude IDs (see `encode_ids`). """
+        return taxonomy.get().attitude_width
 
     def to_dict(self):  # TODO do this with the others?
         return {
@@ -165,43 +190,39 @@ class Skill(db.Model):
 
     @staticmethod
     def count() -> int:
-        tups1 = Skill.to_tech_tuples()
-        tups2 = Skill.to_biz_tuples()
-        return len(tups1) + len(tups2)
+        snapshot = taxonomy.get()
+        return snapshot.tech_count + snapshot.biz_count
+
+    @staticmethod
+    def width() -> int:
+        """ Number of bits needed to encode a set of skill IDs (see `encode_ids`). """
+        return taxonomy.get().skill_width
 
     @staticmethod
     def to_tech_tuples(sort_index=None, reverse=False) -> List[Tuple[str, int]]:
         """ Gets the title and ID of all tech skill entries """
-        global TSKILL_TITLEIDS
-        if TSKILL_TITLEIDS is None:
-            TSKILL_TITLEIDS = [(s.title, s.id) for s in Skill.query.all() if s.is_tech()]
-
+        tups = taxonomy.get().tech_skills
         if sort_index is None:
-            return TSKILL_TITLEIDS
+            return list(tups)
         else:
-            return sorted(TSKILL_TITLEIDS, key=itemgetter(sort_index), reverse=reverse)
+            return sorted(tups, key=itemgetter(sort_index), reverse=reverse)
 
     @staticmethod
     def tech_count() -> int:
-        tups = Skill.to_tech_tuples()
-        return len(tups)
+        return taxonomy.get().tech_count
 
     @staticmethod
     def to_biz_tuples(sort_index=None, reverse=False) -> List[Tuple[str, int]]:
         """ Gets the title and ID of all business skill entries """
-        global BSKILL_TITLEIDS
-        if BSKILL_TITLEIDS is None:
-            BSKILL_TITLEIDS = [(s.title, s.id) for s in Skill.query.all() if s.is_biz()]
-
+        tups = taxonomy.get().biz_skills
         if sort_index is None:
-            return BSKILL_TITLEIDS
+            return list(tups)
         else:
-            return sorted(BSKILL_TITLEIDS, key=itemgetter(sort_index), reverse=reverse)
+            return sorted(tups, key=itemgetter(sort_index), reverse=reverse)
 
     @staticmethod
     def biz_count() -> int:
-        tups = Skill.to_biz_tuples()
-        return len(tups)
+        return taxonomy.get().biz_count
 
 
 class UserPicture(db.Model, Image):
@@ -262,13 +283,20 @@ class CompanyProfile(db.Model):  # one to one with company-type user account
 
     """
     __tablename__ = 'company_profile'
+    __table_args__ = (Index('ix_company_profile_lat_lng', 'latitude', 'longitude'),)
 
     id = Column(Integer, primary_key=True)
     user_id = Column('user_id', ForeignKey('user.id', ondelete="CASCADE"), nullable=False, unique=True)
     name = Column(String(191), nullable=False)
     city = Column(String(191))
     state = Column(String(2))
+    # coordinates of the city/state (None if neither are given); kept in sync by `_fill_coordinates`
+    latitude = Column(Float)
+    longitude = Column(Float)
     website = Column(String(191))
+    # hashes of the uploaded logo/banner, if any (see `app.api.images`)
+    logo_hash = Column(String(64))
+    banner_hash = Column(String(64))
     tagline = Column(String(100))
     summary = Column(String)
 
@@ -300,21 +328,12 @@ class CompanyProfile(db.Model):  # one to one with company-type user account
         return self.name and self.city and self.state and self.website and self.tagline and self.summary
 
     def avatar(self, size=128):
-        _hashstr = re.sub(r"\W", "", self.name)
-        # choose "random" attributes (theme and number of colors) based on lazy encoding
-        _hashint = sum([ord(x) for x in self.name])
-        _theme = TINYGRAPH_THEMES[_hashint % len(TINYGRAPH_THEMES)]
-        _ncolors = 3 + (_hashint % 2)
-        return f"http://www.tinygraphs.com/spaceinvaders/{_hashstr}?theme={_theme}&numcolors={_ncolors}&size={size}"
+        from app.api.images import image_url  # imported here to avoid a circular import
+        return image_url(self, 'avatar', size)
 
     def banner(self, dims=(100, 20)):
-        _hashstr = re.sub(r"\W", "", self.name)
-        # choose "random" attributes (theme and number of colors) based on lazy encoding
-        _hashint = sum([ord(x) for x in self.name])
-        _theme = TINYGRAPH_THEMES[_hashint % len(TINYGRAPH_THEMES)]
-        _ncolors = 3 + (_hashint % 2)
-        _ntris = 40 + (_hashint % 20)
-        return f"https://www.tinygraphs.com/isogrids/banner/random/gradient?w={dims[0]}&h={dims[1]}&xt={_ntris}&theme={_theme}&numcolors={_ncolors}"
+        from app.api.images import image_url  # imported here to avoid a circular import
+        return image_url(self, 'banner', tuple(dims))
 
 
 class SeekerProfile(db.Model):
@@ -329,6 +348,10 @@ class SeekerProfile(db.Model):
     One to many with a job bookmarked.
     """
     __tablename__ = 'seeker_profile'
+    __table_args__ = (Index('ix_seeker_profile_lat_lng', 'latitude', 'longitude'),
+                      Index('ix_seeker_profile_tech_skill_ids', 'tech_skill_ids', postgresql_using='gin'),
+                      Index('ix_seeker_profile_biz_skill_ids', 'biz_skill_ids', postgresql_using='gin'),
+                      Index('ix_seeker_profile_attitude_ids', 'attitude_ids', postgresql_using='gin'))
 
     id = Column(Integer, primary_key=True)
     user_id = Column('user_id', ForeignKey('user.id'), nullable=False, unique=True)
@@ -337,11 +360,26 @@ class SeekerProfile(db.Model):
     phone_number = Column(String(10))
     city = Column(String(191))
     state = Column(String(2))
+    # coordinates of the city/state (None if neither are given); kept in sync by `_fill_coordinates`
+    latitude = Column(Float)
+    longitude = Column(Float)
+    grid_cell = Column(Integer, index=True)  # see `grid_cell`
     work_wanted = Column(ENUM(WorkTypes), default=WorkTypes.any)
     remote_wanted = Column(Boolean, default=False)
     tagline = Column(String(100))
-    summary = Column(String)
-    resume = Column(LargeBinary)
+    summary = Column(CompressedText)  # stored compressed when long (see `app.compression`)
+    # the resume is kept in its own table (see `ResumeBlob`), so loading a profile never loads it
+    resume_hash = Column(String(64), ForeignKey('resume_blob.sha256'))
+    resume_size = Column(Integer)
+    picture_hash = Column(String(64))  # of the uploaded profile picture, if any (see `app.api.images`)
+    score_signature = Column(String(32))  # `get_score_signature` as of the last match score update
+    # last change to this row or to anything searchable about it (see `_sync_changed_attribute_ids`)
+    updated_timestamp = Column(DateTime, nullable=False, index=True, default=datetime.utcnow,
+                               onupdate=datetime.utcnow, server_default=text("(now() at time zone 'utc')"))
+    # IDs of the skills/attitudes held; kept in sync on every flush by `sync_attribute_ids`
+    tech_skill_ids = Column(ARRAY(Integer), nullable=False, default=list, server_default='{}')
+    biz_skill_ids = Column(ARRAY(Integer), nullable=False, default=list, server_default='{}')
+    attitude_ids = Column(ARRAY(Integer), nullable=False, default=list, server_default='{}')
 
     _user = relationship("User", back_populates="_seeker")
     _skills = relationship("SeekerSkill", back_populates="_seeker")
@@ -369,10 +407,14 @@ class SeekerProfile(db.Model):
     def is_profile_complete(self):
         return all([
             self.first_name, self.last_name, self.phone_number, self.city, self.state,
-            self.tagline, self.summary, self.resume, len(self._skills), len(self._attitudes),
+            self.tagline, self.summary, self.has_resume, len(self._skills), len(self._attitudes),
             len(self._history_edus), len(self._history_jobs)
         ])
 
+    @property
+    def has_resume(self) -> bool:
+        return self.resume_hash is not None
+
     @property
     def full_name(self):
         return f"{self.first_name} {self.last_name}"
@@ -412,7 +454,7 @@ class SeekerProfile(db.Model):
                 abbvs.append("C")
         return abbvs
 
-    @property
+    @hybrid_property
     def min_edu_level(self) -> int:
         """
         Converts the education experience to a single int representing the minimum qualifications held.
@@ -423,6 +465,15 @@ class SeekerProfile(db.Model):
         # add one since allocating 0 for 'none'
         return int(max([e.education_lvl for e in self._history_edus])) + 1
 
+    @min_edu_level.expression
+    def min_edu_level(cls):
+        """ SQL version of `min_edu_level` (so it can be used in a query's filter) """
+        # the levels are stored by name, so they need to be mapped back to their values
+        lvl_value = case({lvl: int(lvl) for lvl in EducationLevel}, value=SeekerHistoryEducation.education_lvl)
+        return select(func.coalesce(func.max(lvl_value) + 1, 0))\
+            .where(SeekerHistoryEducation.seeker_id == cls.id)\
+            .scalar_subquery()
+
     @property
     def min_edu_abbv(self) -> str:
         """
@@ -442,13 +493,20 @@ class SeekerProfile(db.Model):
         elif lvl == 5:
             return "D.S."
 
-    @property
+    @hybrid_property
     def years_job_experience(self) -> int:
         """
         Calculates the number of years of job experience held.
         """
         return sum([job.years_employed for job in self._history_jobs])
 
+    @years_job_experience.expression
+    def years_job_experience(cls):
+        """ SQL version of `years_job_experience` (so it can be used in a query's filter) """
+        return select(func.coalesce(func.sum(SeekerHistoryJob.years_employed), 0))\
+            .where(SeekerHistoryJob.seeker_id == cls.id)\
+            .scalar_subquery()
+
     def get_tech_skills_levels(self):
         output = [[skr_skl._skill.title, int(skr_skl.skill_level)] for skr_skl in self._skills if
                   skr_skl._skill.is_tech()]
@@ -492,24 +550,28 @@ class SeekerProfile(db.Model):
     def get_attitudes(self) -> List[str]:
         return [skr_att._attitude.title for skr_att in self._attitudes]
 
+    def get_score_signature(self) -> str:
+        """
+        Gets a hash of everything that the match score depends on (location, skills and attitudes).
+        When it differs from `score_signature`, this seeker's match scores are out of date.
+        """
+        inputs = (self.city, self.state,
+                  sorted((s.skill_id, int(s.skill_level)) for s in self._skills),
+                  sorted(a.attitude_id for a in self._attitudes))
+        return md5(repr(inputs).encode('utf-8')).hexdigest()
+
     def is_within(self, distance_limit_mi, city, state) -> bool:
         if not self.city and not self.state:
             # always return true if user does not have a city or a state
             return True
 
-        self_coords = LocationCoordinates.get(self.city, self.state)
-        other_coords = LocationCoordinates.get(city, state)
-
-        dist_mi = geodesic(self_coords, other_coords).miles
-        return dist_mi <= distance_limit_mi
+        from app.api.distance import is_within  # imported here to avoid a circular import
+        return is_within(LocationCoordinates.get(self.city, self.state), LocationCoordinates.get(city, state),
+                         distance_limit_mi)
 
     def avatar(self, size=128):
-        # convert email to random number between 0 and 1
-        r01 = float(crc32(self._user.email.encode("utf-8")) & 0xffffffff) / 2 ** 32
-        rand_bg_hex = "".join([hex(int(round(255 * x)))[2:] for x in colorsys.hsv_to_rgb(r01, 0.25, 1.0)])
-        url = f"https://ui-avatars.com/api/?rounded=true&bold=true&color=00000" \
-              f"&size={size}&background={rand_bg_hex}&name={self.first_name}+{self.last_name}"
-        return url
+        from app.api.images import image_url  # imported here to avoid a circular import
+        return image_url(self, 'avatar', size)
 
     def to_dict(self) -> dict:
         """ Converts an instance of this class to a dictionary (e.g., for JSONifying it)"""
@@ -543,36 +605,21 @@ class SeekerProfile(db.Model):
         Converts technical skills possessed to an integer.
         Only looks at whether the seeker added it to their profile.
         """
-        # skill_id skill_level
-        tskill_ids = [s.skill_id for s in self._skills if s._skill.is_tech()]
-        enc = ['0' for _ in range(Skill.count())]
-        for _id in tskill_ids:
-            enc[_id - 1] = '1'
-        return int(''.join(enc), base=2)
+        return encode_ids(self.tech_skill_ids, Skill.width())
 
     def encode_biz_skills(self) -> int:
         """
         Converts business skills possessed to an integer.
         Only looks at whether the seeker added it to their profile.
         """
-        # skill_id skill_level
-        bskill_ids = [s.skill_id for s in self._skills if s._skill.is_biz()]
-        enc = ['0' for _ in range(Skill.count())]
-        for _id in bskill_ids:
-            enc[_id - 1] = '1'
-        return int(''.join(enc), base=2)
+        return encode_ids(self.biz_skill_ids, Skill.width())
 
     def encode_attitudes(self) -> int:
         """
         Converts attitudes possessed to an integer.
         Only looks at whether the seeker added it to their profile.
         """
-        # skill_id skill_level
-        att_ids = [s.attitude_id for s in self._attitudes]
-        enc = ['0' for _ in range(Attitude.count())]
-        for _id in att_ids:
-            enc[_id - 1] = '1'
-        return int(''.join(enc), base=2)
+        return encode_ids(self.attitude_ids, Attitude.width())
 
 
 class SeekerSkill(db.Model):
@@ -584,8 +631,8 @@ class SeekerSkill(db.Model):
     __tablename__ = 'seeker_skill'
 
     id = Column(Integer, nullable=False, primary_key=True)
-    seeker_id = Column(Integer, ForeignKey('seeker_profile.id', ondelete="CASCADE"), nullable=False)
-    skill_id = Column(Integer, ForeignKey('skill.id', ondelete="CASCADE"), nullable=False)
+    seeker_id = Column(Integer, ForeignKey('seeker_profile.id', ondelete="CASCADE"), nullable=False, index=True)
+    skill_id = Column(Integer, ForeignKey('skill.id', ondelete="CASCADE"), nullable=False, index=True)
     skill_level = Column(ENUM(SkillLevels), nullable=False)
 
     _seeker = relationship("SeekerProfile", back_populates="_skills")
@@ -604,8 +651,8 @@ class SeekerAttitude(db.Model):
     __tablename__ = 'seeker_attitude'
 
     id = Column(Integer, primary_key=True)
-    seeker_id = Column(Integer, ForeignKey('seeker_profile.id', ondelete="CASCADE"), nullable=False)
-    attitude_id = Column(Integer, ForeignKey('attitude.id', ondelete="CASCADE"), nullable=False)
+    seeker_id = Column(Integer, ForeignKey('seeker_profile.id', ondelete="CASCADE"), nullable=False, index=True)
+    attitude_id = Column(Integer, ForeignKey('attitude.id', ondelete="CASCADE"), nullable=False, index=True)
 
     _seeker = relationship('SeekerProfile', back_populates='_attitudes')
     _attitude = relationship('Attitude', back_populates="_seekers")
@@ -622,7 +669,7 @@ class SeekerHistoryEducation(db.Model):
     __tablename__ = 'seeker_history_education'
 
     id = Column(Integer, primary_key=True)
-    seeker_id = Column(Integer, ForeignKey('seeker_profile.id', ondelete="CASCADE"), nullable=False)
+    seeker_id = Column(Integer, ForeignKey('seeker_profile.id', ondelete="CASCADE"), nullable=False, index=True)
     school = Column(String, nullable=False)
     education_lvl = Column(ENUM(EducationLevel), nullable=False)
     study_field = Column(String, nullable=False)
@@ -663,7 +710,7 @@ class SeekerHistoryJob(db.Model):
     __tablename__ = 'seeker_history_job'
 
     id = Column(Integer, primary_key=True)
-    seeker_id = Column(Integer, ForeignKey('seeker_profile.id', ondelete="CASCADE"), nullable=False)
+    seeker_id = Column(Integer, ForeignKey('seeker_profile.id', ondelete="CASCADE"), nullable=False, index=True)
     job_title = Column(String(191))
     years_employed = Column(Integer)
 
@@ -717,6 +764,24 @@ class SeekerBookmark(db.Model):
         return f"Seeker[{self.seeker_id}]-Bookmark[{self.job_id}]"
 
 
+class ResumeBlob(db.Model):
+    """
+    This table holds the contents of uploaded resumes, keyed by their SHA-256 (so identical files are stored once).
+    Seekers refer to theirs by `SeekerProfile.resume_hash`; they're written and read a chunk at a time
+        by `app.api.resumes`, so the contents are never loaded by a query of this table.
+    """
+    __tablename__ = 'resume_blob'
+
+    sha256 = Column(String(64), nullable=False, primary_key=True)
+    size = Column(Integer, nullable=False)  # of the resume itself (not as stored)
+    codec = Column(String(8))  # the data's compression (see `app.compression`), or None if stored as is
+    data = deferred(Column(LargeBinary, nullable=False))
+    created_timestamp = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"Resume[{self.sha256[:12]}|{self.size}]"
+
+
 ##### JOB POST #####
 
 class JobPost(db.Model):
@@ -727,19 +792,36 @@ class JobPost(db.Model):
     One to many with a job post attitude.
     """
     __tablename__ = 'jobpost'
+    __table_args__ = (Index('ix_jobpost_active_created', 'active', 'created_timestamp'),
+                      Index('ix_jobpost_lat_lng', 'latitude', 'longitude'),
+                      Index('ix_jobpost_tech_skill_ids', 'tech_skill_ids', postgresql_using='gin'),
+                      Index('ix_jobpost_biz_skill_ids', 'biz_skill_ids', postgresql_using='gin'),
+                      Index('ix_jobpost_attitude_ids', 'attitude_ids', postgresql_using='gin'))
 
     id = Column(Integer, primary_key=True)
-    company_id = Column(ForeignKey('company_profile.id'), nullable=False)
+    company_id = Column(ForeignKey('company_profile.id'), nullable=False, index=True)
     job_title = Column(String(191), nullable=False)
     city = Column(String(191))
     state = Column(String(2))
-    description = Column(Text)
+    # coordinates of the city/state (None if neither are given); kept in sync by `_fill_coordinates`
+    latitude = Column(Float)
+    longitude = Column(Float)
+    grid_cell = Column(Integer, index=True)  # see `grid_cell`
+    description = Column(CompressedText)  # stored compressed when long (see `app.compression`)
     work_type = Column(ENUM(WorkTypes), default=WorkTypes.any)
     is_remote = Column(Boolean, default=False)
     salary_min = Column(Integer)
     salary_max = Column(Integer)
     created_timestamp = Column(DateTime, default=datetime.utcnow)
     active = Column(Boolean, default=True)
+    score_signature = Column(String(32))  # `get_score_signature` as of the last match score update
+    # last change to this row or to anything searchable about it (see `_sync_changed_attribute_ids`)
+    updated_timestamp = Column(DateTime, nullable=False, index=True, default=datetime.utcnow,
+                               onupdate=datetime.utcnow, server_default=text("(now() at time zone 'utc')"))
+    # IDs of the skills/attitudes held; kept in sync on every flush by `sync_attribute_ids`
+    tech_skill_ids = Column(ARRAY(Integer), nullable=False, default=list, server_default='{}')
+    biz_skill_ids = Column(ARRAY(Integer), nullable=False, default=list, server_default='{}')
+    attitude_ids = Column(ARRAY(Integer), nullable=False, default=list, server_default='{}')
 
     _company = relationship("CompanyProfile", back_populates="_job_posts")
     _skills = relationship("JobPostSkill", back_populates="_job_post")
@@ -913,52 +995,45 @@ class JobPost(db.Model):
         return [(a._attitude.title if name else a.attitude_id, a.importance_level)
                 for a in self._attitudes]
 
+    def get_score_signature(self) -> str:
+        """
+        Gets a hash of everything that the match score depends on (location, skills and attitudes).
+        When it differs from `score_signature`, this post's match scores are out of date.
+        """
+        inputs = (self.city, self.state, self.is_remote,
+                  sorted((s.skill_id, int(s.skill_level_min), int(s.importance_level)) for s in self._skills),
+                  sorted((a.attitude_id, int(a.importance_level)) for a in self._attitudes))
+        return md5(repr(inputs).encode('utf-8')).hexdigest()
+
     def is_within(self, distance_limit_mi, city, state) -> bool:
         if not self.city and not self.state:
             # always return true if user does not have a city or a state
             return True
 
-        self_coords = LocationCoordinates.get(self.city, self.state)
-        other_coords = LocationCoordinates.get(city, state)
-
-        dist_mi = geodesic(self_coords, other_coords).miles
-        return dist_mi <= distance_limit_mi
+        from app.api.distance import is_within  # imported here to avoid a circular import
+        return is_within(LocationCoordinates.get(self.city, self.state), LocationCoordinates.get(city, state),
+                         distance_limit_mi)
 
     def encode_tech_skills(self) -> int:
         """
         Converts technical skills possessed to an integer.
         Only looks at whether the seeker added it to their profile.
         """
-        # skill_id skill_level
-        tskill_ids = [s.skill_id for s in self._skills if s._skill.is_tech()]
-        enc = ['0' for _ in range(Skill.count())]
-        for _id in tskill_ids:
-            enc[_id - 1] = '1'
-        return int(''.join(enc), base=2)
+        return encode_ids(self.tech_skill_ids, Skill.width())
 
     def encode_biz_skills(self) -> int:
         """
         Converts business skills possessed to an integer.
         Only looks at whether the seeker added it to their profile.
         """
-        # skill_id skill_level
-        bskill_ids = [s.skill_id for s in self._skills if s._skill.is_biz()]
-        enc = ['0' for _ in range(Skill.count())]
-        for _id in bskill_ids:
-            enc[_id - 1] = '1'
-        return int(''.join(enc), base=2)
+        return encode_ids(self.biz_skill_ids, Skill.width())
 
     def encode_attitudes(self) -> int:
         """
         Converts attitudes possessed to an integer.
         Only looks at whether the seeker added it to their profile.
         """
-        # skill_id skill_level
-        att_ids = [s.attitude_id for s in self._attitudes]
-        enc = ['0' for _ in range(Attitude.count())]
-        for _id in att_ids:
-            enc[_id - 1] = '1'
-        return int(''.join(enc), base=2)
+        return encode_ids(self.attitude_ids, Attitude.width())
 
 
 class JobPostSkill(db.Model):
@@ -970,8 +1045,8 @@ class JobPostSkill(db.Model):
     __tablename__ = 'jobpost_skill'
 
     id = Column(Integer, nullable=False, primary_key=True)
-    jobpost_id = Column(Integer, ForeignKey('jobpost.id', ondelete="CASCADE"), nullable=False)
-    skill_id = Column(Integer, ForeignKey('skill.id', ondelete="CASCADE"), nullable=False)
+    jobpost_id = Column(Integer, ForeignKey('jobpost.id', ondelete="CASCADE"), nullable=False, index=True)
+    skill_id = Column(Integer, ForeignKey('skill.id', ondelete="CASCADE"), nullable=False, index=True)
     skill_level_min = Column(ENUM(SkillLevels), default=SkillLevels.novice)
     importance_level = Column(ENUM(ImportanceLevel), default=ImportanceLevel.none)
 
@@ -991,8 +1066,8 @@ class JobPostAttitude(db.Model):
     __tablename__ = 'jobpost_attitude'
 
     id = Column(Integer, nullable=False, primary_key=True)
-    jobpost_id = Column(Integer, ForeignKey('jobpost.id', ondelete="CASCADE"), nullable=False)
-    attitude_id = Column(Integer, ForeignKey('attitude.id', ondelete="CASCADE"), nullable=False)
+    jobpost_id = Column(Integer, ForeignKey('jobpost.id', ondelete="CASCADE"), nullable=False, index=True)
+    attitude_id = Column(Integer, ForeignKey('attitude.id', ondelete="CASCADE"), nullable=False, index=True)
     importance_level = Column(ENUM(ImportanceLevel), default=ImportanceLevel.none)
 
     _job_post = relationship("JobPost", back_populates="_attitudes")
@@ -1048,29 +1123,127 @@ class LocationCoordinates(db.Model):
         return f"{city}, {state} USA"
 
     @staticmethod
-    def get(city: str = None, state: str = None, fallback=True) -> Tuple[float, float]:
+    def get(city: str = None, state: str = None, fallback=True, persist=True) -> Tuple[float, float]:
         """
         Gets the coordinates for the given city and/or state.
+        Looks in the in-process cache, then the table, then the bundled gazetteer, and only then asks the geolocator
+            (unless `GEOCODE_ON_REQUEST` is off and this is called while handling a request).
+        Locations that can't be found are remembered too, so they aren't looked up again
+            (but not when the lookup was skipped or the geolocator was unavailable; those are retried later).
         If fallback is true, it will attempt to get the closest matching result
             (just state if city cannot be found, otherwise just 'USA')
+        If persist is false, new lookups are not saved to the table (e.g., while the session is flushing).
         """
         loc_id = LocationCoordinates.to_location(city, state)
 
+        coords = _location_cache.get(loc_id, _MISSING)
+        if coords is _MISSING:
+            coords = LocationCoordinates._lookup(loc_id, persist)
+            if coords is _UNKNOWN:
+                coords = None
+            else:
+                _location_cache.put(loc_id, coords)
+        if coords is None:
+            if not fallback:
+                raise ValueError(f"Cannot be found: '{loc_id}' (city: {city}, state: {state})")
+            if city is not None and state is not None:  # try just getting the state
+                return LocationCoordinates.get(None, state, fallback, persist)
+            # otherwise place in bermuda
+            return 32.3078, -64.7505
+        return coords
+
+    @staticmethod
+    def _lookup(loc_id: str, persist: bool = True) -> Union[Tuple[float, float], None, object]:
+        """
+        Finds the coordinates of a location key without any caching: None if it can't be found,
+            or `_UNKNOWN` if it wasn't found this time but may be later (so it shouldn't be remembered).
+        """
         row = LocationCoordinates.query.get(loc_id)
-        if row is None:
-            # not present, create then return
-            loc_obj = geolocator.geocode(loc_id)
-            if loc_obj is None or loc_obj.latitude is None:
-                if not fallback:
-                    raise ValueError(f"Cannot be found: '{loc_id}' (city: {city}, state: {state})")
-                if state is not None:  # try just getting the state
-                    return LocationCoordinates.get(None, state, fallback)
-                # otherwise place in bermuda
-                return 32.3078, -64.7505
-            row = LocationCoordinates(location=loc_id, latitude=loc_obj.latitude, longitude=loc_obj.longitude)
-            db.session.add(row)
-            db.session.commit()
-        return row.latitude, row.longitude
+        if row is not None:
+            # rows without coordinates are past lookups that failed
+            return (float(row.latitude), float(row.longitude)) if row.latitude is not None else None
+
+        coords = _gazetteer().get(loc_id)
+        if coords is None:
+            if has_request_context() and not current_app.config['GEOCODE_ON_REQUEST']:
+                return _UNKNOWN  # don't persist it; it may still be found outside of a request
+            try:
+                loc_obj = geolocator.geocode(loc_id)
+            except GeopyError:
+                return _UNKNOWN  # the service is unavailable; not the location's fault, so don't persist it
+            if loc_obj is not None and loc_obj.latitude is not None:
+                coords = (loc_obj.latitude, loc_obj.longitude)
+        if not persist:
+            return _UNKNOWN if coords is None else coords  # a miss is only remembered once it's in the table
+        # another process may have just added it; either result is fine to keep
+        db.session.execute(insert(LocationCoordinates)
+                           .values(location=loc_id, latitude=coords[0] if coords else None,
+                                   longitude=coords[1] if coords else None)
+                           .on_conflict_do_nothing(index_elements=[LocationCoordinates.location]))
+        db.session.commit()
+        return coords
+
+    @staticmethod
+    def preload(path: str = GAZETTEER_PATH) -> int:
+        """
+        Loads the bundled gazetteer (coordinates for every state and the larger cities) into the table,
+            replacing any failed lookups for those locations. Returns the number of locations loaded.
+        """
+        rows = [dict(location=loc_id, latitude=lat, longitude=lng) for loc_id, (lat, lng) in _gazetteer(path).items()]
+        stmt = insert(LocationCoordinates).values(rows)
+        stmt = stmt.on_conflict_do_update(index_elements=[LocationCoordinates.location],
+                                          set_=dict(latitude=stmt.excluded.latitude,
+                                                    longitude=stmt.excluded.longitude))
+        db.session.execute(stmt)
+        db.session.commit()
+        _location_cache.clear()
+        return len(rows)
+
+
+_MISSING = object()
+# a location that couldn't be looked up right now (see `LocationCoordinates._lookup`)
+_UNKNOWN = object()
+
+
+class _LRUCache:
+    """ A small thread-safe least-recently-used cache. """
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+# coordinates (or None, if not found) by location key; see `LocationCoordinates.get`
+_location_cache = _LRUCache(LOCATION_CACHE_SIZE)
+
+
+@lru_cache(maxsize=None)
+def _gazetteer(path: str = GAZETTEER_PATH) -> Dict[str, Tuple[float, float]]:
+    """ Reads the bundled gazetteer CSV (city, state, latitude, longitude) into coordinates by location key. """
+    coords = dict()
+    with open(path, newline='') as f:
+        for entry in csv.DictReader(f):
+            loc_id = LocationCoordinates.to_location(entry['city'] or None, entry['state'] or None)
+            coords[loc_id] = (float(entry['latitude']), float(entry['longitude']))
+    return coords
 
 
 class MatchScores(db.Model):
@@ -1078,12 +1251,266 @@ class MatchScores(db.Model):
     This table contains records of seeker-job post match scores.
     It should be updated when a seeker or job is updated.
     It is used by the search results to order by match score.
+    There is at most one entry per seeker-job post pair.
     """
     __tablename__ = 'match_scores'
+    __table_args__ = (UniqueConstraint('seeker_id', 'jobpost_id'),)
     id = Column(Integer, nullable=False, primary_key=True)
     seeker_id = Column(Integer, ForeignKey('seeker_profile.id'), nullable=False)
-    jobpost_id = Column(Integer, ForeignKey('jobpost.id'), nullable=False)
+    jobpost_id = Column(Integer, ForeignKey('jobpost.id'), nullable=False, index=True)
     score = Column(Numeric, nullable=False)
 
     _seekers = relationship("SeekerProfile", back_populates="_scores")
     _job_posts = relationship("JobPost", back_populates="_scores")
+
+
+class ScoreTask(db.Model):
+    """
+    This table is a queue of match score updates for the background worker (see `app.api.tasks`).
+    Each task rescores either a job post (kind 'post') or a seeker (kind 'seeker') against everyone else.
+    Only one pending task can exist per post/seeker, so repeated edits are coalesced into a single update.
+    """
+    __tablename__ = 'score_task'
+    __table_args__ = (Index('ix_score_task_pending_target', 'kind', 'target_id', unique=True,
+                            postgresql_where=text("status = 'pending'")),)
+    id = Column(Integer, nullable=False, primary_key=True)
+    kind = Column(String(6), nullable=False)
+    target_id = Column(Integer, nullable=False)
+    status = Column(String(7), nullable=False, default='pending', index=True)  # pending, running, done, failed
+    attempts = Column(Integer, nullable=False, default=0)
+    error = Column(Text)
+    enqueued_timestamp = Column(DateTime, nullable=False, default=datetime.utcnow)
+    started_timestamp = Column(DateTime)
+    finished_timestamp = Column(DateTime)
+
+    def __repr__(self):
+        return f"ScoreTask[{self.kind}#{self.target_id}|{self.status}]"
+
+
+##### ATTRIBUTE IDS #####
+def _ids_subquery(id_column, owner_column, owner_id_column, skill_type: SkillTypes = None):
+    """ Correlated subquery for the sorted array of attribute IDs an owner has (an empty array if none). """
+    sub = select(func.array_agg(func.distinct(id_column))).where(owner_column == owner_id_column)
+    if skill_type is not None:
+        sub = sub.where(Skill.id == id_column, Skill.type == skill_type)
+    return func.coalesce(sub.scalar_subquery(), literal_column("'{}'::integer[]"))
+
+
+def sync_attribute_ids(session, seeker_ids=None, jobpost_ids=None):
+    """
+    Recomputes the `tech_skill_ids`, `biz_skill_ids` and `attitude_ids` columns of the given seekers and job posts
+        from their skill/attitude tables. Passing None for either list updates every row of that table
+        (e.g., to backfill the columns: `sync_attribute_ids(db.session); db.session.commit()`).
+    """
+    for model, skill_model, attitude_model, owner_ids in (
+            (SeekerProfile, SeekerSkill, SeekerAttitude, seeker_ids),
+            (JobPost, JobPostSkill, JobPostAttitude, jobpost_ids)):
+        if owner_ids is not None and len(owner_ids) == 0:
+            continue
+        skill_owner = skill_model.seeker_id if model is SeekerProfile else skill_model.jobpost_id
+        attitude_owner = attitude_model.seeker_id if model is SeekerProfile else attitude_model.jobpost_id
+        stmt = update(model).values(
+            tech_skill_ids=_ids_subquery(skill_model.skill_id, skill_owner, model.id, SkillTypes.t),
+            biz_skill_ids=_ids_subquery(skill_model.skill_id, skill_owner, model.id, SkillTypes.b),
+            attitude_ids=_ids_subquery(attitude_model.attitude_id, attitude_owner, model.id))
+        if owner_ids is not None:
+            stmt = stmt.where(model.id.in_(owner_ids))
+        session.execute(stmt.execution_options(synchronize_session=False))
+
+
+def _touch(session, model, condition):
+    """ Sets `updated_timestamp` to now on the matching seekers/job posts. """
+    session.execute(update(model).where(condition).values(updated_timestamp=datetime.utcnow())
+                    .execution_options(synchronize_session=False))
+
+
+@event.listens_for(Session, 'after_flush')
+def _sync_changed_attribute_ids(session, flush_context):
+    """
+    Keeps the stored attribute IDs up to date whenever a skill or attitude entry is added, changed or removed.
+    Also bumps the `updated_timestamp` of seekers/job posts whose searchable details live in other tables
+        (their skills, attitudes and history, or their account being (de)activated).
+    """
+    seeker_ids, jobpost_ids, history_seeker_ids, user_ids = set(), set(), set(), set()
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, (SeekerSkill, SeekerAttitude)):
+            seeker_ids.add(obj.seeker_id)
+        elif isinstance(obj, (JobPostSkill, JobPostAttitude)):
+            jobpost_ids.add(obj.jobpost_id)
+        elif isinstance(obj, (SeekerHistoryEducation, SeekerHistoryJob)):
+            history_seeker_ids.add(obj.seeker_id)
+        elif isinstance(obj, User) and inspect(obj).attrs.is_active.history.has_changes():
+            user_ids.add(obj.id)
+    if seeker_ids or jobpost_ids:
+        sync_attribute_ids(session, seeker_ids, jobpost_ids)
+    if seeker_ids or history_seeker_ids:
+        _touch(session, SeekerProfile, SeekerProfile.id.in_(seeker_ids | history_seeker_ids))
+    if jobpost_ids:
+        _touch(session, JobPost, JobPost.id.in_(jobpost_ids))
+    if user_ids:
+        _touch(session, SeekerProfile, SeekerProfile.user_id.in_(user_ids))
+        company_ids = select(CompanyProfile.id).where(CompanyProfile.user_id.in_(user_ids))
+        _touch(session, JobPost, JobPost.company_id.in_(company_ids))
+
+
+##### COORDINATES #####
+GRID_DEGREES = 0.5  # size of the spatial grid's cells (~35 miles of latitude)
+GRID_COLUMNS = int(360 / GRID_DEGREES)
+
+
+def grid_cell(latitude: float, longitude: float) -> Union[int, None]:
+    """
+    Gets the ID of the cell of a uniform latitude/longitude grid that the coordinates fall in.
+    Seekers and job posts store it so the ones near a point can be found by cell (see `app.api.spatial`).
+    """
+    if latitude is None or longitude is None:
+        return None
+    row = min(int((latitude + 90) // GRID_DEGREES), int(180 / GRID_DEGREES) - 1)
+    col = int((longitude + 180) // GRID_DEGREES) % GRID_COLUMNS
+    return row * GRID_COLUMNS + col
+
+
+def _coordinates_for(city: str, state: str, persist: bool = True) -> Tuple[float, float]:
+    """ Gets the coordinates to store for a city/state (None for both if neither are given). """
+    if not city and not state:
+        return None, None
+    return LocationCoordinates.get(city, state, persist=persist)
+
+
+@event.listens_for(Session, 'before_flush')
+def _fill_coordinates(session, flush_context, instances):
+    """
+    Sets the latitude/longitude (and grid cell) of companies, seekers and job posts
+        whose city or state were added or changed.
+    """
+    for obj in chain(session.new, session.dirty):
+        if not isinstance(obj, (CompanyProfile, SeekerProfile, JobPost)):
+            continue
+        attrs = inspect(obj).attrs
+        if obj in session.new or attrs.city.history.has_changes() or attrs.state.history.has_changes():
+            # the session is flushing, so new lookups can't be committed to the location table here
+            obj.latitude, obj.longitude = _coordinates_for(obj.city, obj.state, persist=False)
+            if not isinstance(obj, CompanyProfile):
+                obj.grid_cell = grid_cell(obj.latitude, obj.longitude)
+
+
+def fill_missing_coordinates() -> int:
+    """
+    Sets the latitude/longitude (and grid cell) of every company, seeker and job post that has a city or state
+        but no coordinates (e.g., rows from before the columns were added). Returns the number of rows updated.
+    """
+    n = 0
+    for model in (CompanyProfile, SeekerProfile, JobPost):
+        locations = db.session.query(model.city, model.state)\
+            .filter((model.city.isnot(None)) | (model.state.isnot(None)), model.latitude.is_(None))\
+            .distinct()\
+            .all()
+        for city, state in locations:
+            lat, lng = _coordinates_for(city, state)
+            values = dict(latitude=lat, longitude=lng)
+            if model is not CompanyProfile:
+                values['grid_cell'] = grid_cell(lat, lng)
+            n += model.query.filter(model.city.is_(city) if city is None else model.city == city,
+                                    model.state.is_(state) if state is None else model.state == state,
+                                    model.latitude.is_(None))\
+                .update(values, synchronize_session=False)
+        if model is not CompanyProfile:  # rows with coordinates from before the grid was added
+            rows = db.session.query(model.id, model.latitude, model.longitude)\
+                .filter(model.latitude.isnot(None), model.grid_cell.is_(None))\
+                .all()
+            db.session.bulk_update_mappings(model, [dict(id=_id, grid_cell=grid_cell(lat, lng))
+                                                    for _id, lat, lng in rows])
+            n += len(rows)
+        db.session.commit()
+    return n
+
+
+##### TAXONOMY #####
+class TaxonomyVersion(db.Model):
+    """
+    This table holds a single row (ID 1) whose version is bumped whenever a skill or attitude is added, changed
+        or removed, so every worker knows to reload its copy of them (see `_TaxonomyCache`).
+    """
+    __tablename__ = 'taxonomy_version'
+    id = Column(Integer, nullable=False, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
+class TaxonomySnapshot:
+    """ The skills and attitudes as of one version: their titles/IDs by type, counts and bitmask widths. """
+    def __init__(self, version: int, skills: List[Tuple[str, int, SkillTypes]], attitudes: List[Tuple[str, int]]):
+        self.version = version
+        self.tech_skills = [(title, _id) for title, _id, type_ in skills if type_ == SkillTypes.t]
+        self.biz_skills = [(title, _id) for title, _id, type_ in skills if type_ == SkillTypes.b]
+        self.attitudes = [(title, _id) for title, _id in attitudes]
+        self.skill_ids = {title: _id for title, _id, _ in skills}
+        self.skill_titles = {_id: title for title, _id, _ in skills}
+        self.attitude_ids = {title: _id for title, _id in attitudes}
+        self.attitude_titles = {_id: title for title, _id in attitudes}
+        self.tech_count = len(self.tech_skills)
+        self.biz_count = len(self.biz_skills)
+        self.attitude_count = len(self.attitudes)
+        # the bit for ID `i` is at position `width - i`, so the width has to cover the largest ID
+        self.skill_width = max(chain(self.skill_titles, [len(skills)]), default=0)
+        self.attitude_width = max(chain(self.attitude_titles, [len(attitudes)]), default=0)
+
+
+def _taxonomy_version(session) -> int:
+    return session.query(TaxonomyVersion.version).filter(TaxonomyVersion.id == 1).scalar() or 0
+
+
+class _TaxonomyCache:
+    """
+    Each worker's copy of the skills and attitudes, which rarely change but are read on every search.
+    Before being used, the stored version is checked (at most every `TAXONOMY_CHECK_SECONDS`),
+        and if another worker changed them since the copy was loaded, it's reloaded.
+    """
+    def __init__(self):
+        self._snapshot = None
+        self._checked = 0.0
+        self._lock = Lock()
+
+    def get(self) -> TaxonomySnapshot:
+        interval = current_app.config['TAXONOMY_CHECK_SECONDS'] if has_app_context() else 0
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is not None and time.monotonic() - self._checked < interval:
+                return snapshot
+            version = _taxonomy_version(db.session)
+            if snapshot is None or snapshot.version != version:
+                skills = db.session.query(Skill.title, Skill.id, Skill.type).order_by(Skill.id).all()
+                attitudes = db.session.query(Attitude.title, Attitude.id).order_by(Attitude.id).all()
+                snapshot = self._snapshot = TaxonomySnapshot(version, skills, attitudes)
+            self._checked = time.monotonic()
+            return snapshot
+
+    def invalidate(self):
+        """ Drops this worker's copy, so the next use reloads it. """
+        with self._lock:
+            self._snapshot = None
+
+
+taxonomy = _TaxonomyCache()
+
+
+@event.listens_for(Session, 'after_flush')
+def _bump_taxonomy_version(session, flush_context):
+    """ Bumps the stored version when a skill or attitude is added, changed or removed. """
+    if not any(isinstance(obj, (Skill, Attitude)) for obj in chain(session.new, session.dirty, session.deleted)):
+        return
+    stmt = insert(TaxonomyVersion).values(id=1, version=1)
+    session.execute(stmt.on_conflict_do_update(index_elements=[TaxonomyVersion.id],
+                                               set_=dict(version=TaxonomyVersion.version + 1)))
+    session.info['taxonomy_changed'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _reload_taxonomy(session):
+    """ Drops this worker's copy right away once a change is committed (others see the new version). """
+    if session.info.pop('taxonomy_changed', False):
+        taxonomy.invalidate()
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_taxonomy_change(session, previous_transaction):
+    session.info.pop('taxonomy_changed', None)
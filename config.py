@@ -48,3 +48,52 @@ class Config:
     LOG_TO_STDOUT = os.environ.get('LOG_TO_STDOUT')
     SQLALCHEMY_ECHO = False
     RESULTS_PER_PAGE = 15
+    # background worker for match score updates (see worker.py)
+    SCORE_WORKER_PROCESSES = int(os.environ.get('SCORE_WORKER_PROCESSES') or 2)
+    SCORE_WORKER_POLL_SECONDS = float(os.environ.get('SCORE_WORKER_POLL_SECONDS') or 2)
+    SCORE_TASK_TIMEOUT_MINUTES = int(os.environ.get('SCORE_TASK_TIMEOUT_MINUTES') or 30)
+    # failed tasks are retried until they've been tried this many times
+    SCORE_TASK_MAX_ATTEMPTS = int(os.environ.get('SCORE_TASK_MAX_ATTEMPTS') or 3)
+
+    # search filtering: 'sql' (default) or 'memory' (see app/api/search_engine.py)
+    SEARCH_ENGINE = os.environ.get('SEARCH_ENGINE') or 'sql'
+    SEARCH_ENGINE_REFRESH_SECONDS = float(os.environ.get('SEARCH_ENGINE_REFRESH_SECONDS') or 1)
+    # how often each worker checks whether the skills/attitudes changed (see `_TaxonomyCache` in app/models.py)
+    TAXONOMY_CHECK_SECONDS = float(os.environ.get('TAXONOMY_CHECK_SECONDS') or 5)
+    # when false, locations missing from the table/gazetteer are treated as unknown instead of geocoded mid-request
+    GEOCODE_ON_REQUEST = (os.environ.get('GEOCODE_ON_REQUEST') or 'true').lower() in ('1', 'true', 'yes')
+    # 'fast' (haversine), 'auto' (haversine, geodesic near the limits) or 'exact' (geodesic); see app/api/distance.py
+    DISTANCE_ACCURACY = os.environ.get('DISTANCE_ACCURACY') or 'auto'
+    # search result totals: counted exactly up to this many (by the planner's estimate), estimated above it
+    SEARCH_COUNT_EXACT_THRESHOLD = int(os.environ.get('SEARCH_COUNT_EXACT_THRESHOLD') or 1000)
+    SEARCH_COUNT_CACHE_SECONDS = float(os.environ.get('SEARCH_COUNT_CACHE_SECONDS') or 60)
+    # search result cache (see app/api/search_cache.py); a size of 0 disables it
+    SEARCH_CACHE_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE') or 256)
+    SEARCH_CACHE_TTL_SECONDS = float(os.environ.get('SEARCH_CACHE_TTL_SECONDS') or 300)
+    SEARCH_CACHE_MAX_IDS = int(os.environ.get('SEARCH_CACHE_MAX_IDS') or 5000)
+    # resumes (see app/api/resumes.py): the largest accepted, how much of an upload is kept in memory,
+    #   and how much is read/written at a time
+    RESUME_MAX_BYTES = int(os.environ.get('RESUME_MAX_BYTES') or 10 * 1024 * 1024)
+    RESUME_SPOOL_BYTES = int(os.environ.get('RESUME_SPOOL_BYTES') or 1024 * 1024)
+    RESUME_CHUNK_BYTES = int(os.environ.get('RESUME_CHUNK_BYTES') or 256 * 1024)
+    # compression of resumes and long text (see app/compression.py): 'zlib' or 'zstd' (needs the zstandard package),
+    #   and the shortest value that's compressed
+    COMPRESSION_CODEC = os.environ.get('COMPRESSION_CODEC') or 'zlib'
+    COMPRESSION_MIN_BYTES = int(os.environ.get('COMPRESSION_MIN_BYTES') or 512)
+    # downloads sent by the web server in front (see app/api/filestore.py): '' (off), 'x-accel' or 'x-sendfile'
+    FILE_OFFLOAD = os.environ.get('FILE_OFFLOAD') or ''
+    FILE_STORE_DIR = os.environ.get('FILE_STORE_DIR') or os.path.join(basedir, 'filestore')
+    FILE_STORE_URL_PREFIX = os.environ.get('FILE_STORE_URL_PREFIX') or '/_files/'
+    # avatars/banners (see app/api/images.py): rendering processes per worker, how long a request waits for one,
+    #   and the largest picture accepted
+    IMAGE_RENDER_PROCESSES = int(os.environ.get('IMAGE_RENDER_PROCESSES') or 2)
+    IMAGE_RENDER_TIMEOUT_SECONDS = float(os.environ.get('IMAGE_RENDER_TIMEOUT_SECONDS') or 10)
+    IMAGE_MAX_UPLOAD_BYTES = int(os.environ.get('IMAGE_MAX_UPLOAD_BYTES') or 5 * 1024 * 1024)
+    # rows fetched at a time when streaming search result downloads
+    EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE') or 500)
+    # per-request SQL statistics (see app/api/instrumentation.py); off unless enabled
+    SQL_INSTRUMENTATION = (os.environ.get('SQL_INSTRUMENTATION') or 'false').lower() in ('1', 'true', 'yes')
+    SQL_SLOW_QUERY_MS = float(os.environ.get('SQL_SLOW_QUERY_MS') or 200)
+    SQL_EXPLAIN_SLOW = (os.environ.get('SQL_EXPLAIN_SLOW') or 'false').lower() in ('1', 'true', 'yes')
+    SQL_N_PLUS_ONE_THRESHOLD = int(os.environ.get('SQL_N_PLUS_ONE_THRESHOLD') or 10)
+    SQL_STATS_BUFFER_SIZE = int(os.environ.get('SQL_STATS_BUFFER_SIZE') or 200)
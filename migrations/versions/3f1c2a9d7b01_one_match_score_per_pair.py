@@ -0,0 +1,41 @@
+"""one match score per pair, and score signatures
+
+Revision ID: 3f1c2a9d7b01
+Revises:
+Create Date: 2026-10-17 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a9d7b01'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+CONSTRAINT = 'match_scores_seeker_id_jobpost_id_key'
+
+
+def _columns(table):
+    return {c['name'] for c in sa.inspect(op.get_bind()).get_columns(table)}
+
+
+def upgrade():
+    # the same cleanup as `remove_duplicate_scores` (the newest entry of each pair is kept);
+    #   it has to run first, or the constraint can't be added to a database with duplicates
+    op.execute("DELETE FROM match_scores WHERE id NOT IN "
+               "(SELECT max(id) FROM match_scores GROUP BY seeker_id, jobpost_id)")
+    constraints = {c['name'] for c in sa.inspect(op.get_bind()).get_unique_constraints('match_scores')}
+    if CONSTRAINT not in constraints:
+        op.create_unique_constraint(CONSTRAINT, 'match_scores', ['seeker_id', 'jobpost_id'])
+    for table in ('seeker_profile', 'jobpost'):
+        if 'score_signature' not in _columns(table):
+            op.add_column(table, sa.Column('score_signature', sa.String(length=32), nullable=True))
+
+
+def downgrade():
+    op.drop_column('jobpost', 'score_signature')
+    op.drop_column('seeker_profile', 'score_signature')
+    op.drop_constraint(CONSTRAINT, 'match_scores', type_='unique')
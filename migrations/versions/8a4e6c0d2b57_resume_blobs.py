@@ -0,0 +1,60 @@
+"""resumes in their own table
+
+Revision ID: 8a4e6c0d2b57
+Revises: 3f1c2a9d7b01
+Create Date: 2026-10-17 12:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8a4e6c0d2b57'
+down_revision = '3f1c2a9d7b01'
+branch_labels = None
+depends_on = None
+
+
+def _columns(table):
+    return {c['name'] for c in sa.inspect(op.get_bind()).get_columns(table)}
+
+
+def upgrade():
+    if not sa.inspect(op.get_bind()).has_table('resume_blob'):
+        op.create_table('resume_blob',
+                        sa.Column('sha256', sa.String(length=64), nullable=False),
+                        sa.Column('size', sa.Integer(), nullable=False),
+                        sa.Column('codec', sa.String(length=8), nullable=True),
+                        sa.Column('data', sa.LargeBinary(), nullable=False),
+                        sa.Column('created_timestamp', sa.DateTime(), nullable=False),
+                        sa.PrimaryKeyConstraint('sha256'))
+    columns = _columns('seeker_profile')
+    if 'resume_hash' not in columns:
+        op.add_column('seeker_profile', sa.Column('resume_hash', sa.String(length=64), nullable=True))
+        op.create_foreign_key('seeker_profile_resume_hash_fkey', 'seeker_profile', 'resume_blob',
+                              ['resume_hash'], ['sha256'])
+    if 'resume_size' not in columns:
+        op.add_column('seeker_profile', sa.Column('resume_size', sa.Integer(), nullable=True))
+
+    if 'resume' in columns:
+        # copied as they are (uncompressed); `flask compress-stored` can compress them afterwards
+        op.execute("INSERT INTO resume_blob (sha256, size, data, created_timestamp) "
+                   "SELECT encode(sha256(resume), 'hex'), length(resume), resume, now() at time zone 'utc' "
+                   "FROM seeker_profile WHERE resume IS NOT NULL "
+                   "ON CONFLICT (sha256) DO NOTHING")
+        op.execute("UPDATE seeker_profile "
+                   "SET resume_hash = encode(sha256(resume), 'hex'), resume_size = length(resume) "
+                   "WHERE resume IS NOT NULL")
+        op.drop_column('seeker_profile', 'resume')
+
+
+def downgrade():
+    op.add_column('seeker_profile', sa.Column('resume', sa.LargeBinary(), nullable=True))
+    # compressed resumes can't be decompressed here; run this after rewriting them uncompressed, or they're lost
+    op.execute("UPDATE seeker_profile SET resume = resume_blob.data FROM resume_blob "
+               "WHERE seeker_profile.resume_hash = resume_blob.sha256 AND resume_blob.codec IS NULL")
+    op.drop_constraint('seeker_profile_resume_hash_fkey', 'seeker_profile', type_='foreignkey')
+    op.drop_column('seeker_profile', 'resume_size')
+    op.drop_column('seeker_profile', 'resume_hash')
+    op.drop_table('resume_blob')
@@ -0,0 +1,16 @@
+# Entry point for the match score worker; see `app.api.tasks`.
+import argparse
+
+from app import create_app
+from app.api.tasks import run_worker
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Runs queued match score updates.")
+    parser.add_argument('--processes', type=int, default=None,
+                        help="number of worker processes (defaults to SCORE_WORKER_PROCESSES)")
+    parser.add_argument('--once', action='store_true', help="exit once the queue is empty")
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        run_worker(args.processes, args.once)